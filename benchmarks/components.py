@@ -0,0 +1,105 @@
+#    Copyright 2013 10gen Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Times the helpers the /mws endpoints are built from, in isolation.
+"""
+
+from urllib import quote
+
+from bson.json_util import dumps
+from flask import session
+
+from webapps.ivs.verify.ValidationTest import ValidationTest
+from webapps.lib.db import get_db
+from webapps.lib.decorators import check_session_id, ratelimit
+from webapps.server.operations import (calculate_document_size,
+                                       validate_document_or_list)
+from webapps.server.views import parse_get_json, to_json
+from benchmarks.endpoints import request
+from benchmarks.harness import case, make_document
+
+
+class CollectionComparison(ValidationTest):
+    def run(self):
+        pass
+
+
+def _view(res_id=None):
+    return None
+
+
+def request_context(app, url='/', session_id=None):
+    """Returns setup and teardown functions pushing a request context for
+    url around each iteration."""
+    def setup():
+        ctx = app.test_request_context(url)
+        ctx.push()
+        if session_id is not None:
+            session['session_id'] = session_id
+        return ctx
+
+    def teardown(ctx):
+        ctx.pop()
+    return setup, teardown
+
+
+def cases(app, sizes, batch_sizes, bulk_sizes):
+    client = app.test_client()
+    res_id = request(client, 'post', '/mws/')['res_id']
+    with client.session_transaction() as client_session:
+        session_id = client_session['session_id']
+
+    checked = check_session_id(_view)
+    yield case('check_session_id', {},
+               lambda ctx: checked(res_id=res_id),
+               *request_context(app, session_id=session_id))
+    limited = ratelimit(_view, endpoint_class='read')
+    yield case('ratelimit', {}, lambda ctx: limited(),
+               *request_context(app, session_id=session_id))
+
+    for size_name, size in sorted(sizes.iteritems()):
+        document = make_document(size)
+        params = {'size': size_name}
+        yield case('validate_document_or_list', params,
+                   lambda arg, d=document: validate_document_or_list(d))
+        yield case('calculate_document_size', params,
+                   lambda arg, d=document: calculate_document_size(d))
+
+        for count in sorted(set(batch_sizes) | set(bulk_sizes)):
+            documents = [make_document(size, i) for i in xrange(count)]
+            batch_params = dict(params, batch=count)
+            yield case('validate_document_or_list', batch_params,
+                       lambda arg, d=documents: validate_document_or_list(d))
+            yield case('calculate_document_size', batch_params,
+                       lambda arg, d=documents: calculate_document_size(d))
+            yield case('to_json', batch_params,
+                       lambda arg, d=documents: to_json(
+                           {'result': d, 'cursor_id': '0'}))
+            url = '/?data=%s' % quote(dumps({'document': documents}))
+            yield case('parse_get_json', batch_params,
+                       lambda ctx: parse_get_json(),
+                       *request_context(app, url))
+            yield case('ValidationTest.collection_equals', batch_params,
+                       *_comparison_case(res_id, size_name, documents))
+
+
+def _comparison_case(res_id, size_name, documents):
+    collection = 'validation_%s_%d' % (size_name, len(documents))
+    db = get_db()
+    db.drop_collection(collection)
+    db[collection].insert([dict(d) for d in documents])
+    expected = [dict(d) for d in documents]
+    comparison = CollectionComparison(res_id)
+    return (lambda arg: comparison.collection_equals(collection, expected),)
@@ -0,0 +1,158 @@
+#    Copyright 2013 10gen Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Times the /mws endpoints through the Flask test client, so that each figure
+includes routing, session handling, rate limiting and serialization.
+"""
+
+from urllib import quote
+
+from bson.json_util import dumps, loads
+from bson.objectid import ObjectId
+
+from webapps.lib.util import UseResId
+from benchmarks.harness import case, make_document
+
+READ_DOCUMENTS = 250  # documents in the collections read by find and next
+INSERTED_LIMIT = 2000  # documents inserted before a collection is emptied
+
+
+def request(client, method, url, data=None, expected_status=200):
+    """Makes a request like the shell does. Raises AssertionError if it
+    does not return expected_status."""
+    if data is not None:
+        data = dumps(data)
+        if method == 'get':
+            url = '%s?data=%s' % (url, quote(data))
+            data = None
+    rv = getattr(client, method)(url, data=data,
+                                 content_type='application/json')
+    if rv.status_code != expected_status:
+        raise AssertionError('%s %s returned %s: %s' %
+                             (method.upper(), url, rv.status_code, rv.data))
+    return loads(rv.data) if rv.data else None
+
+
+def endpoint(client, method, url, data=None):
+    return lambda arg: request(client, method, url, data)
+
+
+def with_batch_size(app, batch_size, func):
+    def run(arg):
+        app.config['CURSOR_BATCH_SIZE'] = batch_size
+        return func(arg)
+    return run
+
+
+def emptied_every(res_id, collection, limit):
+    """Returns a setup function that drops collection every limit calls, so
+    that insert cases do not grow it without bound."""
+    calls = [0]
+
+    def setup():
+        calls[0] += 1
+        if calls[0] % limit == 0:
+            with UseResId(res_id) as db:
+                db.drop_collection(collection)
+    return setup
+
+
+def cases(app, sizes, batch_sizes, bulk_sizes):
+    client = app.test_client()
+    res_id = request(client, 'post', '/mws/')['res_id']
+
+    def url(collection, operation):
+        return '/mws/%s/db/%s/%s' % (res_id, collection, operation)
+
+    yield case('create', {},
+               lambda arg: request(app.test_client(), 'post', '/mws/'))
+    yield case('create', {'session': 'existing'},
+               endpoint(client, 'post', '/mws/'))
+
+    for size_name, size in sorted(sizes.iteritems()):
+        params = {'size': size_name}
+
+        # Writes
+        written = 'written_%s' % size_name
+        yield case('insert', params,
+                   endpoint(client, 'post', url(written, 'insert'),
+                            {'document': make_document(size)}),
+                   emptied_every(res_id, written, INSERTED_LIMIT))
+        for bulk in bulk_sizes:
+            documents = [make_document(size, i) for i in xrange(bulk)]
+            yield case('insert', dict(params, bulk=bulk),
+                       endpoint(client, 'post', url(written, 'insert'),
+                                {'document': documents}),
+                       emptied_every(res_id, written,
+                                     max(INSERTED_LIMIT // bulk, 1)))
+
+        # Reads, on a collection that only the update case changes
+        read = 'read_%s' % size_name
+        documents = [make_document(size, i) for i in xrange(READ_DOCUMENTS)]
+        request(client, 'post', url(read, 'insert'), {'document': documents})
+
+        for batch_size in batch_sizes:
+            batch_params = dict(params, batch=batch_size)
+            find = endpoint(client, 'get', url(read, 'find'), {'query': {}})
+            yield case('find', batch_params,
+                       with_batch_size(app, batch_size, find))
+            yield case('next', batch_params,
+                       *_next_case(app, client, url(read, 'find'),
+                                   url(read, 'next'), batch_size))
+
+        yield case('count', params,
+                   endpoint(client, 'get', url(read, 'count'),
+                            {'query': {'i': {'$gte': 10}}}))
+        yield case('aggregate', params,
+                   endpoint(client, 'get', url(read, 'aggregate'), [
+                       {'$match': {'i': {'$gte': 10}}},
+                       {'$group': {'_id': None, 'total': {'$sum': '$i'}}}
+                   ]))
+        yield case('update', params,
+                   endpoint(client, 'put', url(read, 'update'), {
+                       'query': {'i': 0},
+                       'update': {'$set': {'name': 'updated'}}
+                   }))
+        yield case('remove', params,
+                   *_remove_case(client, res_id, read, url(read, 'remove'),
+                                 size))
+
+
+def _next_case(app, client, find_url, next_url, batch_size):
+    def setup():
+        app.config['CURSOR_BATCH_SIZE'] = batch_size
+        result = request(client, 'get', find_url, {'query': {}})
+        return {'cursor_id': result['cursor_id'], 'retrieved': batch_size}
+
+    def run(params):
+        app.config['CURSOR_BATCH_SIZE'] = batch_size
+        request(client, 'get', next_url, params)
+    return run, setup
+
+
+def _remove_case(client, res_id, collection, remove_url, size):
+    def setup():
+        document = make_document(size)
+        document['_id'] = ObjectId()
+        with UseResId(res_id) as db:
+            db[collection].insert(document)
+        return document['_id']
+
+    def run(_id):
+        request(client, 'delete', remove_url, {
+            'constraint': {'_id': _id},
+            'options': {'justOne': True}
+        })
+    return run, setup
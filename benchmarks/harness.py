@@ -0,0 +1,151 @@
+#    Copyright 2013 10gen Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Times benchmark cases and compares their results against a baseline.
+
+A case has a name, a dict of params and a func called once per iteration.
+Only func is timed. setup, if given, is called before each iteration and
+its return value passed to func and then to teardown, so that state a case
+consumes (a fresh cursor, a document to remove, a pushed request context)
+is made and cleaned up outside the timing.
+"""
+
+from collections import namedtuple
+import json
+import platform
+import time
+import timeit
+
+SIZES = {'small': 100, 'medium': 1024, 'large': 16 * 1024}  # bytes
+
+Case = namedtuple('Case', 'name params func setup teardown')
+
+
+def case(name, params, func, setup=None, teardown=None):
+    return Case(name, params, func, setup, teardown)
+
+
+def make_document(size, i=0):
+    """Returns a document of roughly size bytes once BSON encoded."""
+    document = {
+        'i': i,
+        'name': 'document %d' % i,
+        'tags': ['mongo', 'shell', i % 7],
+        'nested': {'a': i, 'b': [1, 2, 3]},
+    }
+    padding = size - 120
+    if padding > 0:
+        document['padding'] = 'x' * padding
+    return document
+
+
+def case_key(name, params):
+    if not params:
+        return name
+    return '%s[%s]' % (name, ','.join('%s=%s' % (k, params[k])
+                                       for k in sorted(params)))
+
+
+def _percentile(ordered, fraction):
+    index = min(int(round(fraction * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+
+def measure(func, setup=None, teardown=None, iterations=200, warmup=10):
+    """Returns timing stats, in seconds per call, for iterations calls of
+    func."""
+    timer = timeit.default_timer
+    times = []
+    for i in xrange(warmup + iterations):
+        arg = setup() if setup else None
+        start = timer()
+        try:
+            func(arg)
+        finally:
+            elapsed = timer() - start
+            if teardown:
+                teardown(arg)
+        if i >= warmup:
+            times.append(elapsed)
+    times.sort()
+    return {
+        'iterations': iterations,
+        'min': times[0],
+        'median': _percentile(times, 0.5),
+        'p90': _percentile(times, 0.9),
+        'mean': sum(times) / len(times),
+    }
+
+
+def run(cases, iterations, warmup, pattern=None, report=None):
+    """Measures every case whose key contains pattern. Returns the results
+    as a list of dicts."""
+    results = []
+    for c in cases:
+        key = case_key(c.name, c.params)
+        if pattern and pattern not in key:
+            continue
+        stats = measure(c.func, c.setup, c.teardown, iterations, warmup)
+        result = dict(stats, key=key, name=c.name, params=c.params)
+        results.append(result)
+        if report is not None:
+            report(result)
+    return results
+
+
+def metadata(**extra):
+    meta = {
+        'timestamp': int(time.time()),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'node': platform.node(),
+    }
+    meta.update(extra)
+    return meta
+
+
+def save(path, results, meta):
+    with open(path, 'w') as f:
+        json.dump({'meta': meta, 'results': results}, f, indent=2,
+                  sort_keys=True)
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare(results, baseline, threshold):
+    """
+    Compares the median of each result with the same case in baseline.
+    Returns [(key, baseline median, median, ratio)] for the cases that are
+    more than threshold (a fraction) slower.
+    """
+    before = dict((r['key'], r['median']) for r in baseline['results'])
+    regressions = []
+    for result in results:
+        old = before.get(result['key'])
+        if not old:
+            continue
+        ratio = result['median'] / old
+        if ratio > 1 + threshold:
+            regressions.append((result['key'], old, result['median'], ratio))
+    return regressions
+
+
+def format_result(result):
+    return '%-60s median %9.1fus  p90 %9.1fus  min %9.1fus' % (
+        result['key'], result['median'] * 1e6, result['p90'] * 1e6,
+        result['min'] * 1e6)
@@ -157,6 +157,33 @@ describe('The Collection class', function () {
     });
   });
 
+  describe('in a multi-statement script', function () {
+    var queueOperation;
+
+    beforeEach(function () {
+      queueOperation = spyOn(mongo.request, 'queueOperation');
+      coll.shell.batchWrites = true;
+    });
+
+    it('queues writes instead of making requests', function () {
+      coll.insert({a: 1});
+      coll.save({a: 2});
+      coll.update({a: 1}, {a: 3});
+      coll.remove({a: 3});
+      expect(makeRequest).not.toHaveBeenCalled();
+      expect(pause).not.toHaveBeenCalled();
+      expect(queueOperation.calls.length).toEqual(4);
+      expect(queueOperation.calls[0].args).toEqual(
+        [coll.shell, name_, 'insert', {document: {a: 1}}]);
+    });
+
+    it('returns the queued write', function () {
+      var write = {};
+      queueOperation.andReturn(write);
+      expect(coll.insert({a: 1})).toBe(write);
+    });
+  });
+
   describe('remove', function () {
     it('uses the collection url', function () {
       coll.urlBase = 'test_url_base/';
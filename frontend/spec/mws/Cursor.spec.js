@@ -261,7 +261,7 @@ describe('A Cursor', function () {
       });
 
       it('does not re-execute and calls the on success callback if it has all results', function () {
-        instance._count = 1;
+        instance._hasNext = false;
         instance._retrieved = 1;
         instance._executeQuery(callbackSpy);
         expect(instance._executed).toBe(true);
@@ -270,7 +270,7 @@ describe('A Cursor', function () {
       });
 
       it('re-executes and calls the on success callback if it does not have all results', function () {
-        instance._count = 10;
+        instance._hasNext = true;
         instance._retrieved = 1;
         instance._executeQuery(callbackSpy);
         expect(instance._executed).toBe(true);
@@ -387,6 +387,35 @@ describe('A Cursor', function () {
         });
       });
 
+      describe('ending on a batch boundary', function () {
+        beforeEach(function () {
+          instance._result = [];
+          instance._hasNext = true;
+          instance._cursorId = 1234;
+          result = {result: [], empty_cursor: true};
+        });
+
+        it('ends without an error when the getMore is empty', function () {
+          var callback = jasmine.createSpy();
+          instance._shell.lastUsedCursor = instance;
+          expect(instance.hasNext()).toBe(true);
+          instance.next(callback);
+          expect(makeRequest).toHaveBeenCalled();
+          expect(callback).not.toHaveBeenCalled();
+          expect(resume.mostRecentCall.args.length).toBe(1);
+          expect(instance.hasNext()).toBe(false);
+          expect(instance._shell.lastUsedCursor).toBe(null);
+        });
+
+        it('throws if next is called again', function () {
+          instance.next();
+          instance.next();
+          var error = new Error('Cursor does not have any more elements.');
+          expect(resume.mostRecentCall.args[1]).toEqual(error);
+          expect(resume.mostRecentCall.args[2]).toEqual(true);
+        });
+      });
+
       describe('will not execute a function that', function () {
         it('sorts the query result set', function () {
           // TODO: Implement sort.
@@ -432,6 +461,36 @@ describe('A Cursor', function () {
     });
   });
 
+  describe('draining the cursor to an array', function () {
+    var streamRequest;
+
+    beforeEach(function () {
+      streamRequest = spyOn(mongo.request, 'streamRequest').andCallFake(
+          function (url, params, name, shell, onItem, onDone) {
+        onItem('more');
+        onItem('results');
+        onDone();
+      });
+    });
+
+    it('streams the documents left after the first batch', function () {
+      instance.toArray();
+      var params = streamRequest.mostRecentCall.args[1];
+      expect(streamRequest.mostRecentCall.args[0]).toEqual(instance.urlBase + 'next');
+      expect(params).toEqual({cursor_id: 1234, retrieved: 3, drain_cursor: true});
+      expect(resume.mostRecentCall.args[1]).toEqual(
+        ['test', 'results', 'here', 'more', 'results']);
+      expect(instance.hasNext()).toBe(false);
+    });
+
+    it('passes the array to a callback instead of resuming', function () {
+      var callback = jasmine.createSpy();
+      instance.toArray(callback);
+      expect(pause).not.toHaveBeenCalled();
+      expect(callback.mostRecentCall.args[0].length).toEqual(5);
+    });
+  });
+
   describe('accessing the cursor like an array', function () {
     it('pauses evaluation', function () {
       result.result = [0];
@@ -452,6 +511,10 @@ describe('A Cursor', function () {
   });
 
   describe('counting results', function () {
+    beforeEach(function () {
+      instance = new mongo.Cursor(coll, jasmine.createSpy(), {});
+    });
+
     it('doesn\'t execute the query', function () {
       instance.count();
       expect(instance._executed).toBe(false);
@@ -464,9 +527,8 @@ describe('A Cursor', function () {
 
     it('resumes evaluation with the count', function () {
       var query = {a: {$gt: 2}};
-      var projection = {_id: 0, b: 1};
       coll.urlBase = 'my_coll_url/';
-      instance = new mongo.Cursor(coll, query, projection);
+      instance = new mongo.Cursor(coll, jasmine.createSpy(), query);
       result = {count: 12};
 
       instance.count();
@@ -500,6 +562,15 @@ describe('A Cursor', function () {
       expect(params.limit).toEqual(7);
     });
 
+    it('executes an aggregation cursor to count its results', function () {
+      instance = new mongo.Cursor(coll, function (onSuccess) {
+        onSuccess({result: [1, 2, 3]});
+      });
+      instance.count();
+      expect(makeRequest).not.toHaveBeenCalled();
+      expect(resume.mostRecentCall.args[1]).toEqual(3);
+    });
+
     it('uses size as an alias for count', function () {
       spyOn(instance, 'count');
       instance.size();
@@ -38,4 +38,11 @@ describe('The mutateSource module', function () {
     var expected = 'a.foo = __get(a, "foo"); __get(foo, "bar").baz = "hello"';
     expect(mutated).toEqual(expected);
   });
+
+  it('counts top level statements', function () {
+    expect(mongo.mutateSource.countStatements('db.foo.find()')).toEqual(1);
+    var source = 'for (var i = 0; i < 3; i++) { db.foo.insert({i: i}); }\n' +
+                 'db.foo.count()';
+    expect(mongo.mutateSource.countStatements(source)).toEqual(2);
+  });
 });
@@ -137,6 +137,251 @@ describe('The request module', function () {
     });
   });
 
+  describe('streaming a response', function () {
+    var shell_, onItem;
+
+    beforeEach(function () {
+      shell_ = new mongo.Shell($('<div></div>'), 0);
+      onItem = jasmine.createSpy();
+    });
+
+    it('asks for newline delimited JSON', function () {
+      mongo.request.streamRequest('url/', {a: 1}, 'test', shell_, onItem);
+      expect(requests[0].method).toEqual('GET');
+      expect(requests[0].url).toEqual('url/?data=' +
+                                      encodeURIComponent('{"a":1}'));
+      expect(requests[0].requestHeaders.Accept).toEqual('application/x-ndjson');
+    });
+
+    it('passes on each document and resumes evaluation', function () {
+      var resume = spyOn(shell_.evaluator, 'resume');
+      var onDone = jasmine.createSpy();
+      mongo.request.streamRequest('url/', {}, 'test', shell_, onItem, onDone);
+      requests[0].respond(200, {'Content-Type': 'application/x-ndjson'},
+                          '{"a": 1}\n{"b": 2}\n');
+      expect(onItem.calls.length).toEqual(2);
+      expect(onItem.calls[1].args[0]).toEqual({b: 2});
+      expect(onDone).toHaveBeenCalled();
+      expect(resume.mostRecentCall.args.length).toEqual(1);
+    });
+
+    it('resumes evaluation with a streamed error', function () {
+      var resume = spyOn(shell_.evaluator, 'resume');
+      mongo.request.streamRequest('url/', {}, 'test', shell_, onItem);
+      requests[0].respond(200, {'Content-Type': 'application/x-ndjson'},
+                          '{"a": 1}\n{"error": 400, "reason": "Cursor not found", "detail": ""}\n');
+      expect(onItem.calls.length).toEqual(1);
+      expect(resume.mostRecentCall.args[1]).toEqual(new Error('Cursor not found'));
+      expect(resume.mostRecentCall.args[2]).toBe(true);
+    });
+  });
+
+  describe('batching operations', function () {
+    var shell_;
+
+    beforeEach(function () {
+      mongo.config = {baseUrl: 'base/', batchMaxOperations: 3};
+      shell_ = new mongo.Shell($('<div></div>'), 0);
+      shell_.mwsResourceID = 'res_id';
+    });
+
+    it('queues operations until they are flushed', function () {
+      mongo.request.queueOperation(shell_, 'coll', 'insert', {document: {a: 1}});
+      mongo.request.queueOperation(shell_, 'coll', 'remove', {constraint: {}});
+      expect(requests.length).toEqual(0);
+
+      mongo.request.flushOperations(shell_, function () {}, function () {});
+      expect(requests.length).toEqual(1);
+      expect(requests[0].url).toEqual('base/res_id/batch');
+      expect(requests[0].async).toBe(true);
+      expect(JSON.parse(requests[0].requestBody)).toEqual({
+        operations: [
+          {op: 'insert', collection: 'coll', params: {document: {a: 1}}},
+          {op: 'remove', collection: 'coll', params: {constraint: {}}}
+        ],
+        ordered: true
+      });
+      expect(shell_.pendingOperations).toEqual([]);
+    });
+
+    it('sets the result of each queued write', function () {
+      var onDone = jasmine.createSpy('onDone');
+      var write = mongo.request.queueOperation(shell_, 'coll', 'insert',
+                                               {document: {}});
+      expect(mongo.util.toString(write)).toEqual('');
+      mongo.request.flushOperations(shell_, onDone, function () {});
+      var results = [{result: {pretty: 'WriteResult({ "nInserted" : 1 })'}}];
+      requests[0].respond(200, '', JSON.stringify({results: results}));
+      expect(onDone).toHaveBeenCalledWith(results);
+      expect(mongo.util.toString(write)).toEqual(
+        'WriteResult({ "nInserted" : 1 })');
+    });
+
+    it('calls onDone straight away with nothing queued', function () {
+      var onDone = jasmine.createSpy('onDone');
+      mongo.request.flushOperations(shell_, onDone, function () {});
+      expect(requests.length).toEqual(0);
+      expect(onDone).toHaveBeenCalledWith([]);
+    });
+
+    it('pauses once batchMaxOperations are queued', function () {
+      var context = {};
+      spyOn(shell_.evaluator, 'pause').andReturn(context);
+      var resume = spyOn(shell_.evaluator, 'resume');
+      for (var i = 0; i < 3; i++) {
+        expect(requests.length).toEqual(0);
+        mongo.request.queueOperation(shell_, 'coll', 'insert', {document: {}});
+      }
+      expect(requests.length).toEqual(1);
+      expect(requests[0].async).toBe(true);
+      expect(resume).not.toHaveBeenCalled();
+
+      var result = {result: {pretty: 'WriteResult({ "nInserted" : 1 })'}};
+      requests[0].respond(200, '', JSON.stringify({
+        results: [result, result, result]
+      }));
+      expect(resume).toHaveBeenCalledWith(context, result.result.pretty);
+    });
+
+    it('flushes before making another request', function () {
+      mongo.request.queueOperation(shell_, 'coll', 'insert', {document: {}});
+      spyOn(shell_.evaluator, 'pause');
+      mongo.request.makeRequest('url/', {}, 'GET', 'test', shell_);
+      expect(requests.length).toEqual(1);
+      expect(requests[0].url).toEqual('base/res_id/batch');
+      requests[0].respond(200, '', JSON.stringify({results: [{result: {}}]}));
+      expect(requests[1].url).toMatch('^url/');
+    });
+
+    it('flushes synchronously before a synchronous request', function () {
+      mongo.request.queueOperation(shell_, 'coll', 'insert', {document: {}});
+      spyOn(shell_.evaluator, 'pause');
+      mongo.request.makeRequest('url/', {}, 'GET', 'test', shell_, null,
+                                false);
+      expect(requests[0].url).toEqual('base/res_id/batch');
+      expect(requests[0].async).toBe(false);
+      requests[0].respond(200, '', JSON.stringify({results: [{result: {}}]}));
+      expect(requests[1].url).toMatch('^url/');
+      expect(requests[1].async).toBe(false);
+    });
+
+    it('does not make the request after a failed batch', function () {
+      mongo.request.queueOperation(shell_, 'coll', 'insert', {document: {}});
+      var context = {};
+      spyOn(shell_.evaluator, 'pause').andReturn(context);
+      var resume = spyOn(shell_.evaluator, 'resume');
+      mongo.request.makeRequest('url/', {}, 'GET', 'test', shell_);
+      requests[0].respond(200, '', JSON.stringify({results: [
+        {error: {error: 403, reason: 'Collection size exceeded', detail: ''}}
+      ]}));
+      expect(requests.length).toEqual(1);
+      expect(resume).toHaveBeenCalledWith(
+        context, new Error('Collection size exceeded'), true);
+    });
+
+    it('passes the first failure to onFail', function () {
+      var onFail = jasmine.createSpy('onFail');
+      mongo.request.queueOperation(shell_, 'coll', 'insert', {document: {}});
+      mongo.request.flushOperations(shell_, function () {}, onFail);
+      requests[0].respond(200, '', JSON.stringify({results: [
+        {error: {error: 403, reason: 'Collection size exceeded', detail: ''}}
+      ]}));
+      expect(onFail).toHaveBeenCalledWith('Collection size exceeded');
+    });
+  });
+
+  describe('sending commands over a WebSocket', function () {
+    var sockets, realWebSocket, shell_, resume;
+
+    beforeEach(function () {
+      realWebSocket = window.WebSocket;
+      sockets = [];
+      window.WebSocket = function (url) {
+        this.url = url;
+        this.readyState = 0;
+        this.sent = [];
+        sockets.push(this);
+      };
+      window.WebSocket.OPEN = 1;
+      window.WebSocket.prototype.send = function (data) {
+        this.sent.push(JSON.parse(data));
+      };
+      mongo.config.baseUrl = 'http://test.com/mws/';
+      mongo.config.webSocket = true;
+      shell_ = new mongo.Shell($('<div></div>'), 0);
+      shell_.mwsResourceID = 'iu';
+      resume = spyOn(shell_.evaluator, 'resume');
+
+      mongo.request.openSocket('iu');
+      sockets[0].readyState = 1;
+      sockets[0].onopen();
+    });
+
+    afterEach(function () {
+      sockets[0].onclose();
+      window.WebSocket = realWebSocket;
+    });
+
+    it('connects to the resource', function () {
+      expect(sockets[0].url).toEqual('ws://test.com/mws/iu/ws');
+    });
+
+    it('sends operations as commands', function () {
+      var onSuccess = jasmine.createSpy();
+      mongo.request.makeRequest(RES_URL + 'foo/count', {query: {}}, 'GET',
+                                'count', shell_, onSuccess);
+      expect(requests.length).toEqual(0);
+      var command = sockets[0].sent[0];
+      expect(command.op).toEqual('count');
+      expect(command.collection).toEqual('foo');
+      expect(command.params).toEqual({query: {}});
+
+      sockets[0].onmessage({data: JSON.stringify({id: command.id,
+                                                  result: {count: 3}})});
+      expect(onSuccess).toHaveBeenCalledWith({count: 3});
+      expect(resume).toHaveBeenCalled();
+    });
+
+    it('reports failed commands', function () {
+      var onSuccess = jasmine.createSpy();
+      mongo.request.makeRequest(RES_URL + 'foo/find', {}, 'GET', 'find',
+                                shell_, onSuccess);
+      var error = {error: 400, reason: 'Cursor not found', detail: ''};
+      sockets[0].onmessage({data: JSON.stringify({id: sockets[0].sent[0].id,
+                                                  error: error})});
+      expect(onSuccess).not.toHaveBeenCalled();
+      expect(resume.mostRecentCall.args[1].message).toEqual('Cursor not found');
+      expect(resume.mostRecentCall.args[2]).toBe(true);
+    });
+
+    it('fails pending commands when it closes', function () {
+      mongo.request.makeRequest(RES_URL + 'foo/find', {}, 'GET', 'find',
+                                shell_);
+      sockets[0].onclose();
+      expect(resume.mostRecentCall.args[1].message).toEqual(
+        'Lost connection with server');
+
+      // Later requests go over HTTP
+      mongo.request.makeRequest(RES_URL + 'foo/find', {}, 'GET', 'find',
+                                shell_);
+      expect(requests.length).toEqual(1);
+    });
+
+    it('uses HTTP for other requests', function () {
+      mongo.request.makeRequest(RES_URL + 'getCollectionNames', undefined,
+                                'GET', 'getCollectionNames', shell_);
+      mongo.request.makeRequest(RES_URL + 'foo/find', {}, 'GET', 'find',
+                                shell_, null, false);
+      expect(requests.length).toEqual(2);
+      expect(sockets[0].sent.length).toEqual(0);
+    });
+
+    it('replaces keep-alive requests', function () {
+      mongo.request.keepAlive('iu');
+      expect(requests.length).toEqual(0);
+    });
+  });
+
   describe('keeps the session alive and', function(){
     var requestSuccess = function(success){
       var shell = {mwsResourceID: 'my_resource'};
@@ -67,7 +67,7 @@ mongo.Coll.prototype.find = function (query, projection) {
       onSuccess);
   }
 
-  cursor = new mongo.Cursor(this, findRequest);
+  cursor = new mongo.Cursor(this, findRequest, query);
   return cursor;
 };
 
@@ -103,7 +103,7 @@ mongo.Coll.prototype.count = function (query) {
   var context = shell.evaluator.pause();
   mongo.request.makeRequest(url, params,'GET', 'dbCollectionCount', shell,
       function(data){
-        shell.evaluator.resume(context, data);
+        shell.evaluator.resume(context, data.count);
       });
 };
 
@@ -113,6 +113,9 @@ mongo.Coll.prototype.insert = function (doc) {
   var shell = this.shell;
   mongo.events.functionTrigger(this.shell, 'db.collection.insert', arguments,
                                {collection: this.name});
+  if (shell.batchWrites) {
+    return mongo.request.queueOperation(shell, this.name, 'insert', params);
+  }
   var context = shell.evaluator.pause();
   tst = mongo.request.makeRequest(url, params, 'POST', 'dbCollectionInsert', shell,
     function(data){
@@ -126,6 +129,9 @@ mongo.Coll.prototype.save = function (doc) {
   var shell = this.shell;
   mongo.events.functionTrigger(this.shell, 'db.collection.save', arguments,
     {collection: this.name});
+  if (shell.batchWrites) {
+    return mongo.request.queueOperation(shell, this.name, 'save', params);
+  }
   var context = shell.evaluator.pause();
   mongo.request.makeRequest(url, params, 'POST', 'dbCollectionSave', shell,
     function(data){
@@ -152,6 +158,9 @@ mongo.Coll.prototype.remove = function (constraint, options) {
   var params = {constraint: constraint, options: options};
   mongo.events.functionTrigger(this.shell, 'db.collection.remove', arguments,
                                {collection: this.name});
+  if (shell.batchWrites) {
+    return mongo.request.queueOperation(shell, this.name, 'remove', params);
+  }
   var context = shell.evaluator.pause();
   mongo.request.makeRequest(url, params, 'DELETE', 'dbCollectionRemove', shell,
     function(data){
@@ -186,6 +195,9 @@ mongo.Coll.prototype.update = function (query, update, upsert, multi) {
   }
 
   var params = {query: query, update: update, upsert: !!upsert, multi: !!multi};
+  if (shell.batchWrites) {
+    return mongo.request.queueOperation(shell, this.name, 'update', params);
+  }
   var context = shell.evaluator.pause();
   mongo.request.makeRequest(url, params, 'PUT', 'dbCollectionUpdate', shell,
     function(data){
@@ -14,15 +14,21 @@
  */
 
 /* global console, mongo, Error */
-mongo.Cursor = function (collection, query) {
+/**
+ * query is the function that executes the cursor. filter is the query
+ * document of a find, which count() uses to count the results without
+ * executing the cursor.
+ */
+mongo.Cursor = function (collection, query, filter) {
   this._coll = collection;
   this._shell = collection.shell;
   this.urlBase = mongo.util.getDBCollectionResURL(this._shell.mwsResourceID, collection.name);
   this._query = query;
+  this._filter = filter;
   this._executed = false;
   this._result = [];
   this._retrieved = 0;
-  this._count = 0;
+  this._hasNext = false;
   this._batchSize = collection.shell.getShellBatchSize();
 };
 
@@ -37,9 +43,10 @@ mongo.Cursor.prototype._executeQuery = function (onSuccess) {
         mongo.events.callbackTrigger(this._shell, 'cursor.execute', data.result.slice());
         this._storeQueryResult(data.result);
         this._cursorId = data.cursor_id || this._cursorId;
-        this._count = data.count || this._count;
         this._retrieved += data.result.length;
-        this._hasNext = this._retrieved < this._count;
+        // The server reports a cursor id of 0 once nothing is left to fetch
+        this._hasNext = !data.empty_cursor && !!this._cursorId &&
+                        String(this._cursorId) !== '0';
     }
     if (onSuccess) {
       onSuccess();
@@ -60,12 +67,12 @@ mongo.Cursor.prototype._executeQuery = function (onSuccess) {
 
 
 mongo.Cursor.prototype._getMore = function (callback) {
-  if ((!this._executed || this._retrieved < this._count) &&
-      (this._result.length === 0)) {
+  if (this._hasNext && this._result.length === 0) {
     var url = this.urlBase + "next";
     var params = {};
     params['cursor_id'] = this._cursorId;
     params['retrieved'] = this._retrieved;
+    params['limit'] = this._limit;
     mongo.request.makeRequest(url, params, 'GET', 'CursorGetMore', this._shell,
       callback);
   } else if (callback) {
@@ -155,19 +162,21 @@ mongo.Cursor.prototype.next = function (callback) {
     return;
   }
   var context = this._shell.evaluator.pause();
+  var expected = this._hasNext;
   this._executeQuery(function () {
     var next, isError;
+    if (this._result.length === 0 && expected) {
+      // A result that ends on a batch boundary leaves the cursor open until
+      // a getMore comes back empty, so hasNext() promised one more element
+      // that does not exist. That is the end, not an error.
+      this._shell.lastUsedCursor = null;
+      this._shell.evaluator.resume(context);
+      return;
+    }
     if (this._result.length === 0) {
       next = new Error('Cursor does not have any more elements.');
       isError = true;
       this._shell.lastUsedCursor = null;
-      /*
-        If count is a multiple of batchsize, send another executeQuery
-        to clean up a lingering cursor
-      */
-      if(this._count % this._batchSize === 0){
-        this._executeQuery();
-      }
     } else {
       next = this._result.pop();
       isError = false;
@@ -216,25 +225,75 @@ mongo.Cursor.prototype.batchSize = function () {
 };
 
 
+/**
+ * Collects every remaining document. Whatever is left on the server after
+ * the first batch is streamed in a single drain request. The array is passed
+ * to callback if one is given, otherwise evaluation resumes with it.
+ */
 mongo.Cursor.prototype.toArray = function (callback) {
-    var result = [];
-    while(this.hasNext()){
-        result.push(this.next());
+  var context = callback ? null : this._shell.evaluator.pause();
+  var done = function (result) {
+    if (callback) {
+      callback(result);
+    } else {
+      this._shell.evaluator.resume(context, result);
     }
-    return result;
+  }.bind(this);
+
+  var drain = function () {
+    var result = this._result.reverse();
+    this._result = [];
+    if (!this._hasNext) {
+      done(result);
+      return;
+    }
+    var params = {
+      cursor_id: this._cursorId,
+      retrieved: this._retrieved,
+      limit: this._limit,
+      drain_cursor: true
+    };
+    mongo.request.streamRequest(this.urlBase + 'next', params, 'CursorDrain',
+      this._shell, function (doc) {
+        result.push(doc);
+        this._retrieved++;
+      }.bind(this), function () {
+        this._hasNext = false;
+        done(result);
+      }.bind(this));
+  }.bind(this);
+
+  if (this._executed) {
+    drain();
+  } else {
+    this._executeQuery(drain);
+  }
 };
 
 
+/**
+ * Counts the results with a separate count request, so that the cursor is
+ * neither executed nor charged for a count it may never need.
+ */
 mongo.Cursor.prototype.count = function (useSkipLimit) {
-  useSkipLimit = !!useSkipLimit;
-  // If the cursor already has a count, use that.
-  if (this._count) { return this._count; }
-
-  // Otherwise, execute the cursor, and get the count.
   var context = this._shell.evaluator.pause();
-  this._executeQuery(function () {
-    this._shell.evaluator.resume(context, this._count, false);
-  }.bind(this));
+  if (this._filter === undefined) {
+    // Aggregation results all arrive with the first batch
+    this._executeQuery(function () {
+      this._shell.evaluator.resume(context, this._retrieved, false);
+    }.bind(this));
+    return;
+  }
+
+  var params = {query: this._filter};
+  if (useSkipLimit) {
+    params.skip = this._skip;
+    params.limit = this._limit;
+  }
+  mongo.request.makeRequest(this.urlBase + 'count', params, 'GET',
+    'CursorCount', this._shell, function (data) {
+      this._shell.evaluator.resume(context, data.count, false);
+    }.bind(this));
 };
 
 
@@ -23,6 +23,8 @@ mongo.Shell = function (rootElement, shellID) {
   this.mwsResourceID = null;
   this.readline = null;
   this.lastUsedCursor = null;
+  this.batchWrites = false;
+  this.pendingOperations = [];
   this.shellBatchSize = mongo.config.shellBatchSize;
   this.db = new mongo.DB(this, 'test');
 
@@ -130,16 +132,28 @@ mongo.Shell.prototype.handleInput = function () {
  * throw any exceptions eval throws.
  */
 mongo.Shell.prototype.eval = function (src) {
+  // Writes in multi-statement input are queued and sent as one batch
+  this.batchWrites = mongo.mutateSource.countStatements(src) > 1;
   this.evaluator.eval(src, function (out, isError) {
-    if (isError) {
-      this.insertError(out);
-    } else {
-      if (out instanceof mongo.Cursor) {
-        out._printBatch();
-      } else if(out != undefined) {
-        this.insertResponseLine(out);
+    this.batchWrites = false;
+    // The output is written once the script's queued writes have been sent,
+    // as it may be the result of one of them
+    mongo.request.flushOperations(this, function () {
+      if (isError) {
+        this.insertError(out);
+      } else {
+        if (out instanceof mongo.Cursor) {
+          out._printBatch();
+        } else if(out != undefined) {
+          this.insertResponseLine(out);
+        }
       }
-    }
+    }.bind(this), function (message) {
+      this.insertError(message);
+      if (isError) {
+        this.insertError(out);
+      }
+    }.bind(this));
   }.bind(this));
 };
 
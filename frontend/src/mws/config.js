@@ -16,6 +16,8 @@
 /* global mongo */
 mongo.config = (function () {
   var mwsHost = window.MWS_HOST || '';
+  // Send shell commands over a WebSocket, see webapps/server/websocket.py
+  var webSocket = !!window.MWS_WEBSOCKET;
   var KEYCODES = {
     enter: 13,
     left: 37,
@@ -25,6 +27,7 @@ mongo.config = (function () {
   };
 
   return {
+    batchMaxOperations: 100,
     keycodes: KEYCODES,
     keepAliveTime: 30000,
     rootElementSelector: '.mongo-web-shell',
@@ -33,6 +36,7 @@ mongo.config = (function () {
     shellHistoryKey: 'mongo.history',
     shellHistorySize: 500,
     mwsHost: mwsHost,
-    baseUrl: mwsHost + '/server/mws/'
+    baseUrl: mwsHost + '/server/mws/',
+    webSocket: webSocket
   };
 }());
@@ -101,6 +101,7 @@ mongo.init = (function(){
 
     // Request a resource ID, give it to all the shells, and keep it alive
     mongo.request.createMWSResource(mongo.shells, function (data) {
+      mongo.request.openSocket(data.res_id);
       setInterval(
         function () { mongo.request.keepAlive(data.res_id); },
         mongo.config.keepAliveTime
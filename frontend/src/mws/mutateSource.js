@@ -57,7 +57,21 @@ mongo.mutateSource = (function () {
     return output.toString();
   }
 
+  /**
+   * Returns the number of top level statements in the given source.
+   */
+  function countStatements(src) {
+    var count = 0;
+    falafel(src, function (node) {
+      if (node.parent && node.parent.type === 'Program') {
+        count++;
+      }
+    });
+    return count;
+  }
+
   return {
+    countStatements: countStatements,
     swapMemberAccesses: swapMemberAccesses
   };
 }());
@@ -14,10 +14,19 @@
  */
 
 /* jshint camelcase: false, unused: false */
-/* global console, mongo, noty */
+/* global console, mongo, noty, WebSocket */
 mongo.request = (function () {
   $.ajaxSetup({ xhrFields: {withCredentials: true}});
 
+  // Operations the server accepts over the WebSocket, see websocket.py
+  var SOCKET_OPERATIONS = ['count', 'find_one', 'find', 'next', 'aggregate',
+                           'insert', 'update', 'save', 'remove', 'drop'];
+  var socket = null;
+  // Set once a WebSocket fails to open, so that it is not retried
+  var socketRefused = false;
+  var pendingCommands = {};
+  var nextCommandId = 0;
+
   /*
    * Creates an MWS resource for a set of shells on the remote server. Calls
    * onSuccess if the data received is valid. Otherwise, prints an error to the
@@ -40,6 +49,89 @@ mongo.request = (function () {
       });
   }
 
+  /*
+   * Opens a WebSocket to the server for the resource, if enabled in the
+   * config. While it is open, asynchronous requests for the operations it
+   * accepts are sent over it rather than as HTTP requests, and no
+   * keep-alive requests are needed. Once it closes, requests go back to
+   * HTTP until keepAlive opens a new one.
+   */
+  function openSocket(res_id) {
+    if (!mongo.config.webSocket || !window.WebSocket || socket ||
+        socketRefused) {
+      return;
+    }
+    var url = mongo.config.baseUrl + res_id + '/ws';
+    if (/^https?:/.test(url)) {
+      url = url.replace(/^http/, 'ws');
+    } else {
+      url = window.location.protocol.replace(/^http/, 'ws') + '//' +
+        window.location.host + url;
+    }
+    var ws = new WebSocket(url);
+    var opened = false;
+    socket = ws;
+    ws.onopen = function () {
+      console.info('WebSocket open:', url);
+      opened = true;
+    };
+    ws.onmessage = function (event) {
+      var reply = $.parseJSON(event.data);
+      var command = pendingCommands[reply.id];
+      delete pendingCommands[reply.id];
+      if (!command) {
+        return;
+      }
+      if (reply.error) {
+        command.fail(reply.error.reason);
+      } else {
+        command.succeed(reply.result);
+      }
+    };
+    ws.onclose = function () {
+      console.info('WebSocket closed:', url);
+      if (socket === ws) {
+        socket = null;
+      }
+      socketRefused = socketRefused || !opened;
+      var pending = pendingCommands;
+      pendingCommands = {};
+      $.each(pending, function (id, command) {
+        command.fail('Lost connection with server');
+      });
+    };
+  }
+
+  function socketIsOpen() {
+    return socket !== null && socket.readyState === WebSocket.OPEN;
+  }
+
+  /*
+   * Returns the {op, collection} command for a request to url if it can be
+   * sent over the WebSocket, otherwise null.
+   */
+  function socketCommand(url, shell, async) {
+    if (!async || !socketIsOpen()) {
+      return null;
+    }
+    var base = mongo.util.getDBResURL(shell.mwsResourceID);
+    if (url.indexOf(base) !== 0) {
+      return null;
+    }
+    var path = url.substring(base.length);
+    var op = path.substring(path.lastIndexOf('/') + 1);
+    if ($.inArray(op, SOCKET_OPERATIONS) === -1) {
+      return null;
+    }
+    return {op: op, collection: path.substring(0, path.lastIndexOf('/'))};
+  }
+
+  function sendCommand(command, succeed, fail) {
+    command.id = ++nextCommandId;
+    pendingCommands[command.id] = {succeed: succeed, fail: fail};
+    socket.send(JSON.stringify(command));
+  }
+
   function makeRequest(url, params, type, name, shell, onSuccess, async) {
     if (async === undefined) {
       // Default async to true
@@ -47,51 +139,272 @@ mongo.request = (function () {
     }
     shell.enableInput(false);
     var context = shell.evaluator.pause();
-    console.debug(name + ' request:', url, params);
-    data = JSON.stringify(params);
-    if(type == "GET"){
-        data = {'data': data}
+
+    function succeed(data) {
+      console.info(name + ' success');
+      shell.enableInput(true);
+      shell.focus();
+      shell.evaluator.resume(context);
+      if (onSuccess) {
+        onSuccess(data);
+      }
+    }
+
+    function fail(message) {
+      // Hack: suspend.js doesn't seem to handle errors for single command
+      // evaluations.
+      if(context == null){
+          shell.insertError(message);
+      }
+      console.error(name + ' fail:', message);
+      shell.enableInput(true);
+      shell.focus();
+      shell.evaluator.resume(context, new Error(message), true);
+    }
+
+    function send() {
+      console.debug(name + ' request:', url, params);
+      var command = socketCommand(url, shell, async);
+      if (command) {
+        command.params = params || {};
+        sendCommand(command, succeed, fail);
+        return;
+      }
+
+      data = JSON.stringify(params);
+      if(type == "GET"){
+          data = {'data': data}
+      }
+      $.ajax({
+        async: !!async,
+        type: type,
+        url: url,
+        data: data,
+        dataType: 'json',
+        contentType: 'application/json',
+        success: function (data, textStatus, jqXHR) {
+          succeed(data);
+        },
+        error: function (jqXHR, textStatus, errorThrown) {
+          try{
+              var response = $.parseJSON(jqXHR.responseText);
+              var message = response.reason;
+          } catch (e) {
+              var message = 'The server experienced an unexpected error.' 
+          }
+          fail(message);
+        }
+      });
+    }
+
+    // Writes queued earlier in the script must reach the server first. A
+    // synchronous request flushes them synchronously, so that it is still
+    // made before this returns.
+    flushOperations(shell, send, fail, async);
+  }
+
+  /*
+   * Makes a GET request whose response is newline delimited JSON, calling
+   * onItem with each document as its line arrives rather than once the whole
+   * response has been read. Evaluation is paused until the response is
+   * complete, then resumed and onDone is called. A line holding an error,
+   * or a failed request, resumes evaluation with that error instead.
+   */
+  function streamRequest(url, params, name, shell, onItem, onDone) {
+    shell.enableInput(false);
+    var context = shell.evaluator.pause();
+
+    var xhr = new XMLHttpRequest();
+    var consumed = 0;
+    var message = null;
+
+    // Parses the complete lines received since the last call
+    function consume(done) {
+      var text = xhr.responseText;
+      var end = done ? text.length : text.lastIndexOf('\n') + 1;
+      if (end <= consumed) {
+        return;
+      }
+      var lines = text.substring(consumed, end).split('\n');
+      consumed = end;
+      $.each(lines, function (i, line) {
+        if (message !== null) {
+          return false;
+        }
+        if (line) {
+          var item = $.parseJSON(line);
+          if (item.error && item.reason !== undefined) {
+            message = item.reason;
+          } else {
+            onItem(item);
+          }
+        }
+      });
+    }
+
+    xhr.open('GET', url + '?data=' + encodeURIComponent(JSON.stringify(params)));
+    xhr.withCredentials = true;
+    xhr.setRequestHeader('Accept', 'application/x-ndjson');
+    xhr.onprogress = function () {
+      if (xhr.status === 200) {
+        consume(false);
+      }
+    };
+    xhr.onreadystatechange = function () {
+      if (xhr.readyState !== 4) {
+        return;
+      }
+      if (xhr.status === 200) {
+        consume(true);
+      } else {
+        try {
+          message = $.parseJSON(xhr.responseText).reason;
+        } catch (e) {
+          message = 'The server experienced an unexpected error.';
+        }
+      }
+      if (message !== null) {
+        fail(message);
+      } else {
+        console.info(name + ' success');
+        shell.enableInput(true);
+        shell.focus();
+        shell.evaluator.resume(context);
+        if (onDone) {
+          onDone();
+        }
+      }
+    };
+
+    function fail(failure) {
+      console.error(name + ' fail:', failure);
+      shell.enableInput(true);
+      shell.focus();
+      if (context == null) {
+        shell.insertError(failure);
+      }
+      shell.evaluator.resume(context, new Error(failure), true);
+    }
+
+    // Writes queued earlier in the script must reach the server first
+    flushOperations(shell, function () {
+      console.debug(name + ' request:', url, params);
+      xhr.send();
+    }, fail);
+  }
+
+  /*
+   * A write queued by queueOperation. Its result is set once the batch
+   * holding it has been sent, and it prints as that result's WriteResult, so
+   * a script ending in a queued write shows the same output as when the
+   * write is sent on its own.
+   */
+  function QueuedWrite(op, collection, params) {
+    this.op = op;
+    this.collection = collection;
+    this.params = params;
+    this.result = null;
+  }
+
+  QueuedWrite.prototype.tojson = function () {
+    return this.result ? this.result.pretty : '';
+  };
+
+  /*
+   * Queues a write for the shell instead of sending it straight away and
+   * returns the QueuedWrite. Queued operations are sent together to the batch
+   * endpoint by flushOperations, which happens before the shell's next
+   * request, when the script finishes and once batchMaxOperations are queued.
+   * In the last case evaluation is paused until the batch is done, then
+   * resumes with the write's result, or with the first failure in the batch.
+   */
+  function queueOperation(shell, collection, op, params) {
+    var write = new QueuedWrite(op, collection, params);
+    shell.pendingOperations = shell.pendingOperations || [];
+    shell.pendingOperations.push(write);
+    if (shell.pendingOperations.length < mongo.config.batchMaxOperations) {
+      return write;
+    }
+    var context = shell.evaluator.pause();
+    flushOperations(shell, function () {
+      shell.evaluator.resume(context, write.result.pretty);
+    }, function (message) {
+      if (context == null) {
+        shell.insertError(message);
+      }
+      shell.evaluator.resume(context, new Error(message), true);
+    });
+  }
+
+  /*
+   * Sends the shell's queued operations in one batch request, setting the
+   * result of each QueuedWrite that was run. Operations run in order and
+   * stop at the first failure. Input is disabled until the batch is done,
+   * then onDone is called with the per-operation results, or onFail with the
+   * first failure. With nothing queued, onDone is called straight away. The
+   * batch request is synchronous if async is false.
+   */
+  function flushOperations(shell, onDone, onFail, async) {
+    var operations = shell.pendingOperations;
+    if (!operations || operations.length === 0) {
+      onDone([]);
+      return;
     }
+    shell.pendingOperations = [];
+    var url = mongo.config.baseUrl + shell.mwsResourceID + '/batch';
+    var body = $.map(operations, function (write) {
+      return {op: write.op, collection: write.collection, params: write.params};
+    });
+    console.debug('batch request:', url, body);
+    shell.enableInput(false);
     $.ajax({
-      async: !!async,
-      type: type,
+      async: async !== false,
+      type: 'POST',
       url: url,
-      data: data,
+      data: JSON.stringify({operations: body, ordered: true}),
       dataType: 'json',
       contentType: 'application/json',
       success: function (data, textStatus, jqXHR) {
-        console.info(name + ' success');
+        var message = null;
+        $.each(data.results, function (i, result) {
+          if (result.error) {
+            message = result.error.reason;
+            return false;
+          }
+          operations[i].result = result.result;
+        });
         shell.enableInput(true);
-        shell.focus();
-        shell.evaluator.resume(context);
-        if (onSuccess) {
-          onSuccess(data);
+        if (message !== null) {
+          console.error('batch fail:', message);
+          onFail(message);
+        } else {
+          console.info('batch success');
+          onDone(data.results);
         }
       },
       error: function (jqXHR, textStatus, errorThrown) {
-        try{
-            var response = $.parseJSON(jqXHR.responseText);
-            var message = response.reason;
+        var message;
+        try {
+          message = $.parseJSON(jqXHR.responseText).reason;
         } catch (e) {
-            var message = 'The server experienced an unexpected error.' 
+          message = 'The server experienced an unexpected error.';
         }
-        // Hack: suspend.js doesn't seem to handle errors for single command
-        // evaluations.
-        if(context == null){
-            shell.insertError(message);
-        }
-        console.error(name + ' fail:', textStatus, errorThrown);
+        console.error('batch fail:', textStatus, errorThrown);
         shell.enableInput(true);
-        shell.focus();
-        shell.evaluator.resume(context, new Error(message), true);
+        onFail(message);
       }
     });
   }
 
   function keepAlive(res_id) {
+    if (socketIsOpen()) {
+      // The server keeps the resource alive while the WebSocket is open
+      return;
+    }
     var url = mongo.config.baseUrl + res_id + '/keep-alive';
     $.post(url, null,function (data, textStatus, jqXHR) {
       console.info('Keep-alive succesful');
+      openSocket(res_id);
       if (mongo.keepaliveNotification) {
         mongo.keepaliveNotification.setText('and we\'re back!');
         setTimeout(function () {
@@ -118,7 +431,12 @@ mongo.request = (function () {
 
   return {
     createMWSResource: createMWSResource,
+    flushOperations: flushOperations,
     keepAlive: keepAlive,
-    makeRequest: makeRequest
+    makeRequest: makeRequest,
+    openSocket: openSocket,
+    QueuedWrite: QueuedWrite,
+    queueOperation: queueOperation,
+    streamRequest: streamRequest
   };
 }());
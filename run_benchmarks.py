@@ -0,0 +1,133 @@
+#    Copyright 2013 10gen Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Runs the benchmarks in benchmarks/ and compares them with a baseline.
+
+    python run_benchmarks.py                      # in-memory storage engine
+    python run_benchmarks.py --engine mongo       # against the configured mongod
+    python run_benchmarks.py --save-baseline      # record the baseline
+    python run_benchmarks.py --filter find        # cases whose key has 'find'
+
+Results are printed and, with --output, written as JSON. If a baseline file
+exists, any case whose median is more than --threshold slower than in the
+baseline is reported and the exit status is 1.
+"""
+
+import argparse
+import os
+import sys
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'benchmarks', 'baseline.json')
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--engine', default='memory',
+                        choices=['memory', 'mongo'],
+                        help='storage engine to run against')
+    parser.add_argument('--suite', default='all',
+                        choices=['all', 'endpoints', 'components'])
+    parser.add_argument('--filter', help='only run cases whose key contains '
+                        'this string')
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--warmup', type=int, default=20)
+    parser.add_argument('--sizes', default='small,medium,large',
+                        help='document sizes, from small, medium and large')
+    parser.add_argument('--batch-sizes', default='20,100',
+                        help='CURSOR_BATCH_SIZE values for find and next')
+    parser.add_argument('--bulk-sizes', default='10,100',
+                        help='documents per bulk insert')
+    parser.add_argument('--output', help='write the results to this file')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='write the results to the baseline file')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='fraction by which a case may be slower than '
+                        'the baseline before it is reported')
+    return parser.parse_args(argv)
+
+
+def _ints(value):
+    return [int(v) for v in value.split(',') if v]
+
+
+def main(argv):
+    args = parse_args(argv)
+    # Read by the app config, so this has to be set before it is imported
+    os.environ['DB_ENGINE'] = args.engine
+    os.environ.setdefault('MWS_SERVER_TESTING', '1')
+
+    from benchmarks import components, endpoints, harness
+    from webapps.server.app import app
+
+    app.testing = True
+    # Measure the work done per request, not the limits that stop it
+    app.config.update({
+        'RATELIMIT_QUOTA': sys.maxint,
+        'RATELIMIT_LIMITS': {},
+        'QUOTA_COLLECTION_SIZE': sys.maxint,
+        'QUOTA_NUM_COLLECTIONS': None,
+    })
+    ctx = app.app_context()
+    ctx.push()
+
+    sizes = dict((name, harness.SIZES[name])
+                 for name in args.sizes.split(',') if name)
+    suite_args = (app, sizes, _ints(args.batch_sizes), _ints(args.bulk_sizes))
+    suites = []
+    if args.suite in ('all', 'endpoints'):
+        suites.append(endpoints.cases(*suite_args))
+    if args.suite in ('all', 'components'):
+        suites.append(components.cases(*suite_args))
+
+    def report(result):
+        print harness.format_result(result)
+        sys.stdout.flush()
+
+    results = []
+    for cases in suites:
+        results.extend(harness.run(cases, args.iterations, args.warmup,
+                                   args.filter, report))
+
+    meta = harness.metadata(engine=args.engine, iterations=args.iterations)
+    if args.output:
+        harness.save(args.output, results, meta)
+    if args.save_baseline:
+        harness.save(args.baseline, results, meta)
+        print 'Saved baseline to %s' % args.baseline
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print 'No baseline at %s; run with --save-baseline to record one.' % (
+            args.baseline)
+        return 0
+    baseline = harness.load(args.baseline)
+    if baseline['meta'].get('engine') != args.engine:
+        print 'Warning: the baseline was recorded with the %s engine.' % (
+            baseline['meta'].get('engine'))
+    regressions = harness.compare(results, baseline, args.threshold)
+    for key, before, after, ratio in regressions:
+        print 'REGRESSION %s: %.1fus -> %.1fus (%.0f%% slower)' % (
+            key, before * 1e6, after * 1e6, (ratio - 1) * 100)
+    if regressions:
+        return 1
+    print 'No regressions beyond %d%% against %s' % (args.threshold * 100,
+                                                      args.baseline)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,51 @@
+#    Copyright 2013 10gen Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+from bson import BSON
+
+from benchmarks import harness
+from tests import MongoWSTestCase
+
+
+class HarnessTestCase(MongoWSTestCase):
+    def test_case_keys_sort_params(self):
+        self.assertEqual(harness.case_key('find', {'size': 'small',
+                                                   'batch': 20}),
+                         'find[batch=20,size=small]')
+        self.assertEqual(harness.case_key('create', {}), 'create')
+
+    def test_documents_have_requested_size(self):
+        for size in harness.SIZES.itervalues():
+            actual = len(BSON.encode(harness.make_document(size)))
+            self.assertLess(abs(actual - size), 64)
+
+    def test_measure_times_only_func(self):
+        calls = []
+        stats = harness.measure(lambda arg: calls.append(arg),
+                                setup=lambda: 'state',
+                                teardown=lambda arg: calls.append('done'),
+                                iterations=5, warmup=2)
+        self.assertEqual(stats['iterations'], 5)
+        self.assertEqual(calls, ['state', 'done'] * 7)
+        self.assertLessEqual(stats['min'], stats['median'])
+        self.assertLessEqual(stats['median'], stats['p90'])
+
+    def test_compare_reports_regressions(self):
+        baseline = {'results': [{'key': 'a', 'median': 1.0},
+                                {'key': 'b', 'median': 1.0}]}
+        results = [{'key': 'a', 'median': 1.1},
+                   {'key': 'b', 'median': 1.5},
+                   {'key': 'new', 'median': 9.0}]
+        self.assertEqual(harness.compare(results, baseline, 0.25),
+                         [('b', 1.0, 1.5, 1.5)])
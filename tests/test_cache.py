@@ -0,0 +1,162 @@
+#    Copyright 2013 10gen Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import threading
+import time
+
+import mock
+
+from webapps.lib.cache import LRUCache, SizedLRUCache
+from webapps.lib.decorators import (
+    access_cache,
+    invalidate_access,
+    user_has_access
+)
+from tests import MongoWSTestCase
+
+
+class LRUCacheTestCase(MongoWSTestCase):
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(2, 60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+
+    @mock.patch('webapps.lib.cache.time')
+    def test_entries_expire(self, time_mock):
+        cache = LRUCache(2, 60)
+        time_mock.time.return_value = 1000
+        cache.set('a', 1)
+        time_mock.time.return_value = 1059
+        self.assertEqual(cache.get('a'), 1)
+        time_mock.time.return_value = 1061
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(len(cache), 0)
+
+    def test_counts_hits_and_misses(self):
+        cache = LRUCache(2, 60)
+        cache.get('a')
+        cache.set('a', False)
+        self.assertEqual(cache.get('a', True), False)
+        self.assertEqual(cache.stats(),
+                         {'size': 1, 'hits': 1, 'misses': 1})
+
+
+class SizedLRUCacheTestCase(MongoWSTestCase):
+    def test_evicts_by_size(self):
+        cache = SizedLRUCache(10)
+        self.assertTrue(cache.set('a', 'a', 4))
+        self.assertTrue(cache.set('b', 'b', 4))
+        cache.get('a')
+        self.assertTrue(cache.set('c', 'c', 4))
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 'a')
+        self.assertFalse(cache.set('d', 'd', 11))
+        self.assertEqual(cache.stats()['bytes'], 8)
+
+    def test_loads_once(self):
+        cache = SizedLRUCache(10)
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def loader():
+            calls.append(1)
+            started.set()
+            release.wait()
+            return 'value', 20  # too large to keep
+
+        waiting = []
+
+        class Event(threading._Event):
+            def wait(self, timeout=None):
+                waiting.append(self)
+                return super(Event, self).wait(timeout)
+
+        results = []
+        threads = [threading.Thread(
+            target=lambda: results.append(cache.load('k', loader)))
+            for _ in xrange(3)]
+        with mock.patch('webapps.lib.cache.threading.Event', Event):
+            threads[0].start()
+            started.wait()
+            for thread in threads[1:]:
+                thread.start()
+            # Let the load finish once the others are waiting for it
+            while len(waiting) < 2:
+                time.sleep(0.001)
+            release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, ['value'] * 3)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(cache), 0)
+
+    def test_load_errors_are_not_cached(self):
+        cache = SizedLRUCache(10)
+
+        def failing():
+            raise ValueError('bad dataset')
+        with self.assertRaises(ValueError):
+            cache.load('k', failing)
+        self.assertEqual(cache.load('k', lambda: ('ok', 2)), 'ok')
+        self.assertEqual(cache.load('k', failing), 'ok')
+        self.assertEqual(cache.stats(),
+                         {'size': 1, 'bytes': 2, 'hits': 1, 'misses': 2})
+
+
+@mock.patch('webapps.lib.decorators.get_db')
+class UserHasAccessTestCase(MongoWSTestCase):
+    def setUp(self):
+        super(UserHasAccessTestCase, self).setUp()
+        access_cache.clear()
+
+    def tearDown(self):
+        super(UserHasAccessTestCase, self).tearDown()
+        access_cache.clear()
+
+    def test_caches_answers(self, get_db_mock):
+        find_one = get_db_mock.return_value.__getitem__.return_value.find_one
+        find_one.return_value = {'_id': 1}
+        self.assertTrue(user_has_access('res', 'sess'))
+        self.assertTrue(user_has_access('res', 'sess'))
+        self.assertEqual(find_one.call_count, 1)
+
+        find_one.return_value = None
+        self.assertFalse(user_has_access('res', 'other'))
+        self.assertFalse(user_has_access('res', 'other'))
+        self.assertEqual(find_one.call_count, 2)
+
+    def test_writes_check_the_database(self, get_db_mock):
+        find_one = get_db_mock.return_value.__getitem__.return_value.find_one
+        find_one.return_value = {'_id': 1}
+        self.assertTrue(user_has_access('res', 'sess'))
+        # Expired by another process
+        find_one.return_value = None
+        self.assertTrue(user_has_access('res', 'sess'))
+        self.assertFalse(user_has_access('res', 'sess', cached=False))
+        self.assertFalse(user_has_access('res', 'sess'))
+
+    def test_invalidate_access(self, get_db_mock):
+        find_one = get_db_mock.return_value.__getitem__.return_value.find_one
+        find_one.return_value = None
+        self.assertFalse(user_has_access('res', 'sess'))
+
+        find_one.return_value = {'_id': 1}
+        invalidate_access('res', 'sess')
+        self.assertTrue(user_has_access('res', 'sess'))
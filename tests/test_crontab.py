@@ -14,8 +14,10 @@
 
 from datetime import datetime, timedelta
 import mock
+from bson.json_util import loads
 from webapps.server import crontab
 from webapps.server.crontab import run_scheduler, EXPIRE_SESSION_EVERY
+from webapps.lib import LEASES_COLLECTION, leases
 from webapps.lib.db import get_db
 from webapps.lib.util import to_coll_name
 from tests import MongoWSTestCase
@@ -32,6 +34,7 @@ class ExpireSessionsTestCase(MongoWSTestCase):
         # We can assume we don't have any real data before this date
         self.test_before_date = datetime(2012, 7, 6)
         self.db.clients.remove({'timestamp': {'$lt': self.test_before_date}})
+        self.db[LEASES_COLLECTION].remove()
 
     def tearDown(self):
         super(ExpireSessionsTestCase, self).tearDown()
@@ -105,7 +108,8 @@ class ExpireSessionsTestCase(MongoWSTestCase):
         scheduler_mock = mock.MagicMock()
         scheduler_cls_mock.return_value = scheduler_mock
 
-        run_scheduler(mock.sentinel.app)
+        app = mock.MagicMock(config=self.real_app.config)
+        run_scheduler(app)
 
         self.assertTrue(scheduler_mock.add_interval_job.called)
         args = scheduler_mock.add_interval_job.call_args
@@ -115,5 +119,125 @@ class ExpireSessionsTestCase(MongoWSTestCase):
         secs = args[1]['seconds']
 
         func()
-        expire_sessions_mock.assert_called_with(mock.sentinel.app)
+        expire_sessions_mock.assert_called_with(app)
         self.assertEqual(secs, EXPIRE_SESSION_EVERY)
+
+    @mock.patch('webapps.server.crontab.EXPIRE_SESSION_BATCH_SIZE', 2)
+    def test_expires_in_batches(self):
+        for res_id in xrange(5):
+            self.db[to_coll_name(res_id, 'c')].insert({'foo': 'bar'})
+            self.db.clients.insert({
+                'session_id': res_id,
+                'res_id': res_id,
+                'collections': ['c'],
+                'timestamp': datetime(2012, 7, 1),
+            })
+
+        stats = crontab.expire_sessions(self.real_app)
+        self.assertEqual(stats['sessions_expired'], 5)
+        self.assertEqual(stats['collections_dropped'], 5)
+        self.assertEqual(crontab.expiry_metrics['last_sessions_expired'], 5)
+        self.assertEqual(self.db.clients.find({
+            'timestamp': {'$lt': self.test_before_date}
+        }).count(), 0)
+
+    @mock.patch('webapps.server.crontab.EXPIRE_SESSION_BATCH_SIZE', 2)
+    @mock.patch('webapps.server.crontab.time')
+    def test_stops_at_time_budget(self, time_mock):
+        # The clock passes the budget after the first batch
+        time_mock.time.side_effect = [0, 0, crontab.EXPIRE_SESSION_TIME_BUDGET,
+                                      crontab.EXPIRE_SESSION_TIME_BUDGET]
+        for res_id in xrange(5):
+            self.db.clients.insert({
+                'session_id': res_id,
+                'res_id': res_id,
+                'collections': [],
+                'timestamp': datetime(2012, 7, 1),
+            })
+
+        stats = crontab.expire_sessions(self.real_app)
+        self.assertEqual(stats['sessions_expired'], 2)
+        self.assertEqual(self.db.clients.find({
+            'timestamp': {'$lt': self.test_before_date}
+        }).count(), 3)
+
+    @mock.patch('webapps.server.crontab.expire_sessions')
+    def test_only_the_lease_holder_expires_sessions(self,
+                                                    expire_sessions_mock):
+        crontab.run_expiry(self.real_app)
+        expire_sessions_mock.assert_called_once_with(self.real_app)
+        lease = leases.get(self.db, crontab.EXPIRE_LEASE)
+        self.assertEqual(lease['owner'], leases.owner_id())
+        self.assertEqual(lease['partitions'], 1)
+        self.assertIn('duration', lease['last_run'])
+
+        self.db[LEASES_COLLECTION].update(
+            {'_id': crontab.EXPIRE_LEASE}, {'$set': {'owner': 'elsewhere:1'}})
+        crontab.run_expiry(self.real_app)
+        self.assertEqual(expire_sessions_mock.call_count, 1)
+
+    @mock.patch('webapps.server.crontab.EXPIRE_SESSION_PARTITION_BACKLOG', 1)
+    @mock.patch('webapps.server.crontab.expire_sessions')
+    def test_partitions_a_large_backlog(self, expire_sessions_mock):
+        for i in xrange(2):
+            self.db.clients.insert({'res_id': i, 'collections': [],
+                                    'timestamp': datetime(2012, 7, 1)})
+        partitions = crontab.EXPIRE_SESSION_PARTITIONS
+        # Alone, the lease holder sweeps every partition itself
+        crontab.run_expiry(self.real_app)
+        self.assertEqual(expire_sessions_mock.call_args_list,
+                         [mock.call(self.real_app, (i, partitions))
+                          for i in xrange(partitions)])
+
+        # Except those another process holds
+        expire_sessions_mock.reset_mock()
+        self.db[LEASES_COLLECTION].update(
+            {'_id': '%s.1' % crontab.EXPIRE_LEASE},
+            {'$set': {'owner': 'elsewhere:2',
+                      'expires': datetime.utcnow() + timedelta(seconds=60)}})
+        crontab.run_expiry(self.real_app)
+        swept = [c[0][1][0] for c in expire_sessions_mock.call_args_list]
+        self.assertEqual(swept, [i for i in xrange(partitions) if i != 1])
+
+        # Another process takes one of the other partitions
+        self.db[LEASES_COLLECTION].update(
+            {'_id': crontab.EXPIRE_LEASE}, {'$set': {'owner': 'elsewhere:1'}})
+        crontab.run_expiry(self.real_app)
+        partition = expire_sessions_mock.call_args[0][1]
+        self.assertNotEqual(partition[0], 0)
+        self.assertEqual(partition[1], partitions)
+
+    def test_res_id_ranges_cover_every_res_id(self):
+        self.assertEqual(crontab.res_id_range(0, 1), {})
+        self.assertEqual(crontab.res_id_range(0, 4),
+                         {'res_id': {'$lt': '40'}})
+        self.assertEqual(crontab.res_id_range(1, 4),
+                         {'res_id': {'$gte': '40', '$lt': '80'}})
+        self.assertEqual(crontab.res_id_range(3, 4),
+                         {'res_id': {'$gte': 'c0'}})
+
+    def test_expires_one_partition(self):
+        for res_id in ('0abc', 'fabc'):
+            self.db.clients.insert({'res_id': res_id, 'collections': [],
+                                    'timestamp': datetime(2012, 7, 1)})
+        result = crontab.expire_sessions(self.real_app, (0, 2))
+        self.assertEqual(result['sessions_expired'], 1)
+        remaining = [doc['res_id'] for doc in self.db.clients.find(
+            {'timestamp': {'$lt': self.test_before_date}})]
+        self.assertEqual(remaining, ['fabc'])
+
+    def test_status_view(self):
+        leases.acquire(self.db, crontab.EXPIRE_LEASE, 60)
+        path = self.real_app.config['SCHEDULER_STATUS_PATH']
+        self.assertEqual(self.app.get(path).status_code, 403)
+        self.real_app.config['SCHEDULER_STATUS_TOKEN'] = 'operator'
+        try:
+            rv = self.app.get(path,
+                              headers={'Authorization': 'Bearer operator'})
+        finally:
+            self.real_app.config['SCHEDULER_STATUS_TOKEN'] = None
+        status = loads(rv.data)
+        self.assertEqual(status['owner'], leases.owner_id())
+        self.assertEqual([l['name'] for l in status['leases']],
+                         [crontab.EXPIRE_LEASE])
+        self.assertTrue(status['leases'][0]['is_self'])
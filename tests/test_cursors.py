@@ -0,0 +1,75 @@
+#    Copyright 2013 10gen Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+from datetime import datetime, timedelta
+import mock
+
+from webapps.lib import CURSORS_COLLECTION
+from webapps.lib.cursors import (
+    register_cursor,
+    reap_idle_cursors,
+    touch_cursor
+)
+from webapps.lib.db import get_db
+from tests import MongoWSTestCase
+
+
+class CursorRegistryTestCase(MongoWSTestCase):
+    def setUp(self):
+        super(CursorRegistryTestCase, self).setUp()
+        self.db = get_db()
+        self.registry = self.db[CURSORS_COLLECTION]
+        self.registry.remove({'res_id': {'$in': ['a', 'b']}})
+        self.old_limit = self.real_app.config['CURSOR_LIMIT_PER_RES_ID']
+
+    def tearDown(self):
+        super(CursorRegistryTestCase, self).tearDown()
+        self.registry.remove({'res_id': {'$in': ['a', 'b']}})
+        self.real_app.config['CURSOR_LIMIT_PER_RES_ID'] = self.old_limit
+
+    @mock.patch('webapps.lib.cursors.kill_cursors')
+    def test_touch_checks_ownership(self, kill_mock):
+        register_cursor('a', 'coll', 1001)
+        self.assertTrue(touch_cursor('a', 1001))
+        self.assertFalse(touch_cursor('b', 1001))
+        self.assertFalse(touch_cursor('a', 1002))
+
+    @mock.patch('webapps.lib.cursors.kill_cursors')
+    def test_evicts_oldest_over_limit(self, kill_mock):
+        self.real_app.config['CURSOR_LIMIT_PER_RES_ID'] = 2
+        register_cursor('a', 'coll', 1001)
+        register_cursor('a', 'coll', 1002)
+        register_cursor('b', 'coll', 1003)
+        self.assertFalse(kill_mock.called)
+
+        register_cursor('a', 'coll', 1004)
+        kill_mock.assert_called_once_with(mock.ANY, [1001])
+
+    def test_reaps_idle_cursors_in_batches(self):
+        now = datetime.now()
+        for i in xrange(5):
+            self.registry.insert({'_id': 2000 + i, 'res_id': 'a',
+                                  'collection': 'coll',
+                                  'last_touched': now - timedelta(hours=1)})
+        self.registry.insert({'_id': 2005, 'res_id': 'b',
+                              'collection': 'coll', 'last_touched': now})
+
+        with mock.patch.object(self.db.connection, 'kill_cursors') as kill:
+            reaped = reap_idle_cursors(self.db, 60, 2)
+
+        self.assertEqual(reaped, 5)
+        self.assertEqual(kill.call_count, 3)
+        remaining = [c['_id'] for c in self.registry.find(
+            {'res_id': {'$in': ['a', 'b']}})]
+        self.assertEqual(remaining, [2005])
@@ -0,0 +1,103 @@
+#    Copyright 2013 10gen Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import os
+import shutil
+import tempfile
+
+from bson.json_util import dumps
+import mock
+
+from webapps.ivs.initializers import datasets
+from webapps.ivs.initializers.util import (load_data_from_json,
+    load_data_from_mongoexport)
+from webapps.lib import CLIENTS_COLLECTION
+from webapps.lib.db import get_db
+from webapps.lib.util import UseResId
+from tests import MongoWSTestCase
+
+DOCUMENTS = [{'_id': i, 'name': 'doc %d' % i} for i in xrange(5)]
+
+
+class DatasetCacheTestCase(MongoWSTestCase):
+    def setUp(self):
+        super(DatasetCacheTestCase, self).setUp()
+        self.data_dir = tempfile.mkdtemp()
+        self.old_data_dir = self.real_app.config.get('DATA_DIR')
+        self.real_app.config['DATA_DIR'] = self.data_dir
+        self.res_id = 'datasetcache'
+        get_db()[CLIENTS_COLLECTION].insert({'res_id': self.res_id,
+                                             'collections': []})
+        datasets.cache.clear()
+
+    def tearDown(self):
+        super(DatasetCacheTestCase, self).tearDown()
+        self.real_app.config['DATA_DIR'] = self.old_data_dir
+        self.real_app.config.pop('DATASET_CACHE_MAX_FILE', None)
+        shutil.rmtree(self.data_dir)
+        with UseResId(self.res_id) as db:
+            db.drop_database()
+        get_db()[CLIENTS_COLLECTION].remove({'res_id': self.res_id})
+        datasets.cache.clear()
+
+    def write(self, name, documents, mtime=None):
+        path = os.path.join(self.data_dir, name)
+        with open(path, 'w') as f:
+            f.write('\n'.join(dumps(doc) for doc in documents))
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+
+    def load(self):
+        load_data_from_mongoexport(self.res_id, 'people.json', 'people')
+        with UseResId(self.res_id) as db:
+            documents = list(db.people.find().sort('_id', 1))
+            db.drop_collection('people')
+        return documents
+
+    @mock.patch('webapps.ivs.initializers.datasets.stream.read_mongoexport',
+                wraps=datasets.stream.read_mongoexport)
+    def test_parses_each_version_once(self, read_mock):
+        self.write('people.json', DOCUMENTS, mtime=1000)
+        self.assertEqual(self.load(), DOCUMENTS)
+        self.assertEqual(self.load(), DOCUMENTS)
+        self.assertEqual(read_mock.call_count, 1)
+
+        self.write('people.json', DOCUMENTS[:2], mtime=2000)
+        self.assertEqual(self.load(), DOCUMENTS[:2])
+        self.assertEqual(read_mock.call_count, 2)
+
+    @mock.patch('webapps.ivs.initializers.datasets.encode')
+    def test_streams_large_files(self, encode_mock):
+        self.real_app.config['DATASET_CACHE_MAX_FILE'] = 10
+        self.write('people.json', DOCUMENTS)
+        self.assertEqual(self.load(), DOCUMENTS)
+        self.assertFalse(encode_mock.called)
+        self.assertEqual(len(datasets.cache), 0)
+
+    def test_cached_collections(self):
+        path = os.path.join(self.data_dir, 'all.json')
+        with open(path, 'w') as f:
+            f.write(dumps({'people': DOCUMENTS, 'empty': []}))
+        for _ in xrange(2):
+            load_data_from_json(self.res_id, 'all.json', remove_id=True)
+        with UseResId(self.res_id) as db:
+            self.assertEqual(db.people.count(), 10)
+            self.assertEqual(db.people.find({'_id': 0}).count(), 0)
+        self.assertEqual(len(datasets.cache), 1)
+
+    def test_encode_batches(self):
+        batches, size = datasets.encode(DOCUMENTS)
+        self.assertEqual([len(batch) for batch in batches], [5])
+        self.assertEqual(size, sum(len(b) for batch in batches
+                                   for b in batch))
@@ -0,0 +1,92 @@
+#    Copyright 2013 10gen Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import mock
+from pymongo.errors import ConnectionFailure
+
+from webapps.lib import memory
+from webapps.lib.db import ConnectionManager, KeepAliveCursorManager
+from tests import MongoWSTestCase
+
+
+@mock.patch('webapps.lib.db.pymongo.MongoClient')
+class ConnectionManagerTestCase(MongoWSTestCase):
+    def setUp(self):
+        super(ConnectionManagerTestCase, self).setUp()
+        self.manager = ConnectionManager()
+        self.config = dict(self.real_app.config, DB_ENGINE='mongo')
+
+    def test_reuses_clients(self, client_mock):
+        first = self.manager.get_db(self.config)
+        second = self.manager.get_db(self.config)
+        self.assertIs(first, second)
+        self.assertEqual(client_mock.call_count, 1)
+
+    def test_keepalive_client_is_separate(self, client_mock):
+        client_mock.side_effect = lambda *a, **kw: mock.MagicMock()
+        normal = self.manager.get_client(self.config)
+        keepalive = self.manager.get_client(self.config, keepalive=True)
+        self.assertIsNot(normal, keepalive)
+        keepalive.set_cursor_manager.assert_called_once_with(
+            KeepAliveCursorManager)
+        self.assertFalse(normal.set_cursor_manager.called)
+
+    def test_pool_sizes_come_from_config(self, client_mock):
+        self.config['DB_POOL_SIZE'] = 7
+        self.config['DB_KEEPALIVE_POOL_SIZE'] = 3
+        self.manager.get_client(self.config)
+        self.manager.get_client(self.config, keepalive=True)
+        sizes = [kw['max_pool_size'] for _, kw in client_mock.call_args_list]
+        self.assertEqual(sizes, [7, 3])
+
+    def test_authenticates_once(self, client_mock):
+        self.config['username'] = 'user'
+        self.config['password'] = 'pass'
+        self.manager.get_db(self.config)
+        self.manager.get_db(self.config)
+        db = client_mock.return_value[self.config['DB_NAME']]
+        db.authenticate.assert_called_once_with('user', 'pass')
+
+    @mock.patch('webapps.lib.db.os.getpid')
+    def test_rebuilds_clients_after_fork(self, getpid_mock, client_mock):
+        getpid_mock.return_value = self.manager._pid
+        self.manager.get_client(self.config)
+        getpid_mock.return_value = self.manager._pid + 1
+        self.manager.get_client(self.config)
+        self.assertEqual(client_mock.call_count, 2)
+
+    def test_failed_ping_reconnects(self, client_mock):
+        client = client_mock.return_value
+        client.admin.command.side_effect = ConnectionFailure('down')
+        self.assertFalse(self.manager.ping(self.config))
+        client.disconnect.assert_called_once_with()
+
+        client.admin.command.side_effect = None
+        self.assertTrue(self.manager.ping(self.config))
+        self.assertEqual(client_mock.call_count, 2)
+
+    def test_memory_engine_shares_one_client(self, client_mock):
+        self.config['DB_ENGINE'] = 'memory'
+        normal = self.manager.get_client(self.config)
+        keepalive = self.manager.get_client(self.config, keepalive=True)
+        self.assertIs(normal, keepalive)
+        self.assertIs(normal, memory.get_client())
+        self.assertFalse(client_mock.called)
+
+    def test_greenlet_clients(self, client_mock):
+        self.manager.get_client(self.config)
+        self.config['DB_USE_GREENLETS'] = True
+        self.manager.get_client(self.config)
+        flags = [kw['use_greenlets'] for _, kw in client_mock.call_args_list]
+        self.assertEqual(flags, [False, True])
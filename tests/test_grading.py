@@ -0,0 +1,169 @@
+#    Copyright 2013 10gen Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+from datetime import datetime, timedelta
+import json
+import threading
+
+import mock
+from werkzeug.serving import make_server
+
+from webapps.ivs import grading
+from webapps.ivs.grading_stub import create_app
+from webapps.lib import GRADES_COLLECTION
+from webapps.lib.db import get_db
+from tests import MongoWSTestCase
+
+
+class GradingTestCase(MongoWSTestCase):
+    def setUp(self):
+        super(GradingTestCase, self).setUp()
+        self.stub = create_app()
+        self.server = make_server('127.0.0.1', 0, self.stub, threaded=True)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.config = {
+            'GRADING_SERVER_URL': 'http://127.0.0.1:%d' %
+                                  self.server.server_port,
+            'GRADING_API_KEY': 'key',
+            'GRADING_API_SECRET': 'secret',
+            'GRADING_TIMEOUT': 5,
+            'GRADING_MAX_ATTEMPTS': 3,
+            'GRADING_RETRY_DELAY': 60,
+        }
+        self.db = get_db()
+        self.db[GRADES_COLLECTION].remove()
+
+    def tearDown(self):
+        super(GradingTestCase, self).tearDown()
+        self.server.shutdown()
+        self.db[GRADES_COLLECTION].remove()
+
+    def submit(self):
+        return grading.submit(self.db, self.config, 'course', 'problem',
+                              'user', {'score': '1'})
+
+    def make_due(self, grade_id):
+        self.db[GRADES_COLLECTION].update(
+            {'_id': grade_id},
+            {'$set': {'next_attempt': datetime.utcnow() - timedelta(1)}})
+
+    def test_sends_grades(self):
+        grade_id = self.submit()
+        grade = grading.wait(self.db, self.config, grade_id, 5)
+        self.assertEqual(grade['state'], grading.DONE)
+        self.assertEqual(grade['attempts'], 1)
+        self.assertEqual(json.loads(grade['response']['body'])['user_id'],
+                         'user')
+        self.assertEqual(self.stub.grades, [
+            ('course', 'problem', 'user',
+             {'score': '1', 'api_key': 'key', 'api_secret': 'secret'})])
+        # The credentials are not stored
+        self.assertNotIn('api_secret', grade['results'])
+
+    def test_retries_server_errors(self):
+        self.stub.config['STUB_FAILURE_RATE'] = 1
+        grade_id = self.submit()
+        grade = grading.claim(self.db, self.config)
+        self.assertEqual(grading.deliver(self.db, self.config, grade),
+                         grading.PENDING)
+        grade = self.db[GRADES_COLLECTION].find_one({'_id': grade_id})
+        self.assertEqual(grade['error'], 'HTTP 503')
+        self.assertGreater(grade['next_attempt'],
+                           datetime.utcnow() + timedelta(seconds=50))
+        self.assertIsNone(grading.claim(self.db, self.config))
+
+        self.make_due(grade_id)
+        self.stub.config['STUB_FAILURE_RATE'] = 0
+        grade = grading.claim(self.db, self.config)
+        self.assertEqual(grading.deliver(self.db, self.config, grade),
+                         grading.DONE)
+        self.assertEqual(len(self.stub.grades), 1)
+
+    def test_gives_up(self):
+        self.stub.config['STUB_FAILURE_RATE'] = 1
+        self.stub.config['STUB_FAILURE_STATUS'] = 400
+        grade_id = self.submit()
+        grade = grading.claim(self.db, self.config)
+        self.assertEqual(grading.deliver(self.db, self.config, grade),
+                         grading.FAILED)
+
+        # Timeouts are retried until GRADING_MAX_ATTEMPTS
+        self.stub.config['STUB_FAILURE_RATE'] = 0
+        self.stub.config['STUB_LATENCY'] = 0.5
+        self.config['GRADING_TIMEOUT'] = 0.1
+        grade_id = self.submit()
+        states = []
+        for _ in xrange(3):
+            self.make_due(grade_id)
+            grade = grading.claim(self.db, self.config)
+            states.append(grading.deliver(self.db, self.config, grade))
+        self.assertEqual(states, [grading.PENDING, grading.PENDING,
+                                  grading.FAILED])
+
+    def test_reclaims_expired_locks(self):
+        grade_id = self.submit()
+        self.assertIsNotNone(grading.claim(self.db, self.config))
+        self.assertIsNone(grading.claim(self.db, self.config))
+        self.db[GRADES_COLLECTION].update(
+            {'_id': grade_id},
+            {'$set': {'locked_until': datetime.utcnow() - timedelta(1)}})
+        stale = grading.claim(self.db, self.config)
+        self.assertEqual(stale['attempts'], 2)
+
+    def test_wait_times_out(self):
+        self.stub.config['STUB_FAILURE_RATE'] = 1
+        grade_id = self.submit()
+        self.assertIsNone(grading.wait(self.db, self.config, grade_id, 0.2))
+
+    def test_wait_is_woken_by_the_worker(self):
+        grade_id = self.submit()
+
+        def send():
+            grade = grading.claim(self.db, self.config)
+            grading.deliver(self.db, self.config, grade)
+
+        worker = threading.Timer(0.2, send)
+        with mock.patch('webapps.ivs.grading._workers', mock.Mock()):
+            worker.start()
+            grade = grading.wait(self.db, self.config, grade_id, 5)
+            worker.join()
+            self.assertEqual(grade['state'], grading.DONE)
+            self.assertEqual(grading._waiting, {})
+
+            # A grade no worker here finishes is left to be checked again
+            self.stub.config['STUB_FAILURE_RATE'] = 1
+            grade_id = self.submit()
+            self.assertIsNone(grading.wait(self.db, self.config, grade_id,
+                                           0.2))
+            self.assertEqual(len(self.stub.grades), 1)
+
+    def test_wait_sends_inline_without_timeout(self):
+        grade_id = self.submit()
+        grade = grading.wait(self.db, self.config, grade_id, 0)
+        self.assertEqual(grade['state'], grading.DONE)
+        self.assertLessEqual(grade['created'], datetime.utcnow())
+        self.assertLessEqual(grade['finished'] - grade['created'],
+                             timedelta(seconds=5))
+
+        # A retry is sent once it is due
+        self.stub.config['STUB_FAILURE_RATE'] = 1
+        grade_id = self.submit()
+        self.assertIsNone(grading.wait(self.db, self.config, grade_id, 0))
+        self.make_due(grade_id)
+        self.stub.config['STUB_FAILURE_RATE'] = 0
+        grade = grading.wait(self.db, self.config, grade_id, 0)
+        self.assertEqual(grade['state'], grading.DONE)
+        self.assertEqual(grade['attempts'], 2)
@@ -0,0 +1,64 @@
+#    Copyright 2013 10gen Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+from datetime import datetime, timedelta
+
+from webapps.lib import LEASES_COLLECTION, leases
+from webapps.lib.db import get_db
+from tests import MongoWSTestCase
+
+
+class LeasesTestCase(MongoWSTestCase):
+    def setUp(self):
+        super(LeasesTestCase, self).setUp()
+        self.db = get_db()
+        self.db[LEASES_COLLECTION].remove({'_id': 'job'})
+
+    def tearDown(self):
+        super(LeasesTestCase, self).tearDown()
+        self.db[LEASES_COLLECTION].remove({'_id': 'job'})
+
+    def test_acquire_and_renew(self):
+        self.assertTrue(leases.acquire(self.db, 'job', 60))
+        first = leases.get(self.db, 'job')
+        self.assertEqual(first['owner'], leases.owner_id())
+        self.assertEqual(first['acquired_by'], leases.owner_id())
+        self.assertLessEqual(first['expires'] - datetime.utcnow(),
+                             timedelta(seconds=60))
+
+        self.assertTrue(leases.acquire(self.db, 'job', 60))
+        second = leases.get(self.db, 'job')
+        self.assertEqual(second['acquired'], first['acquired'])
+        self.assertGreaterEqual(second['expires'], first['expires'])
+
+    def test_held_elsewhere(self):
+        later = datetime.utcnow() + timedelta(seconds=60)
+        self.db[LEASES_COLLECTION].insert(
+            {'_id': 'job', 'owner': 'elsewhere:1', 'expires': later})
+        self.assertFalse(leases.acquire(self.db, 'job', 60))
+        leases.record(self.db, 'job', {'last_run': {}})
+        self.assertNotIn('last_run', leases.get(self.db, 'job'))
+
+        # Taken over once it expires
+        self.db[LEASES_COLLECTION].update(
+            {'_id': 'job'},
+            {'$set': {'expires': datetime.utcnow() - timedelta(seconds=1)}})
+        self.assertTrue(leases.acquire(self.db, 'job', 60))
+
+    def test_release(self):
+        leases.acquire(self.db, 'job', 60)
+        leases.release(self.db, 'job')
+        status = [lease for lease in leases.status(self.db)
+                  if lease['_id'] == 'job']
+        self.assertFalse(status[0]['held'])
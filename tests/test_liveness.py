@@ -0,0 +1,71 @@
+#    Copyright 2013 10gen Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+from datetime import datetime
+
+import mock
+from pymongo.errors import AutoReconnect
+
+from webapps.lib import CLIENTS_COLLECTION
+from webapps.lib.db import get_db
+from webapps.lib.liveness import LivenessBuffer
+from tests import MongoWSTestCase
+
+
+class LivenessBufferTestCase(MongoWSTestCase):
+    def setUp(self):
+        super(LivenessBufferTestCase, self).setUp()
+        self.db = get_db()
+        self.clients = self.db[CLIENTS_COLLECTION]
+        self.old = datetime(2012, 7, 1)
+        for i in xrange(5):
+            self.clients.insert({'res_id': 'live%d' % i,
+                                 'session_id': 'live%d' % i,
+                                 'timestamp': self.old})
+        self.buffer = LivenessBuffer()
+
+    def tearDown(self):
+        super(LivenessBufferTestCase, self).tearDown()
+        self.clients.remove({'timestamp': {'$lt': datetime(2012, 7, 6)}})
+        self.clients.remove({'res_id': {'$in': ['live%d' % i
+                                                for i in xrange(5)]}})
+
+    def timestamps(self):
+        return dict((doc['res_id'], doc['timestamp']) for doc in
+                    self.clients.find({'res_id': {'$regex': '^live'}}))
+
+    def test_flushes_in_batches(self):
+        for i in xrange(3):
+            self.buffer.touch('live%d' % i, 'live%d' % i)
+        # A session touched with another's res_id is not written
+        self.buffer.touch('live3', 'someone else')
+        self.assertEqual(len(self.buffer), 4)
+
+        self.assertEqual(self.buffer.flush(self.db, batch_size=2), 4)
+        self.assertEqual(len(self.buffer), 0)
+        timestamps = self.timestamps()
+        for i in xrange(3):
+            self.assertGreater(timestamps['live%d' % i], self.old)
+        self.assertEqual(timestamps['live3'], self.old)
+        self.assertEqual(timestamps['live4'], self.old)
+
+    def test_keeps_unwritten_sessions(self):
+        self.buffer.touch('live0', 'live0')
+        update = mock.Mock(side_effect=AutoReconnect('down'))
+        db = {CLIENTS_COLLECTION: mock.Mock(update=update)}
+        self.assertEqual(self.buffer.flush(db), 0)
+        self.assertEqual(len(self.buffer), 1)
+
+        self.assertEqual(self.buffer.flush(self.db), 1)
+        self.assertGreater(self.timestamps()['live0'], self.old)
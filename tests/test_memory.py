@@ -0,0 +1,226 @@
+#    Copyright 2013 10gen Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+from datetime import datetime, timedelta
+import re
+
+import mock
+from pymongo.errors import DuplicateKeyError, OperationFailure
+
+from webapps.lib import memory, query
+from tests import MongoWSTestCase
+
+
+class QueryTestCase(MongoWSTestCase):
+    def assertMatches(self, document, spec, expected=True):
+        self.assertEqual(query.match(document, spec), expected,
+                         '%r against %r' % (document, spec))
+
+    def test_equality_and_paths(self):
+        doc = {'a': 1, 'b': {'c': [1, 2]}, 'd': [{'e': 5}, {'e': 6}]}
+        self.assertMatches(doc, {'a': 1})
+        self.assertMatches(doc, {'b.c': 2})
+        self.assertMatches(doc, {'b.c': [1, 2]})
+        self.assertMatches(doc, {'d.e': 6})
+        self.assertMatches(doc, {'d.1.e': 6})
+        self.assertMatches(doc, {'a': 2}, False)
+        self.assertMatches(doc, {'missing': None})
+        self.assertMatches(doc, {'a': None}, False)
+
+    def test_operators(self):
+        doc = {'n': 5, 's': 'Mongo', 'l': [1, 5, 9]}
+        self.assertMatches(doc, {'n': {'$gt': 4, '$lte': 5}})
+        self.assertMatches(doc, {'n': {'$gt': '4'}}, False)
+        self.assertMatches(doc, {'n': {'$in': [1, 5]}, 's': {'$nin': ['a']}})
+        self.assertMatches(doc, {'l': {'$all': [1, 9], '$size': 3}})
+        self.assertMatches(doc, {'l': {'$elemMatch': {'$gt': 6, '$lt': 10}}})
+        self.assertMatches(doc, {'s': {'$regex': '^mon', '$options': 'i'}})
+        self.assertMatches(doc, {'s': re.compile('go$')})
+        self.assertMatches(doc, {'n': {'$not': {'$gt': 4}}}, False)
+        self.assertMatches(doc, {'x': {'$exists': False}, 'n': {'$ne': 4}})
+        self.assertMatches(doc, {'$or': [{'n': 1}, {'s': 'Mongo'}]})
+        self.assertMatches(doc, {'$nor': [{'n': 5}]}, False)
+        with self.assertRaises(OperationFailure):
+            query.match(doc, {'n': {'$bogus': 1}})
+
+    def test_projection(self):
+        doc = {'_id': 1, 'a': 1, 'b': {'c': 2, 'd': 3}}
+        self.assertEqual(query.project(doc, {'b.c': 1}),
+                         {'_id': 1, 'b': {'c': 2}})
+        self.assertEqual(query.project(doc, {'b': 0, '_id': 0}), {'a': 1})
+        with self.assertRaises(OperationFailure):
+            query.project(doc, {'a': 1, 'b': 0})
+
+    def test_sort_orders_types_like_mongod(self):
+        docs = [{'v': 'a'}, {'v': 2}, {}, {'v': [0, 7]}, {'v': 1.5}]
+        query.sort(docs, [('v', 1)])
+        self.assertEqual(docs, [{}, {'v': [0, 7]}, {'v': 1.5}, {'v': 2},
+                                {'v': 'a'}])
+        query.sort(docs, [('v', -1)])
+        self.assertEqual(docs[0], {'v': 'a'})
+        self.assertEqual(docs[1], {'v': [0, 7]})
+
+    def test_update_operators(self):
+        doc = {'_id': 1, 'n': 1, 'l': [1, 2, 3], 'old': 'x'}
+        query.apply_update(doc, {
+            '$inc': {'n': 2},
+            '$set': {'a.b': 'c'},
+            '$push': {'l': {'$each': [4, 5]}},
+            '$pull': {'l': {'$lt': 3}},
+            '$rename': {'old': 'new'},
+            '$addToSet': {'tags': 'x'}
+        })
+        self.assertEqual(doc, {'_id': 1, 'n': 3, 'a': {'b': 'c'},
+                               'l': [3, 4, 5], 'new': 'x', 'tags': ['x']})
+        with self.assertRaises(OperationFailure):
+            query.apply_update(doc, {'$inc': {'new': 1}})
+        with self.assertRaises(OperationFailure):
+            query.apply_update(doc, {'$set': {'_id': 2}})
+
+    def test_upsert_document(self):
+        self.assertEqual(
+            query.upsert_document({'a': 1, 'b': {'$gt': 1}},
+                                  {'$set': {'c': 2}, '$setOnInsert': {'d': 3}}),
+            {'a': 1, 'c': 2, 'd': 3})
+        self.assertEqual(query.upsert_document({'_id': 5}, {'x': 1}),
+                         {'_id': 5, 'x': 1})
+
+    def test_aggregate(self):
+        docs = [{'k': 'a', 'v': 1, 't': ['x', 'y']}, {'k': 'b', 'v': 2},
+                {'k': 'a', 'v': 3}]
+        result = query.aggregate(docs, [
+            {'$match': {'v': {'$gte': 1}}},
+            {'$group': {'_id': '$k', 'total': {'$sum': '$v'},
+                        'n': {'$sum': 1}}},
+            {'$sort': {'total': -1}}
+        ])
+        self.assertEqual(result, [{'_id': 'a', 'total': 4, 'n': 2},
+                                  {'_id': 'b', 'total': 2, 'n': 1}])
+        result = query.aggregate(docs, [{'$unwind': '$t'},
+                                        {'$project': {'_id': 0, 't': 1}}])
+        self.assertEqual(result, [{'t': 'x'}, {'t': 'y'}])
+        with self.assertRaises(OperationFailure):
+            query.aggregate(docs, [{'$bogus': {}}])
+
+
+class MemoryEngineTestCase(MongoWSTestCase):
+    def setUp(self):
+        super(MemoryEngineTestCase, self).setUp()
+        self.client = memory.MemoryClient()
+        self.db = self.client.test
+        self.coll = self.db.coll
+
+    def test_writes(self):
+        _id = self.coll.insert({'a': 1})
+        with self.assertRaises(DuplicateKeyError):
+            self.coll.insert({'_id': _id})
+        self.assertEqual(len(self.coll.insert([{'a': 2}, {'a': 3}])), 2)
+
+        res = self.coll.update({'a': {'$gt': 1}}, {'$set': {'b': 1}},
+                               multi=True)
+        self.assertEqual((res['n'], res['nModified']), (2, 2))
+        res = self.coll.update({'a': 9}, {'$set': {'b': 2}}, upsert=True)
+        self.assertEqual(res['upserted'][0]['index'], 0)
+        self.assertFalse(res['updatedExisting'])
+        self.assertEqual(self.coll.find({'b': {'$exists': True}}).count(), 3)
+
+        self.assertEqual(self.coll.remove({'a': 2})['n'], 1)
+        self.assertEqual(self.coll.count(), 3)
+        self.assertEqual(self.db.collection_names(), ['coll'])
+        self.db.drop_collection('coll')
+        self.assertEqual(self.db.collection_names(), [])
+
+    def test_returned_documents_are_copies(self):
+        self.coll.insert({'_id': 1, 'l': [1]})
+        self.coll.find_one(1)['l'].append(2)
+        self.assertEqual(self.coll.find_one(1)['l'], [1])
+
+    def test_find_and_modify(self):
+        doc = self.coll.find_and_modify({'_id': 'k'}, {'$inc': {'n': 1}},
+                                        upsert=True, new=True)
+        self.assertEqual(doc, {'_id': 'k', 'n': 1})
+        old = self.coll.find_and_modify({'_id': 'k'}, {'$inc': {'n': 1}})
+        self.assertEqual(old['n'], 1)
+        self.assertIsNone(self.coll.find_and_modify({'_id': 'x'},
+                                                    {'$inc': {'n': 1}}))
+
+    def test_rename(self):
+        self.coll.insert({'_id': 1})
+        self.db.other.insert({'_id': 2})
+        with self.assertRaises(OperationFailure):
+            self.coll.rename('other')
+        self.coll.rename('other', dropTarget=True)
+        self.assertEqual(self.db.collection_names(), ['other'])
+        self.assertEqual(self.db.other.find_one(), {'_id': 1})
+        with self.assertRaises(OperationFailure):
+            self.coll.rename('third')
+
+    def test_aggregate_out(self):
+        self.coll.insert([{'_id': i, 'a': i % 2} for i in xrange(4)])
+        self.db.other.insert({'_id': 'old'})
+        self.db.other.create_index('a')
+        result = self.coll.aggregate([{'$match': {'a': 1}},
+                                      {'$out': 'other'}])
+        self.assertEqual(result['result'], [])
+        self.assertEqual(list(self.db.other.find().sort('_id', 1)),
+                         [{'_id': 1, 'a': 1}, {'_id': 3, 'a': 1}])
+        self.assertIn('a_1', self.db.other.index_information())
+
+    def test_collstats(self):
+        with self.assertRaises(OperationFailure):
+            self.db.command({'collstats': 'coll'})
+        self.coll.insert([{'a': i} for i in xrange(3)])
+        stats = self.db.command({'collstats': 'coll'})
+        self.assertEqual(stats['count'], 3)
+        self.assertGreater(stats['size'], 0)
+        self.coll.remove({})
+        self.assertEqual(self.db.command({'collstats': 'coll'})['size'], 0)
+
+    def test_cursors_are_resumed_by_id(self):
+        self.coll.insert([{'v': i} for i in xrange(25)])
+        cursor = self.coll.find({}, {'_id': 0}).sort('v', -1).batch_size(10)
+        first = [cursor.next()['v'] for _ in xrange(10)]
+        self.assertEqual(first, range(24, 14, -1))
+        self.assertTrue(cursor.alive)
+        self.assertTrue(cursor.cursor_id)
+
+        resumed = self.db.resume_cursor(cursor.cursor_id)
+        self.assertEqual([d['v'] for d in resumed], range(14, -1, -1))
+        self.assertFalse(resumed.alive)
+        # Exhausted cursors are closed
+        self.assertIsNone(self.client.get_cursor(cursor.cursor_id))
+
+    def test_killed_cursors_fail(self):
+        self.coll.insert([{'v': i} for i in xrange(5)])
+        cursor = self.coll.find().batch_size(2)
+        cursor.next()
+        self.client.kill_cursors([cursor.cursor_id])
+        with self.assertRaises(OperationFailure):
+            self.db.resume_cursor(cursor.cursor_id).next()
+
+    def test_small_results_leave_no_cursor(self):
+        self.coll.insert([{'v': i} for i in xrange(5)])
+        cursor = self.coll.find().limit(3).batch_size(10)
+        self.assertEqual(len(list(cursor)), 3)
+        self.assertEqual(cursor.cursor_id, 0)
+        self.assertFalse(cursor.alive)
+
+    @mock.patch('webapps.lib.memory.time')
+    def test_ttl_indexes_expire_documents(self, time_mock):
+        time_mock.time.return_value = 1000
+        self.coll.create_index('expires', expireAfterSeconds=0)
+        self.coll.insert({'expires': datetime.utcnow() - timedelta(hours=1)})
+        self.coll.insert({'expires': datetime.utcnow() + timedelta(hours=1)})
+        self.assertEqual(self.coll.find().count(), 1)
+        self.assertIn('expires_1', self.coll.index_information())
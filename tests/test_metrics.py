@@ -0,0 +1,153 @@
+#    Copyright 2013 10gen Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from webapps.lib import metrics
+from tests import MongoWSTestCase
+
+
+class RegistryTestCase(MongoWSTestCase):
+    def setUp(self):
+        super(RegistryTestCase, self).setUp()
+        self.registry = metrics.Registry()
+
+    def test_counts_by_label(self):
+        self.registry.inc('mws_cursors_opened_total')
+        self.registry.inc('mws_cursors_opened_total', 2)
+        self.registry.inc('mws_mongo_operations_total', operation='find')
+        values, _ = metrics.merge([self.registry.snapshot()])
+        self.assertEqual(values[('mws_cursors_opened_total', ())], 3)
+        self.assertEqual(values[('mws_mongo_operations_total',
+                                 (('operation', 'find'),))], 1)
+
+    def test_observes_into_buckets(self):
+        name = 'mws_http_request_duration_seconds'
+        self.registry.observe(name, 0.001, endpoint='a')
+        self.registry.observe(name, 0.3, endpoint='a')
+        self.registry.observe(name, 100, endpoint='a')
+        _, histograms = metrics.merge([self.registry.snapshot()])
+        counts, total, count = histograms[(name, (('endpoint', 'a'),))]
+        self.assertEqual(count, 3)
+        self.assertAlmostEqual(total, 100.301)
+        self.assertEqual(counts[0], 1)
+        self.assertEqual(counts[metrics.LATENCY_BUCKETS.index(0.5)], 1)
+        # Above the largest bucket, only counted in +Inf
+        self.assertEqual(sum(counts), 2)
+
+    def test_collectors_are_read_on_snapshot(self):
+        sizes = [1]
+        self.registry.add_collector(
+            lambda: [('mws_cache_entries', {'cache': 'c'}, sizes[0])])
+        sizes[0] = 5
+        values, _ = metrics.merge([self.registry.snapshot()])
+        self.assertEqual(values[('mws_cache_entries', (('cache', 'c'),))], 5)
+
+
+class RenderTestCase(MongoWSTestCase):
+    def test_renders_summed_snapshots(self):
+        first, second = metrics.Registry(), metrics.Registry()
+        first.inc('mws_cursors_closed_total', 2)
+        second.inc('mws_cursors_closed_total', 3)
+        name = 'mws_scheduler_job_duration_seconds'
+        first.observe(name, 0.2, job='reap_cursors')
+        second.observe(name, 7, job='reap_cursors')
+        text = metrics.render([first.snapshot(), second.snapshot()])
+        lines = text.splitlines()
+        self.assertIn('# TYPE mws_cursors_closed_total counter', lines)
+        self.assertIn('mws_cursors_closed_total 5', lines)
+        self.assertIn('%s_bucket{job="reap_cursors",le="0.5"} 1' % name,
+                      lines)
+        self.assertIn('%s_bucket{job="reap_cursors",le="10.0"} 2' % name,
+                      lines)
+        self.assertIn('%s_bucket{job="reap_cursors",le="+Inf"} 2' % name,
+                      lines)
+        self.assertIn('%s_count{job="reap_cursors"} 2' % name, lines)
+
+    def test_escapes_label_values(self):
+        registry = metrics.Registry()
+        registry.inc('mws_http_requests_total', endpoint='a"b\\c')
+        text = metrics.render([registry.snapshot()])
+        self.assertIn('mws_http_requests_total{endpoint="a\\"b\\\\c"} 1',
+                      text.splitlines())
+
+
+class SnapshotWriterTestCase(MongoWSTestCase):
+    def setUp(self):
+        super(SnapshotWriterTestCase, self).setUp()
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        super(SnapshotWriterTestCase, self).tearDown()
+        shutil.rmtree(self.directory)
+
+    def test_reads_other_workers_snapshots(self):
+        other = metrics.Registry()
+        other.inc('mws_cursors_opened_total', 7)
+        with open(os.path.join(self.directory, 'metrics-1.json'), 'w') as f:
+            json.dump(other.snapshot(), f)
+        # A snapshot being written by a crashed worker is skipped
+        with open(os.path.join(self.directory, 'metrics-2.json'), 'w') as f:
+            f.write('{"values": [')
+
+        writer = metrics.SnapshotWriter(self.directory, 5)
+        writer.flush()
+        self.assertTrue(os.path.exists(writer.path))
+        snaps = writer.snapshots()
+        self.assertEqual(len(snaps), 2)
+        values, _ = metrics.merge(snaps)
+        self.assertGreaterEqual(values[('mws_cursors_opened_total', ())], 7)
+
+    def test_drops_exited_workers_snapshots(self):
+        path = os.path.join(self.directory, 'metrics-1.json')
+        with open(path, 'w') as f:
+            json.dump(metrics.Registry().snapshot(), f)
+        old = time.time() - 3 * metrics.STALE_FLUSHES * 5
+        os.utime(path, (old, old))
+
+        writer = metrics.SnapshotWriter(self.directory, 5)
+        self.assertEqual(len(writer.snapshots()), 1)
+        self.assertFalse(os.path.exists(path))
+
+
+class MetricsEndpointTestCase(MongoWSTestCase):
+    def setUp(self):
+        super(MetricsEndpointTestCase, self).setUp()
+        self.real_app.config['METRICS_TOKEN'] = 'scraper'
+
+    def tearDown(self):
+        super(MetricsEndpointTestCase, self).tearDown()
+        self.real_app.config['METRICS_TOKEN'] = None
+
+    def test_records_requests(self):
+        self.app.get('/mws/nosuchres/db/coll/count')
+        rv = self.app.get(self.real_app.config['METRICS_PATH'],
+                          headers={'Authorization': 'Bearer scraper'})
+        self.assertEqual(rv.status_code, 200)
+        self.assertTrue(rv.headers['Content-Type'].startswith('text/plain'))
+        self.assertIn('mws_http_requests_total{endpoint=', rv.data)
+        self.assertIn('mws_http_request_duration_seconds_bucket', rv.data)
+
+    def test_requires_the_token(self):
+        path = self.real_app.config['METRICS_PATH']
+        self.assertEqual(self.app.get(path).status_code, 403)
+        rv = self.app.get(path, headers={'Authorization': 'Bearer wrong'})
+        self.assertEqual(rv.status_code, 403)
+        self.real_app.config['METRICS_TOKEN'] = None
+        rv = self.app.get(path, headers={'Authorization': 'Bearer None'})
+        self.assertEqual(rv.status_code, 403)
@@ -17,7 +17,13 @@ from bson.json_util import loads, dumps
 import datetime
 import mock
 import webapps.server
-from webapps.server.views import ratelimit
+from webapps.server.views import (
+    buffer_chunks,
+    ratelimit,
+    stream_json_result,
+    stream_ndjson
+)
+from webapps.lib import liveness
 from webapps.lib.db import get_db
 from webapps.lib.util import to_coll_name, get_collection_names
 from flask import session
@@ -27,7 +33,7 @@ from pymongo.errors import OperationFailure
 from webapps.lib.MWSServerError import MWSServerError
 
 from tests import MongoWSTestCase
-from webapps.lib import CLIENTS_COLLECTION
+from webapps.lib import CLIENTS_COLLECTION, CURSORS_COLLECTION
 
 
 class ViewsSetUpUnitTestCase(MongoWSTestCase):
@@ -67,12 +73,15 @@ class ViewsSetUpUnitTestCase(MongoWSTestCase):
         self.assertIsNotNone(new_res_id)
         self.assertNotEqual(res_id, new_res_id)
 
+    @mock.patch('webapps.lib.liveness.datetime')
     @mock.patch('webapps.server.views.datetime')
-    def test_keep_mws_alive(self, datetime_mock):
+    def test_keep_mws_alive(self, datetime_mock, liveness_datetime_mock):
         first = datetime.datetime(2012, 7, 4)
         second = first + datetime.timedelta(days=1)
         datetime_mock.now.return_value = first
         db = get_db()
+        # Write out activity buffered by other tests
+        liveness.flush(db)
 
         # get a session to keep alive
         rv = self.app.post('/mws/')
@@ -86,10 +95,14 @@ class ViewsSetUpUnitTestCase(MongoWSTestCase):
             old_ts = res[0]['timestamp']
             self.assertEqual(old_ts, first)
 
-            datetime_mock.now.return_value = second
+            liveness_datetime_mock.now.return_value = second
             url = '/mws/' + res_id + '/keep-alive'
             rv = self.app.post(url)
             self.assertEqual(rv.status_code, 204)
+            # Buffered until the next flush
+            newres = db.clients.find({'_id': _id}, {'timestamp': 1})
+            self.assertEqual(newres[0]['timestamp'], first)
+            liveness.flush(db)
             newres = db.clients.find({'_id': _id}, {'timestamp': 1})
             self.assertEqual(newres[0]['timestamp'], second)
 
@@ -136,6 +149,33 @@ class ViewsSetUpUnitTestCase(MongoWSTestCase):
         self.assertEqual(res.headers['expires'], '0')
 
 
+class StreamingUnitTestCase(MongoWSTestCase):
+    def failing_documents(self):
+        yield {'val': 0}
+        raise MWSServerError(400, 'Cursor not found')
+
+    def test_stream_json_result(self):
+        body = ''.join(stream_json_result(iter([{'val': 0}, {'val': 1}])))
+        self.assertEqual(loads(body), {'result': [{'val': 0}, {'val': 1}],
+                                       'empty_cursor': True})
+
+        body = ''.join(stream_json_result(iter([])))
+        self.assertEqual(loads(body), {'result': [], 'empty_cursor': True})
+
+        body = loads(''.join(stream_json_result(self.failing_documents())))
+        self.assertEqual(body['result'], [{'val': 0}])
+        self.assertEqual(body['error']['reason'], 'Cursor not found')
+
+    def test_stream_ndjson(self):
+        lines = list(stream_ndjson(self.failing_documents()))
+        self.assertEqual(loads(lines[0]), {'val': 0})
+        self.assertEqual(loads(lines[1])['error'], 400)
+
+    def test_buffer_chunks(self):
+        chunks = list(buffer_chunks(['ab', 'cd', 'e', 'fgh', 'i'], 3))
+        self.assertEqual(chunks, ['abcd', 'efgh', 'i'])
+
+
 class DBTestCase(MongoWSTestCase):
     def setUp(self):
         super(DBTestCase, self).setUp()
@@ -191,6 +231,11 @@ class DBCollectionTestCase(DBTestCase):
                                                          self.coll_name)
         self.db = get_db()
         self.db_collection = self.db[self.internal_coll_name]
+        # Tests write to self.db_collection directly, so register it with the
+        # res_id as the first write through the API would.
+        self.db[CLIENTS_COLLECTION].update(
+            {'res_id': self.res_id},
+            {'$addToSet': {'collections': self.coll_name}})
 
         self.make_request_url = '/mws/%s/db/%s/%%s' % \
                                 (self.res_id, self.coll_name)
@@ -201,7 +246,8 @@ class DBCollectionTestCase(DBTestCase):
 
     def make_find_request(self, query=None, projection=None, skip=None,
                           limit=None, expected_status=200, cursor_id=0,
-                          retrieved=0, count=0, drain_cursor=False):
+                          retrieved=0, count=0, drain_cursor=False,
+                          with_count=True):
         data = {
             'query': query,
             'projection': projection,
@@ -210,7 +256,8 @@ class DBCollectionTestCase(DBTestCase):
             'cursor_id': cursor_id,
             'retrieved': retrieved,
             'count': count,
-            'drain_cursor': drain_cursor
+            'drain_cursor': drain_cursor,
+            'with_count': with_count
         }
         return self._make_request('find', data, self.app.get,
                                   expected_status)
@@ -246,8 +293,9 @@ class DBCollectionTestCase(DBTestCase):
                                   expected_status)
 
     def make_count_request(self, query=None, skip=None, limit=None,
-                           expected_status=200):
-        data = {'query': query, 'skip': skip, 'limit': limit}
+                           estimate=None, expected_status=200):
+        data = {'query': query, 'skip': skip, 'limit': limit,
+                'estimate': estimate}
         return self._make_request('count', data, self.app.get, expected_status)
 
     def set_session_id(self, new_id):
@@ -371,6 +419,89 @@ class FindUnitTestCase(DBCollectionTestCase):
         self.verify_cursor(100, limit=batch_size+1, drain_cursor=True)
         self.verify_cursor(100, limit=batch_size-1, drain_cursor=True)
 
+    def test_count_is_optional(self):
+        self.db_collection.insert([{'val': i} for i in xrange(30)])
+        result = self.make_find_request({}, with_count=None)
+        self.assertNotIn('count', result)
+        self.assertEqual(len(result['result']), 20)
+
+        result = self.make_find_request({}, skip=5, with_count='estimated')
+        self.assertEqual(result['count'], 25)
+        result = self.make_find_request({'val': {'$lt': 10}},
+                                        with_count='estimated')
+        self.assertEqual(result['count'], 10)
+
+    def test_next_stops_at_limit(self):
+        self.db_collection.insert([{'val': i} for i in xrange(50)])
+        response = self.make_find_request({}, limit=25, with_count=None)
+        self.assertEqual(len(response['result']), 20)
+
+        url = self.make_request_url % 'next'
+        data = dumps({'cursor_id': response['cursor_id'], 'retrieved': 20,
+                      'limit': 25})
+        result = loads(self.app.get(url, query_string={'data': data}).data)
+        self.assertEqual(len(result['result']), 5)
+        self.assertTrue(result['empty_cursor'])
+
+    def test_next_reports_the_end_on_a_batch_boundary(self):
+        batch_size = self.real_app.config['CURSOR_BATCH_SIZE']
+        self.db_collection.insert([{'val': i} for i in xrange(batch_size * 2)])
+        response = self.make_find_request({}, with_count=None)
+        retrieved = len(response['result'])
+        self.assertEqual(retrieved, batch_size)
+
+        url = self.make_request_url % 'next'
+        result = {}
+        while not result.get('empty_cursor'):
+            data = dumps({'cursor_id': response['cursor_id'],
+                          'retrieved': retrieved})
+            rv = self.app.get(url, query_string={'data': data})
+            self.assertEqual(rv.status_code, 200)
+            result = loads(rv.data)
+            retrieved += len(result['result'])
+            self.assertLessEqual(retrieved, batch_size * 2)
+        self.assertEqual(retrieved, batch_size * 2)
+
+    def test_cursor_drain_streams(self):
+        batch_size = self.real_app.config['CURSOR_BATCH_SIZE']
+        self.db_collection.insert([{'val': i} for i in xrange(150)])
+        response = self.make_find_request(query={})
+        self.assertEqual(len(response['result']), batch_size)
+
+        url = self.make_request_url % 'next'
+        data = dumps({'cursor_id': response['cursor_id'],
+                      'retrieved': batch_size, 'drain_cursor': True})
+        rv = self.app.get(url, query_string={'data': data})
+        result = loads(rv.data)
+        self.assertTrue(result['empty_cursor'])
+        self.assertEqual([r['val'] for r in result['result']],
+                         range(batch_size, 150))
+
+        response = self.make_find_request(query={})
+        data = dumps({'cursor_id': response['cursor_id'],
+                      'retrieved': batch_size, 'drain_cursor': True})
+        rv = self.app.get(url, query_string={'data': data},
+                          headers={'Accept': 'application/x-ndjson'})
+        self.assertEqual(rv.mimetype, 'application/x-ndjson')
+        lines = rv.data.splitlines()
+        self.assertEqual([loads(l)['val'] for l in lines],
+                         range(batch_size, 150))
+
+    def test_dropped_drain_kills_the_cursor(self):
+        self.db_collection.insert([{'val': i} for i in xrange(150)])
+        response = self.make_find_request(query={})
+        cursor_id = long(response['cursor_id'])
+        registry = get_db()[CURSORS_COLLECTION]
+        self.assertEqual(registry.find({'_id': cursor_id}).count(), 1)
+
+        url = self.make_request_url % 'next'
+        data = dumps({'cursor_id': response['cursor_id'],
+                      'retrieved': 20, 'drain_cursor': True})
+        rv = self.app.get(url, query_string={'data': data}, buffered=False)
+        # The client goes away before reading any of the body
+        rv.close()
+        self.assertEqual(registry.find({'_id': cursor_id}).count(), 0)
+
     def test_skipping_results(self):
         self.db_collection.insert([{'val': i} for i in xrange(10)])
 
@@ -625,6 +756,14 @@ class CountTestCase(DBCollectionTestCase):
         response = self.make_count_request({}, skip=8, limit=0)
         self.assertEqual(response['count'], 2)
 
+    def test_estimated_count(self):
+        self.db_collection.insert([{'n': i} for i in xrange(10)])
+        response = self.make_count_request({}, skip=3, estimate=True)
+        self.assertEqual(response['count'], 7)
+
+        response = self.make_count_request({'n': {'$gt': 4}}, estimate=True)
+        self.assertEqual(response['count'], 5)
+
 
 class DropUnitTestCase(DBCollectionTestCase):
     def test_drop(self):
@@ -643,6 +782,82 @@ class DropUnitTestCase(DBCollectionTestCase):
         self.assertNotIn(self.internal_coll_name, self.db.collection_names())
 
 
+class BatchUnitTestCase(DBCollectionTestCase):
+    def make_batch_request(self, operations, ordered=True,
+                           expected_status=200):
+        self.make_request_url = '/mws/%s/%%s' % (self.res_id)
+        data = {'operations': operations, 'ordered': ordered}
+        return self._make_request('batch', data, self.app.post,
+                                  expected_status)
+
+    def op(self, op, params=None):
+        return {'op': op, 'collection': self.coll_name, 'params': params or {}}
+
+    def test_batch(self):
+        result = self.make_batch_request([
+            self.op('insert', {'document': [{'name': 'Mongo'},
+                                            {'name': 'NotMongo'}]}),
+            self.op('update', {'query': {'name': 'Mongo'},
+                               'update': {'$set': {'seen': True}}}),
+            self.op('remove', {'constraint': {'name': 'NotMongo'}}),
+            self.op('count', {'query': {'seen': True}})
+        ])['results']
+
+        self.assertEqual(len(result), 4)
+        self.assertIn('nInserted', result[0]['result']['pretty'])
+        self.assertEqual(result[3], {'result': 1})
+        self.assertEqual(self.db_collection.find().count(), 1)
+
+    def test_ordered_batch_stops_at_error(self):
+        operations = [
+            self.op('insert', {'document': {'_id': 1}}),
+            self.op('insert', {'document': {'_id': 1}}),
+            self.op('insert', {'document': {'_id': 2}})
+        ]
+        result = self.make_batch_request(operations)['results']
+        self.assertEqual(len(result), 2)
+        self.assertEqual(result[1]['error']['error'], 400)
+        self.assertEqual(self.db_collection.find().count(), 1)
+
+        self.db_collection.drop()
+        result = self.make_batch_request(operations, ordered=False)['results']
+        self.assertEqual(len(result), 3)
+        self.assertEqual(self.db_collection.find().count(), 2)
+
+    def test_batch_reports_unexpected_errors(self):
+        failing = mock.Mock(side_effect=ValueError('boom'))
+        operations = [
+            self.op('insert', {'document': {'_id': 1}}),
+            self.op('count'),
+            self.op('insert', {'document': {'_id': 2}})
+        ]
+        with mock.patch.dict('webapps.server.operations.OPERATIONS',
+                             {'count': (failing, 'read')}):
+            result = self.make_batch_request(operations)['results']
+        self.assertEqual(len(result), 2)
+        self.assertIn('nInserted', result[0]['result']['pretty'])
+        self.assertEqual(result[1]['error']['error'], 500)
+        self.assertEqual(self.db_collection.find().count(), 1)
+
+    def test_invalid_batch(self):
+        self.make_batch_request([self.op('eval')], expected_status=400)
+        self.make_batch_request([{'op': 'count'}], expected_status=400)
+
+        max_ops = self.real_app.config['BATCH_MAX_OPERATIONS']
+        operations = [self.op('count')] * (max_ops + 1)
+        self.make_batch_request(operations, expected_status=400)
+
+    def test_batch_is_ratelimited_per_operation(self):
+        old_limits = self.real_app.config['RATELIMIT_LIMITS']
+        self.real_app.config['RATELIMIT_LIMITS'] = {'write': {'quota': 2}}
+        try:
+            operations = [self.op('insert', {'document': {}})] * 3
+            self.make_batch_request(operations, expected_status=429)
+            self.assertEqual(self.db_collection.find().count(), 0)
+        finally:
+            self.real_app.config['RATELIMIT_LIMITS'] = old_limits
+
+
 class GetCollectionNamesUnitTestCase(DBTestCase):
     def test_get_collection_names(self):
         result = self.make_get_collection_names_request()['result']
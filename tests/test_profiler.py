@@ -0,0 +1,86 @@
+#    Copyright 2013 10gen Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import os
+import shutil
+import tempfile
+
+from flask import Flask, json
+
+from webapps.lib import profiler
+from tests import MongoWSTestCase
+
+
+class ProfilerTestCase(MongoWSTestCase):
+    def setUp(self):
+        super(ProfilerTestCase, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.client = self.make_client(0)
+        self.headers = {'X-MWS-Profile': 'secret'}
+
+    def make_client(self, sample_rate):
+        app = Flask(__name__)
+        app.config.update({
+            'PROFILE_DIR': self.directory,
+            'PROFILE_SAMPLE_RATE': sample_rate,
+            'PROFILE_TOKEN': 'secret',
+            'PROFILE_MAX_DUMPS': 3
+        })
+        app.add_url_rule('/work', 'work', lambda: str(sum(xrange(1000))))
+        profiler.init_app(app)
+        return app.test_client()
+
+    def tearDown(self):
+        super(ProfilerTestCase, self).tearDown()
+        shutil.rmtree(self.directory)
+
+    def test_profiles_requests_with_token(self):
+        self.client.get('/work')
+        self.assertEqual(profiler.dumps(self.directory), [])
+        self.client.get('/work', headers={'X-MWS-Profile': 'wrong'})
+        self.assertEqual(profiler.dumps(self.directory), [])
+
+        self.client.get('/work', headers=self.headers)
+        paths = profiler.dumps(self.directory)
+        self.assertEqual(len(paths), 1)
+        self.assertEqual(profiler.endpoint_of(paths[0]), 'work')
+
+    def test_profiles_sample(self):
+        self.make_client(1).get('/work')
+        self.assertEqual(len(profiler.dumps(self.directory)), 1)
+
+    def test_rotates_dumps(self):
+        for _ in xrange(5):
+            self.client.get('/work', headers=self.headers)
+        self.assertEqual(len(profiler.dumps(self.directory)), 3)
+
+    def test_summary(self):
+        rv = self.client.get('/profiles')
+        self.assertEqual(rv.status_code, 403)
+
+        self.client.get('/work', headers=self.headers)
+        self.client.get('/work', headers=self.headers)
+        rv = self.client.get('/profiles', headers=self.headers)
+        self.assertEqual(rv.status_code, 200)
+        summary = json.loads(rv.data)
+        self.assertEqual(summary['work']['requests'], 2)
+        functions = summary['work']['functions']
+        self.assertGreater(len(functions), 0)
+        times = [f['cumulative_time'] for f in functions]
+        self.assertEqual(times, sorted(times, reverse=True))
+
+    def test_dump_names_are_safe(self):
+        name = profiler.dump_name('mws.db-find/x', 1.5)
+        self.assertEqual(name, 'mws.db_find_x-1500-%d.pstats' % os.getpid())
+        self.assertEqual(profiler.endpoint_of(name), 'mws.db_find_x')
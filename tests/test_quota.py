@@ -0,0 +1,114 @@
+#    Copyright 2013 10gen Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+from bson import BSON
+from bson.objectid import ObjectId
+
+from webapps.lib import CLIENTS_COLLECTION, QUOTAS_COLLECTION, quota
+from webapps.lib.db import get_db
+from webapps.lib.MWSServerError import MWSServerError
+from webapps.lib.util import UseResId, collection_cache
+from webapps.server import operations
+from tests import MongoWSTestCase
+
+
+class InsertSizeTestCase(MongoWSTestCase):
+    def test_counts_generated_ids(self):
+        doc = {'name': 'Mongo'}
+        stored = dict(doc, _id=ObjectId())
+        self.assertEqual(quota.insert_size(doc),
+                         (len(BSON.encode(stored)), 1))
+        self.assertEqual(quota.insert_size([stored, stored]),
+                         (2 * len(BSON.encode(stored)), 2))
+
+
+class LedgerTestCase(MongoWSTestCase):
+    def setUp(self):
+        super(LedgerTestCase, self).setUp()
+        self.old_quota = self.real_app.config['QUOTA_COLLECTION_SIZE']
+        self.res_id = 'quotaresid.'
+        self.db = get_db()
+        self.db[CLIENTS_COLLECTION].remove({'res_id': self.res_id})
+        self.db[CLIENTS_COLLECTION].insert({'res_id': self.res_id,
+                                            'collections': []})
+        self.db[QUOTAS_COLLECTION].remove({'res_id': self.res_id})
+        collection_cache.clear()
+
+    def tearDown(self):
+        super(LedgerTestCase, self).tearDown()
+        self.real_app.config['QUOTA_COLLECTION_SIZE'] = self.old_quota
+        with UseResId(self.res_id) as db:
+            db.drop_database()
+        self.db[CLIENTS_COLLECTION].remove({'res_id': self.res_id})
+
+    def test_reserve_enforces_quota(self):
+        self.real_app.config['QUOTA_COLLECTION_SIZE'] = 100
+        with UseResId(self.res_id) as db:
+            quota.reserve(db.foo, 60, 1)
+            quota.reserve(db.foo, 40, 1)
+            with self.assertRaises(MWSServerError) as cm:
+                quota.reserve(db.foo, 1)
+            self.assertEqual(cm.exception.error, 403)
+            self.assertEqual(quota.usage(db.foo), (100, 2))
+
+            quota.release_removed(db.foo, 1)
+            self.assertEqual(quota.usage(db.foo), (50, 1))
+
+    def test_seeds_and_reconciles_from_collstats(self):
+        with UseResId(self.res_id) as db:
+            db.foo.insert([{'val': i} for i in xrange(5)])
+            stats = self.db.command({'collstats': db.foo.name})
+            self.assertEqual(quota.usage(db.foo),
+                             (stats['size'], stats['count']))
+
+            quota.adjust(db.foo, 1000, 10)
+            self.assertGreater(quota.reconcile(self.db, 1000), 0)
+            self.assertEqual(quota.usage(db.foo),
+                             (stats['size'], stats['count']))
+
+            db.drop_collection('foo')
+            self.assertIsNone(
+                self.db[QUOTAS_COLLECTION].find_one({'_id': db.foo.name}))
+
+    def test_updates_charge_the_documents_written(self):
+        self.real_app.config['QUOTA_COLLECTION_SIZE'] = 5000
+        update = {'$set': {'tag': 'x' * 100}}
+        size = operations.calculate_document_size(update)
+        with UseResId(self.res_id) as db:
+            db.foo.insert([{'val': i} for i in xrange(100)])
+            before = quota.usage(db.foo)
+            # Reserving for every document would go over quota
+            operations.update(self.res_id, 'foo', {
+                'query': {'val': {'$lt': 3}},
+                'update': update,
+                'multi': True
+            })
+            self.assertEqual(quota.usage(db.foo), (before[0] + 3 * size,
+                                                   before[1]))
+
+            operations.update(self.res_id, 'foo', {
+                'query': {'val': -1},
+                'update': update
+            })
+            self.assertEqual(quota.usage(db.foo), (before[0] + 3 * size,
+                                                   before[1]))
+
+    def test_removes_use_the_cached_figures(self):
+        with UseResId(self.res_id) as db:
+            quota.reserve(db.foo, 100, 2)
+            # Not read back: the average comes from the reservation
+            self.db[QUOTAS_COLLECTION].update(
+                {'_id': db.foo.name}, {'$set': {'size': 1000}})
+            quota.release_removed(db.foo, 1)
+            self.assertEqual(quota.usage(db.foo), (950, 1))
@@ -0,0 +1,139 @@
+#    Copyright 2013 10gen Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+from datetime import datetime, timedelta
+
+import mock
+from flask import session
+
+from webapps.lib.db import get_db
+from webapps.lib.decorators import ratelimit
+from webapps.lib.MWSServerError import MWSServerError
+from webapps.lib.ratelimit import (
+    MongoRateLimiter,
+    TokenBucketRateLimiter,
+    get_limits
+)
+from tests import MongoWSTestCase
+
+
+class TokenBucketTestCase(MongoWSTestCase):
+    @mock.patch('webapps.lib.ratelimit.time')
+    def test_refills_over_time(self, time_mock):
+        limiter = TokenBucketRateLimiter()
+        time_mock.time.return_value = 1000
+        for i in range(3):
+            self.assertTrue(limiter.hit('key', 3, 30))
+        self.assertFalse(limiter.hit('key', 3, 30))
+        self.assertTrue(limiter.hit('other', 3, 30))
+
+        # One token comes back every 10 seconds
+        time_mock.time.return_value = 1010
+        self.assertTrue(limiter.hit('key', 3, 30))
+        self.assertFalse(limiter.hit('key', 3, 30))
+
+    @mock.patch('webapps.lib.ratelimit.time')
+    def test_charges_cost(self, time_mock):
+        limiter = TokenBucketRateLimiter()
+        time_mock.time.return_value = 1000
+        self.assertFalse(limiter.hit('key', 3, 30, cost=4))
+        self.assertTrue(limiter.hit('key', 3, 30, cost=2))
+        self.assertFalse(limiter.hit('key', 3, 30, cost=2))
+        self.assertTrue(limiter.hit('key', 3, 30))
+
+    @mock.patch('webapps.lib.ratelimit.time')
+    def test_prunes_idle_buckets(self, time_mock):
+        limiter = TokenBucketRateLimiter()
+        limiter.max_buckets = 2
+        time_mock.time.return_value = 1000
+        limiter.hit('a', 3, 30)
+        limiter.hit('b', 3, 30)
+        time_mock.time.return_value = 1031
+        limiter.hit('c', 3, 30)
+        self.assertEqual(limiter._buckets.keys(), ['c'])
+
+
+class MongoRateLimiterTestCase(MongoWSTestCase):
+    def setUp(self):
+        super(MongoRateLimiterTestCase, self).setUp()
+        self.coll = get_db()[self.real_app.config['RATELIMIT_COLLECTION']]
+        self.coll.remove({'_id': {'$regex': '^test_key:'}})
+
+    def tearDown(self):
+        super(MongoRateLimiterTestCase, self).tearDown()
+        self.coll.remove({'_id': {'$regex': '^test_key:'}})
+
+    @mock.patch('webapps.lib.ratelimit.time')
+    def test_counts_per_window(self, time_mock):
+        limiter = MongoRateLimiter(self.coll.name)
+        time_mock.time.return_value = 600
+        self.assertTrue(limiter.hit('test_key', 2, 60))
+        self.assertTrue(limiter.hit('test_key', 2, 60))
+        self.assertFalse(limiter.hit('test_key', 2, 60))
+
+        time_mock.time.return_value = 660
+        self.assertTrue(limiter.hit('test_key', 2, 60))
+        self.assertEqual(
+            self.coll.find({'_id': {'$regex': '^test_key:'}}).count(), 2)
+
+    def test_windows_expire_in_utc(self):
+        limiter = MongoRateLimiter(self.coll.name)
+        before = datetime.utcnow()
+        limiter.hit('test_key', 2, 60)
+        doc = self.coll.find_one({'_id': {'$regex': '^test_key:'}})
+        # The TTL index compares expires with the current UTC time
+        self.assertGreaterEqual(doc['expires'],
+                                before + timedelta(seconds=60))
+        self.assertLessEqual(doc['expires'],
+                             datetime.utcnow() + timedelta(seconds=60))
+
+
+class RatelimitDecoratorTestCase(MongoWSTestCase):
+    def setUp(self):
+        super(RatelimitDecoratorTestCase, self).setUp()
+        self.old_limits = self.real_app.config['RATELIMIT_LIMITS']
+
+    def tearDown(self):
+        super(RatelimitDecoratorTestCase, self).tearDown()
+        self.real_app.config['RATELIMIT_LIMITS'] = self.old_limits
+
+    def test_uses_endpoint_class_limits(self):
+        config = {
+            'RATELIMIT_QUOTA': 10,
+            'RATELIMIT_EXPIRY': 60,
+            'RATELIMIT_LIMITS': {'write': {'quota': 2}}
+        }
+        self.assertEqual(get_limits(config), (10, 60))
+        self.assertEqual(get_limits(config, 'read'), (10, 60))
+        self.assertEqual(get_limits(config, 'write'), (2, 60))
+
+    @mock.patch('webapps.lib.decorators.get_ratelimiter')
+    def test_endpoint_classes_are_limited_separately(self, limiter_mock):
+        hit = limiter_mock.return_value.hit
+        hit.return_value = True
+        self.real_app.config['RATELIMIT_LIMITS'] = {'write': {'quota': 2}}
+
+        @ratelimit(endpoint_class='write')
+        def dummy():
+            return ('', 204)
+
+        with self.real_app.test_request_context():
+            session['session_id'] = 'sess'
+            self.assertEqual(dummy(), ('', 204))
+            hit.assert_called_once_with('write:sess', 2, mock.ANY, 1)
+
+            hit.return_value = False
+            with self.assertRaises(MWSServerError) as cm:
+                dummy()
+            self.assertEqual(cm.exception.error, 429)
@@ -0,0 +1,104 @@
+#    Copyright 2013 10gen Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import sys
+import types
+
+import mock
+
+from webapps.ivs.initializers import pool
+from webapps.lib import CLIENTS_COLLECTION, LEASES_COLLECTION
+from webapps.lib.db import get_db
+from webapps.lib.util import UseResId, get_collection_names
+from tests import MongoWSTestCase
+
+SCRIPTS = 'webapps.ivs.initializers.scripts'
+
+
+def run(res_id, request):
+    with UseResId(res_id) as db:
+        db.drop_database()
+        db.people.insert([{'name': 'Ada'}, {'name': 'Grace'}])
+        db.places.insert({'name': 'London'})
+
+
+class SandboxPoolTestCase(MongoWSTestCase):
+    def setUp(self):
+        super(SandboxPoolTestCase, self).setUp()
+        scripts = types.ModuleType(SCRIPTS)
+        scripts.__path__ = []
+        script = types.ModuleType(SCRIPTS + '.pooled')
+        script.run = run
+        self.modules = mock.patch.dict(
+            sys.modules, {SCRIPTS: scripts, SCRIPTS + '.pooled': script})
+        self.modules.start()
+
+        self.db = get_db()
+        self.clients = self.db[CLIENTS_COLLECTION]
+        self.res_id = 'sandboxstudent'
+        self.clients.insert({'res_id': self.res_id, 'session_id': 'student',
+                             'collections': []})
+        self.db[LEASES_COLLECTION].remove({'_id': 'sandbox_pool.pooled'})
+        self.config = {'SANDBOX_POOL': {'pooled': 2}}
+
+    def tearDown(self):
+        super(SandboxPoolTestCase, self).tearDown()
+        self.modules.stop()
+        for sandbox in self.clients.find({'sandbox': 'pooled'}):
+            pool.discard(sandbox['res_id'])
+        with UseResId(self.res_id) as db:
+            db.drop_database()
+        self.clients.remove({'res_id': self.res_id})
+
+    def test_refill_builds_missing_sandboxes(self):
+        self.assertEqual(pool.refill(self.config), 2)
+        self.assertEqual(pool.refill(self.config), 0)
+        sandboxes = list(self.clients.find({'sandbox': 'pooled'}))
+        self.assertEqual([s['sandbox_state'] for s in sandboxes],
+                         ['ready', 'ready'])
+        self.assertItemsEqual(sandboxes[0]['collections'],
+                              ['people', 'places'])
+
+    def test_claim_moves_collections(self):
+        self.assertFalse(pool.claim('pooled', self.res_id))
+        pool.refill(self.config)
+        with UseResId(self.res_id) as db:
+            db.people.insert({'name': 'Stale'})
+
+        self.assertTrue(pool.claim('pooled', self.res_id))
+        self.assertItemsEqual(get_collection_names(self.res_id),
+                              ['people', 'places'])
+        with UseResId(self.res_id) as db:
+            self.assertEqual(db.people.count(), 2)
+            self.assertEqual(db.places.count(), 1)
+        self.assertEqual(self.clients.find({'sandbox': 'pooled'}).count(), 1)
+
+    def test_failed_claims_leave_nothing_behind(self):
+        pool.refill(self.config)
+        self.real_app.config['QUOTA_NUM_COLLECTIONS'] = 1
+        try:
+            self.assertFalse(pool.claim('pooled', self.res_id))
+        finally:
+            self.real_app.config['QUOTA_NUM_COLLECTIONS'] = None
+        self.assertEqual(get_collection_names(self.res_id), [])
+        with UseResId(self.res_id) as db:
+            self.assertEqual(db.people.count(), 0)
+            self.assertEqual(db.places.count(), 0)
+        self.assertEqual(self.clients.find({'sandbox': 'pooled'}).count(), 1)
+
+    def test_failed_builds_are_discarded(self):
+        with mock.patch.object(sys.modules[SCRIPTS + '.pooled'], 'run',
+                               side_effect=IOError('missing data')):
+            self.assertEqual(pool.refill(self.config), 0)
+        self.assertEqual(self.clients.find({'sandbox': 'pooled'}).count(), 0)
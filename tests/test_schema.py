@@ -0,0 +1,81 @@
+#    Copyright 2013 10gen Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import mock
+
+from webapps.lib import CLIENTS_COLLECTION
+from webapps.lib.db import get_db
+from webapps.lib.schema import declared_indexes, ensure_indexes, index_drift
+from tests import MongoWSTestCase
+
+
+class IndexDriftTestCase(MongoWSTestCase):
+    def fake_db(self, indexes):
+        db = mock.MagicMock()
+        db.__getitem__.side_effect = lambda name: mock.Mock(**{
+            'index_information.return_value': indexes.get(name, {})
+        })
+        return db
+
+    def test_reports_drift(self):
+        config = self.real_app.config
+        ratelimit = config['RATELIMIT_COLLECTION']
+        indexes = {
+            CLIENTS_COLLECTION: {
+                '_id_': {'key': [('_id', 1)]},
+                'session_id_1': {'key': [('session_id', 1)]},
+                'res_id_1': {'key': [('res_id', 1)]},
+                'timestamp_1': {'key': [('timestamp', 1)]},
+                'sandbox_1_sandbox_state_1': {
+                    'key': [('sandbox', 1), ('sandbox_state', 1)],
+                    'sparse': True},
+                'version_1': {'key': [('version', 1)]},
+            },
+            ratelimit: {
+                'expires_1': {'key': [('expires', 1)]},
+            },
+        }
+        drift = index_drift(self.fake_db(indexes), config)
+
+        self.assertIn((CLIENTS_COLLECTION, 'undeclared', [('version', 1)]),
+                      drift)
+        self.assertIn((ratelimit, 'mismatched', [('expires', 1)]), drift)
+        self.assertNotIn(CLIENTS_COLLECTION,
+                         [c for c, problem, _ in drift if problem != 'undeclared'])
+        missing = [c for c, problem, _ in drift if problem == 'missing']
+        self.assertEqual(len(missing),
+                         sum(len(specs) for c, specs in
+                             declared_indexes(config).iteritems()
+                             if c not in indexes))
+
+
+class EnsureIndexesTestCase(MongoWSTestCase):
+    def test_builds_declared_indexes(self):
+        db = get_db()
+        config = self.real_app.config
+        self.assertEqual(ensure_indexes(db, config), 0)
+        # Building again changes nothing
+        self.assertEqual(ensure_indexes(db, config), 0)
+        drift = index_drift(db, config)
+        self.assertEqual([d for d in drift if d[1] != 'undeclared'], [])
+
+    def test_builds_in_the_background(self):
+        db = mock.MagicMock()
+        config = self.real_app.config
+        self.assertEqual(ensure_indexes(db, config), 0)
+        calls = db.__getitem__.return_value.create_index.call_args_list
+        self.assertEqual(len(calls), sum(
+            len(specs) for specs in declared_indexes(config).itervalues()))
+        for args, kwargs in calls:
+            self.assertTrue(kwargs['background'])
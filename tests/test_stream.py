@@ -0,0 +1,166 @@
+#    Copyright 2013 10gen Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+from StringIO import StringIO
+
+from bson import BSON
+from bson.errors import InvalidBSON
+from bson.json_util import dumps
+from bson.objectid import ObjectId
+import mock
+import os
+import shutil
+import tempfile
+from unittest2 import TestCase
+from werkzeug.exceptions import InternalServerError, NotFound
+
+from webapps.ivs.initializers import stream
+from webapps.ivs.initializers.util import (load_data_from_json,
+    load_data_from_mongodump, load_data_from_mongoexport)
+from webapps.lib import CLIENTS_COLLECTION
+from webapps.lib.db import get_db
+from webapps.lib.util import UseResId
+from tests import MongoWSTestCase
+
+DOCUMENTS = [
+    {'_id': ObjectId(), 'name': 'Ada', 'tags': ['math', 'engines']},
+    {'_id': 2, 'name': 'Grace', 'nested': {'n': 1.5, 'ok': True}},
+    {'_id': 3, 'name': 'Barbara "Liskov"', 'none': None, 'n': 12345},
+]
+
+
+# Small reads so that values span several chunks
+@mock.patch('webapps.ivs.initializers.stream.READ_SIZE', 7)
+class StreamTestCase(TestCase):
+    def test_reads_lines(self):
+        text = '\n'.join(dumps(doc) for doc in DOCUMENTS) + '\n\n'
+        self.assertEqual(list(stream.read_mongoexport(StringIO(text))),
+                         DOCUMENTS)
+
+    def test_reads_arrays(self):
+        text = '  ' + dumps(DOCUMENTS)
+        self.assertEqual(list(stream.read_mongoexport(StringIO(text))),
+                         DOCUMENTS)
+        self.assertEqual(list(stream.read_mongoexport(StringIO('[ ]'))), [])
+
+    def test_reads_collections(self):
+        text = dumps({'people': DOCUMENTS, 'empty': [], 'one': [{'a': 1}]})
+        collections = [(name, list(docs)) for name, docs in
+                       stream.read_collections(StringIO(text))]
+        self.assertItemsEqual(collections, [('people', DOCUMENTS),
+                                            ('empty', []),
+                                            ('one', [{'a': 1}])])
+
+    def test_rejects_truncated_files(self):
+        text = dumps(DOCUMENTS)[:-20]
+        with self.assertRaises(ValueError):
+            list(stream.read_mongoexport(StringIO(text)))
+
+    def test_batches_by_count_and_size(self):
+        documents = [{'i': i} for i in xrange(5)]
+        self.assertEqual([len(b) for b in stream.batches(documents, size=2)],
+                         [2, 2, 1])
+        size = len(BSON.encode({'i': 0}))
+        self.assertEqual([len(b) for b in
+                          stream.batches(documents, max_bytes=size * 3)],
+                         [3, 2])
+
+    def test_reads_bson(self):
+        dump = ''.join(BSON.encode(doc) for doc in DOCUMENTS)
+        with tempfile.TemporaryFile() as f:
+            f.write(dump)
+            f.flush()
+            mapped = list(stream.read_bson(f))
+        self.assertEqual([BSON(raw).decode() for raw in mapped], DOCUMENTS)
+        self.assertEqual(list(stream.read_bson(StringIO(dump))), mapped)
+        with tempfile.TemporaryFile() as f:
+            self.assertEqual(list(stream.read_bson(f)), [])
+
+    def test_rejects_truncated_bson(self):
+        dump = ''.join(BSON.encode(doc) for doc in DOCUMENTS)[:-3]
+        with self.assertRaises(InvalidBSON):
+            list(stream.read_bson(StringIO(dump)))
+        with tempfile.TemporaryFile() as f:
+            f.write(dump)
+            f.flush()
+            with self.assertRaises(InvalidBSON):
+                list(stream.read_bson(f))
+
+    def test_raw_batches(self):
+        documents = [BSON.encode({'i': i}) for i in xrange(5)]
+        self.assertEqual([len(b) for b in
+                          stream.raw_batches(documents, size=2)], [2, 2, 1])
+        self.assertEqual([len(b) for b in stream.raw_batches(
+            documents, max_bytes=len(documents[0]) * 3)], [3, 2])
+
+    def test_without_id(self):
+        documents = stream.without_id(dict(doc) for doc in DOCUMENTS)
+        self.assertTrue(all('_id' not in doc for doc in documents))
+
+
+class LoaderTestCase(MongoWSTestCase):
+    def setUp(self):
+        super(LoaderTestCase, self).setUp()
+        self.data_dir = tempfile.mkdtemp()
+        self.old_data_dir = self.real_app.config.get('DATA_DIR')
+        self.real_app.config['DATA_DIR'] = self.data_dir
+        self.res_id = 'streamloader'
+        get_db()[CLIENTS_COLLECTION].insert({'res_id': self.res_id,
+                                             'collections': []})
+
+    def tearDown(self):
+        super(LoaderTestCase, self).tearDown()
+        self.real_app.config['DATA_DIR'] = self.old_data_dir
+        shutil.rmtree(self.data_dir)
+        with UseResId(self.res_id) as db:
+            db.drop_database()
+        get_db()[CLIENTS_COLLECTION].remove({'res_id': self.res_id})
+
+    def write(self, name, text):
+        with open(os.path.join(self.data_dir, name), 'w') as f:
+            f.write(text)
+
+    @mock.patch('webapps.ivs.initializers.stream.INSERT_BATCH_SIZE', 2)
+    def test_loads_in_batches(self):
+        self.write('people.json', '\n'.join(dumps(doc) for doc in DOCUMENTS))
+        self.write('all.json', dumps({'places': [{'_id': 1}, {'_id': 2}]}))
+        load_data_from_mongoexport(self.res_id, 'people.json', 'people',
+                                   remove_id=True)
+        load_data_from_json(self.res_id, 'all.json')
+        with UseResId(self.res_id) as db:
+            self.assertEqual(db.people.count(), 3)
+            self.assertIsNone(db.people.find_one({'_id': 2}))
+            self.assertEqual(db.places.count(), 2)
+
+    def test_loads_dumps_and_indexes(self):
+        self.write('people.bson',
+                   ''.join(BSON.encode(doc) for doc in DOCUMENTS))
+        self.write('people.metadata.json', """{"options": {}, "indexes": [
+            {"v": 1, "key": {"_id": 1}, "name": "_id_", "ns": "test.people"},
+            {"v": 1, "key": {"name": 1, "n": -1}, "name": "name_1_n_-1",
+             "ns": "test.people", "sparse": true}]}""")
+        load_data_from_mongodump(self.res_id, 'people.bson', 'people')
+        with UseResId(self.res_id) as db:
+            self.assertEqual(list(db.people.find().sort('_id', 1)),
+                             sorted(DOCUMENTS, key=lambda d: d['_id']))
+            info = db.people.coll.index_information()['name_1_n_-1']
+            self.assertEqual(info['key'], [('name', 1), ('n', -1)])
+            self.assertTrue(info['sparse'])
+
+    def test_rejects_bad_dumps(self):
+        self.write('bad.bson', BSON.encode(DOCUMENTS[0])[:-1])
+        with self.assertRaises(NotFound):
+            load_data_from_mongodump(self.res_id, 'missing.bson', 'bad')
+        with self.assertRaises(InternalServerError):
+            load_data_from_mongodump(self.res_id, 'bad.bson', 'bad')
@@ -0,0 +1,113 @@
+#    Copyright 2013 10gen Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import os
+import shutil
+import tempfile
+
+from bson.json_util import dumps
+import mock
+
+from webapps.ivs.initializers import templates
+from webapps.ivs.initializers.util import load_data_from_mongoexport
+from webapps.lib import CLIENTS_COLLECTION, TEMPLATES_COLLECTION
+from webapps.lib.db import get_db
+from webapps.lib.util import UseResId, collection_cache, to_coll_name
+from tests import MongoWSTestCase
+
+
+class TemplatesTestCase(MongoWSTestCase):
+    def setUp(self):
+        super(TemplatesTestCase, self).setUp()
+        self.data_dir = tempfile.mkdtemp()
+        self.old_data_dir = self.real_app.config.get('DATA_DIR')
+        self.real_app.config['DATA_DIR'] = self.data_dir
+        self.db = get_db()
+        self.res_ids = ['templatesa', 'templatesb']
+        for res_id in self.res_ids:
+            self.db[CLIENTS_COLLECTION].insert({'res_id': res_id,
+                                                'collections': []})
+        collection_cache.clear()
+        self.loads = []
+        self.write([{'_id': i, 'zip': '%05d' % i} for i in xrange(3)], 1000)
+
+    def tearDown(self):
+        super(TemplatesTestCase, self).tearDown()
+        self.real_app.config['DATA_DIR'] = self.old_data_dir
+        shutil.rmtree(self.data_dir)
+        for res_id in self.res_ids:
+            with UseResId(res_id) as db:
+                db.drop_database()
+            self.db[CLIENTS_COLLECTION].remove({'res_id': res_id})
+        template = self.db[TEMPLATES_COLLECTION].find_one({'_id': 'zips'})
+        if template is not None:
+            for name in template['collections']:
+                self.db.drop_collection(to_coll_name(template['res_id'],
+                                                     name))
+        self.db[TEMPLATES_COLLECTION].remove({'_id': 'zips'})
+
+    def write(self, documents, mtime):
+        path = os.path.join(self.data_dir, 'zips.json')
+        with open(path, 'w') as f:
+            f.write('\n'.join(dumps(doc) for doc in documents))
+        os.utime(path, (mtime, mtime))
+
+    def load(self, res_id):
+        self.loads.append(res_id)
+        load_data_from_mongoexport(res_id, 'zips.json', 'zips')
+        with UseResId(res_id) as db:
+            db.zips.coll.create_index('zip', sparse=True)
+
+    def clone(self, res_id):
+        return templates.clone(res_id, 'zips', self.load,
+                               datasets=['zips.json'])
+
+    def test_builds_once_and_clones(self):
+        self.assertTrue(self.clone('templatesa'))
+        self.assertTrue(self.clone('templatesb'))
+        self.assertEqual(len(self.loads), 1)
+        self.assertTrue(self.loads[0].startswith(templates.TEMPLATE_PREFIX))
+
+        for res_id in self.res_ids:
+            with UseResId(res_id) as db:
+                self.assertEqual(db.zips.count(), 3)
+                self.assertEqual(db.zips.find_one({'_id': 1})['zip'],
+                                 '00001')
+                info = db.zips.coll.index_information()
+                self.assertTrue(info['zip_1']['sparse'])
+            clients = self.db[CLIENTS_COLLECTION].find_one({'res_id': res_id})
+            self.assertEqual(clients['collections'], ['zips'])
+
+    def test_rebuilds_changed_datasets(self):
+        self.clone('templatesa')
+        old = self.db[TEMPLATES_COLLECTION].find_one({'_id': 'zips'})
+        self.write([{'_id': 'new'}], 2000)
+        self.clone('templatesb')
+        self.assertEqual(len(self.loads), 2)
+        with UseResId('templatesb') as db:
+            self.assertEqual(list(db.zips.find()), [{'_id': 'new'}])
+        names = self.db.collection_names()
+        self.assertNotIn(to_coll_name(old['res_id'], 'zips'), names)
+
+    @mock.patch('webapps.ivs.initializers.templates.leases.acquire')
+    def test_loads_directly_while_another_builds(self, acquire_mock):
+        acquire_mock.return_value = False
+        self.real_app.config['TEMPLATE_BUILD_WAIT'] = 0
+        try:
+            self.assertFalse(self.clone('templatesa'))
+        finally:
+            self.real_app.config.pop('TEMPLATE_BUILD_WAIT', None)
+        self.assertEqual(self.loads, ['templatesa'])
+        with UseResId('templatesa') as db:
+            self.assertEqual(db.zips.count(), 3)
@@ -17,13 +17,22 @@ from bson.json_util import dumps
 import mock
 from werkzeug.exceptions import NotFound, InternalServerError
 from webapps.lib.db import get_db
-from webapps.lib.util import UseResId, get_collection_names
+from webapps.lib.util import (
+    UseResId,
+    collection_cache,
+    get_collection_names,
+    to_coll_name
+)
 from webapps.lib import CLIENTS_COLLECTION
 from webapps.lib.MWSServerError import MWSServerError
 from tests import MongoWSTestCase
 
 
 class UseResIdTestCase(MongoWSTestCase):
+    def setUp(self):
+        super(UseResIdTestCase, self).setUp()
+        collection_cache.clear()
+
     def test_mangles_collection_names_automatically(self):
         with self.real_app.app_context():
             with UseResId('myresid.') as db:
@@ -59,6 +68,56 @@ class UseResIdTestCase(MongoWSTestCase):
                 self.assertItemsEqual(get_collection_names(res_id), ['bar'])
                 self.assertNotIn(res_id + 'foo', get_collection_names(res_id))
 
+    def test_reads_do_not_register_collections(self):
+        with self.real_app.app_context():
+            db = get_db()
+            res_id = 'myresid.'
+            clients_collection = db[CLIENTS_COLLECTION]
+            clients_collection.remove({'res_id': res_id})
+            clients_collection.insert({'res_id': res_id, 'collections': []})
+            db[to_coll_name(res_id, 'foo')].insert({'message': 'hidden'})
+
+            with UseResId(res_id) as wrapped:
+                foo = wrapped.foo
+                with mock.patch.object(foo, 'coll') as coll_mock:
+                    self.assertIsNone(foo.find_one())
+                    self.assertEqual(foo.find().count(), 0)
+                    self.assertEqual(foo.remove({})['n'], 0)
+                    self.assertEqual(foo.size(), 0)
+                    self.assertEqual(coll_mock.method_calls, [])
+                self.assertItemsEqual(get_collection_names(res_id), [])
+
+                # A collection registered elsewhere is picked up even though
+                # the cached names do not include it yet
+                clients_collection.update(
+                    {'res_id': res_id}, {'$addToSet': {'collections': 'foo'}})
+                self.assertEqual(wrapped.foo.find_one({}, {'_id': 0}),
+                                 {'message': 'hidden'})
+
+            db[to_coll_name(res_id, 'foo')].drop()
+
+    def test_writes_only_register_new_collections(self):
+        with self.real_app.app_context():
+            db = get_db()
+            res_id = 'myresid.'
+            clients_collection = db[CLIENTS_COLLECTION]
+            clients_collection.remove({'res_id': res_id})
+            clients_collection.insert({'res_id': res_id, 'collections': []})
+
+            with UseResId(res_id) as wrapped:
+                wrapped.foo.insert({'message': 'first'})
+                with mock.patch('webapps.lib.metrics.inc') as inc:
+                    wrapped.foo.insert({'message': 'second'})
+                registry_calls = [c for c in inc.call_args_list
+                                  if c[1].get('source') == 'registry']
+                self.assertEqual(registry_calls, [])
+
+                # Dropping it here invalidates the cached names
+                wrapped.drop_collection('foo')
+                wrapped.foo.insert({'message': 'third'})
+                self.assertItemsEqual(get_collection_names(res_id), ['foo'])
+                wrapped.drop_collection('foo')
+
 
 class QuotaCollectionsTestCase(UseResIdTestCase):
     def setUp(self):
@@ -67,8 +126,11 @@ class QuotaCollectionsTestCase(UseResIdTestCase):
         self.res_id = 'myresid.'
         with self.real_app.app_context():
             collections = get_collection_names(self.res_id)
+            if collections is None:
+                get_db()[CLIENTS_COLLECTION].insert(
+                    {'res_id': self.res_id, 'collections': []})
             with UseResId(self.res_id) as db:
-                for c in collections:
+                for c in collections or []:
                     db.drop_collection(c)
 
     def tearDown(self):
@@ -0,0 +1,101 @@
+#    Copyright 2013 10gen Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+from bson.json_util import dumps, loads
+from flask import session
+import mock
+
+from webapps.lib import CLIENTS_COLLECTION
+from webapps.lib.db import get_db
+from webapps.lib.util import UseResId
+from webapps.server import websocket
+
+from tests import MongoWSTestCase
+
+
+class WebSocketTestCase(MongoWSTestCase):
+    def setUp(self):
+        super(WebSocketTestCase, self).setUp()
+        rv = self.app.post('/mws/')
+        self.res_id = loads(rv.data)['res_id']
+        with self.app.session_transaction() as sess:
+            self.session_id = sess['session_id']
+        self.db = get_db()
+
+    def tearDown(self):
+        super(WebSocketTestCase, self).tearDown()
+        with UseResId(self.res_id) as db:
+            db.drop_database()
+
+    def dispatch(self, command):
+        with self.real_app.test_request_context():
+            session['session_id'] = self.session_id
+            if not isinstance(command, basestring):
+                command = dumps(command)
+            return websocket.dispatch(self.res_id, self.session_id, command)
+
+    def test_runs_operations(self):
+        reply = self.dispatch({'id': 1, 'op': 'insert', 'collection': 'foo',
+                               'params': {'document': [{'a': 1}, {'a': 2}]}})
+        self.assertEqual(reply['id'], 1)
+        self.assertNotIn('error', reply)
+
+        reply = self.dispatch({'id': 2, 'op': 'count', 'collection': 'foo',
+                               'params': {'query': {'a': 1}}})
+        self.assertEqual(reply, {'id': 2, 'result': {'count': 1}})
+
+    def test_reports_errors(self):
+        reply = self.dispatch('{not json')
+        self.assertIsNone(reply['id'])
+        self.assertEqual(reply['error']['error'], 400)
+
+        reply = self.dispatch({'id': 3, 'op': 'eval', 'collection': 'foo'})
+        self.assertEqual(reply['id'], 3)
+        self.assertEqual(reply['error']['reason'], 'Invalid command')
+
+        reply = self.dispatch({'id': 4, 'op': 'next', 'collection': 'foo',
+                               'params': {'cursor_id': 1234, 'retrieved': 0}})
+        self.assertEqual(reply['id'], 4)
+        self.assertIn('error', reply)
+
+    def test_closes_once_access_is_revoked(self):
+        command = {'id': 5, 'op': 'insert', 'collection': 'foo',
+                   'params': {'document': {'a': 1}}}
+        self.assertNotIn('error', self.dispatch(command))
+        socket = mock.Mock()
+        self.assertFalse(websocket.close_if_revoked(socket, self.res_id,
+                                                    self.session_id))
+
+        # The answer cached when the socket was opened is not trusted
+        self.db[CLIENTS_COLLECTION].update(
+            {'res_id': self.res_id}, {'$set': {'session_id': 'expired'}})
+        with self.assertRaises(websocket.AccessRevoked) as cm:
+            self.dispatch(command)
+        self.assertEqual(cm.exception.command_id, 5)
+        self.assertTrue(websocket.close_if_revoked(socket, self.res_id,
+                                                   self.session_id))
+        socket.close.assert_called_once_with()
+
+        # Reads are not checked again
+        reply = self.dispatch({'id': 6, 'op': 'count', 'collection': 'foo'})
+        self.assertNotIn('error', reply)
+
+    def test_requires_a_websocket(self):
+        rv = self.app.get('/mws/%s/ws' % self.res_id)
+        self.assertEqual(rv.status_code, 400)
+
+        with self.app.session_transaction() as sess:
+            sess['session_id'] = 'someone else'
+        rv = self.app.get('/mws/%s/ws' % self.res_id)
+        self.assertEqual(rv.status_code, 403)
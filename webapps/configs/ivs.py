@@ -20,19 +20,79 @@ SECRET_KEY = 'foo'
 HOST = '0.0.0.0'
 PORT = 8081
 DATA_DIR = '/tmp'
+# Parsed datasets are cached per process, see initializers/datasets.py
+DATASET_CACHE_BYTES = 128 * 1024 * 1024  # BSON bytes held by the cache
+DATASET_CACHE_MAX_FILE = 32 * 1024 * 1024  # larger files are streamed
+
+# SANDBOX_POOL: init script name -> sandboxes kept ready for it, built in
+# the background so that students get the script's collections by rename.
+# Only scripts that build their collections from scratch, whatever the
+# request, may be pooled. See initializers/pool.py.
+SANDBOX_POOL = {}
+SANDBOX_REFILL_EVERY = 10  # seconds between checks of the pools
+# Seconds an init request waits for another process to build a template
+# before loading the datasets itself. See initializers/templates.py.
+TEMPLATE_BUILD_WAIT = 30
 
 # Rate limit settings
+RATELIMIT_BACKEND = 'mongo'  # 'mongo' or 'memory', see configs/server.py
 RATELIMIT_COLLECTION = 'ivs_ratelimit'
 RATELIMIT_QUOTA = 3    # requests per expiry
 RATELIMIT_EXPIRY = 10  # expiry in seconds
+# Per endpoint class overrides of RATELIMIT_QUOTA and RATELIMIT_EXPIRY
+RATELIMIT_LIMITS = {
+    'ivs': {'quota': 3, 'expiry': 10},
+}
 
 # DB Settings
+# DB_ENGINE: 'mongo', or 'memory' to keep all data in the process, with no
+# persistence. The memory engine needs a single worker process.
+DB_ENGINE = 'mongo'
 DB_HOSTS = ['localhost']
 DB_PORT = 27017
 DB_NAME = 'mongows'
+DB_POOL_SIZE = 100  # max sockets per worker for normal traffic
+DB_KEEPALIVE_POOL_SIZE = 50  # max sockets per worker for open cursors
+ENSURE_INDEXES = True  # build missing indexes (see lib/schema.py) at startup
 
 # edX integration
 EDX_SHARED_KEY = 'wanderlust'
 GRADING_SERVER_URL = 'http://localhost'
 GRADING_API_KEY = 'i4mm3'
 GRADING_API_SECRET = 's0s3cr3t'
+# Grades are queued and sent by background workers, see ivs/grading.py
+GRADING_TIMEOUT = 10  # seconds to wait on the grading server per attempt
+GRADING_POOL_SIZE = 10  # connections kept open to it per process
+GRADING_WORKERS = 2  # threads sending grades per process, 0 sends inline
+GRADING_POLL_EVERY = 5  # seconds between checks for grades due
+GRADING_MAX_ATTEMPTS = 8
+GRADING_RETRY_DELAY = 5  # seconds before the first retry, doubled each time
+GRADING_RETRY_MAX_DELAY = 600
+# Seconds /verify waits for a worker in its process to finish the grade
+# before answering 202 with the grade's id to check at /ivs/grades/<id>. 0
+# answers at once. Without workers the grade is sent once inline instead, and
+# retries are sent when /ivs/grades/<id> is checked.
+GRADING_WAIT = 2
+
+# Metrics, served in the Prometheus text format at METRICS_PATH
+METRICS_ENABLED = True
+METRICS_PATH = '/metrics'
+# Scrapes must send "Authorization: Bearer <METRICS_TOKEN>". None serves the
+# metrics to no one.
+METRICS_TOKEN = None
+# METRICS_DIR: a directory shared by the worker processes, so that each
+# scrape reports the totals of all of them. None reports the answering
+# worker only.
+METRICS_DIR = None
+METRICS_FLUSH_EVERY = 5  # seconds between snapshots written to METRICS_DIR
+
+# Profiling: nothing is profiled unless PROFILE_DIR is set
+PROFILE_DIR = None  # directory the pstats dumps are written to
+PROFILE_SAMPLE_RATE = 0  # fraction of requests profiled, 0 to 1
+# Requests whose PROFILE_HEADER is PROFILE_TOKEN are always profiled and may
+# view the summary at PROFILE_SUMMARY_PATH. None disables the header.
+PROFILE_HEADER = 'X-MWS-Profile'
+PROFILE_TOKEN = None
+PROFILE_MAX_DUMPS = 200  # most recent dumps kept
+PROFILE_SUMMARY_PATH = '/profiles'
+PROFILE_SUMMARY_TOP = 25  # functions listed per endpoint
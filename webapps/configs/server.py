@@ -23,19 +23,44 @@ SECRET_KEY = 'foo'
 
 
 #DB Settings
+# DB_ENGINE: 'mongo', or 'memory' to keep all data in the process, with no
+# persistence. The memory engine needs a single worker process.
+DB_ENGINE = 'mongo'
 DB_HOSTS = ["localhost"]
 DB_PORT = 27017
 DB_NAME = 'mongows'
+DB_POOL_SIZE = 100  # max sockets per worker for normal traffic
+DB_KEEPALIVE_POOL_SIZE = 50  # max sockets per worker for open cursors
+ENSURE_INDEXES = True  # build missing indexes (see lib/schema.py) at startup
+# DB_USE_GREENLETS: give each greenlet its own socket; set by async_app,
+# only correct once gevent has patched the standard library
+DB_USE_GREENLETS = False
 
 
 HOST = "0.0.0.0"
 PORT = 5000
+# Requests in progress at once in each webapps.server.async_app process.
+# Requests beyond DB_POOL_SIZE wait for a socket rather than opening more.
+ASYNC_MAX_CONNECTIONS = 10000
 
+# RATELIMIT_BACKEND: where request counts are kept
+# 'mongo': fixed windows in RATELIMIT_COLLECTION, shared by all processes
+# 'memory': token buckets in each worker process
+RATELIMIT_BACKEND = 'mongo'
 RATELIMIT_COLLECTION = 'server_ratelimit'
 RATELIMIT_QUOTA = 500  # requests per expiry
 RATELIMIT_EXPIRY = 60  # expiry in seconds
+# Per endpoint class overrides of RATELIMIT_QUOTA and RATELIMIT_EXPIRY
+RATELIMIT_LIMITS = {
+    'read': {'quota': 500, 'expiry': 60},
+    'write': {'quota': 250, 'expiry': 60},
+}
 
 QUOTA_COLLECTION_SIZE = 5 * 1024 * 1024  # size quota in bytes
+QUOTA_RECONCILE_EVERY = 300  # seconds between checks of the size ledger
+QUOTA_RECONCILE_BATCH_SIZE = 500  # ledger entries checked against collstats
+QUOTA_USAGE_CACHE_SIZE = 10000  # collections whose ledger figures are cached
+QUOTA_USAGE_CACHE_TTL = 60  # seconds before removes read the figures again
 
 # QUOTA_NUM_COLLECTIONS: number of collections per res_id
 # False: unlimited number of collections, no quota
@@ -43,9 +68,61 @@ QUOTA_COLLECTION_SIZE = 5 * 1024 * 1024  # size quota in bytes
 # 1+: user may have up to # collections per res_id
 QUOTA_NUM_COLLECTIONS = 8
 
+# Per process cache of each res_id's collection names, which saves reads of
+# CLIENTS_COLLECTION. Writes always register their collection.
+COLLECTION_CACHE_SIZE = 10000  # res_ids whose collection names are cached
+COLLECTION_CACHE_TTL = 60  # seconds before the names are read again
+# Per process cache of which sessions may use which res_ids. Only reads use
+# it; writes always check CLIENTS_COLLECTION.
+ACCESS_CACHE_SIZE = 10000  # (res_id, session_id) pairs held per process
+ACCESS_CACHE_TTL = 60  # seconds before a cached answer is checked again
+
 # Cursors config
 CURSOR_BATCH_SIZE = 20  # default max docs to return for a query
+CURSOR_DRAIN_BATCH_SIZE = 1000  # docs fetched per getMore when draining
+STREAM_CHUNK_SIZE = 64 * 1024  # bytes buffered before a streamed chunk is sent
+CURSOR_IDLE_TIMEOUT = 300  # seconds before an unused cursor is killed
+CURSOR_REAP_EVERY = 60  # seconds between sweeps for idle cursors
+CURSOR_REAP_BATCH_SIZE = 500  # cursors killed per kill_cursors call
+# CURSOR_LIMIT_PER_RES_ID: open cursors per res_id before the least recently
+# used are killed. False or 0 disables the limit.
+CURSOR_LIMIT_PER_RES_ID = 20
+
+# Scheduled job leases and their last runs, as JSON. None disables it.
+SCHEDULER_STATUS_PATH = '/scheduler'
+# Requests must send "Authorization: Bearer <SCHEDULER_STATUS_TOKEN>". None
+# shows the status to no one.
+SCHEDULER_STATUS_TOKEN = None
+
+BATCH_MAX_OPERATIONS = 100  # operations accepted in one /batch request
+
+# WebSocket channel at /mws/<res_id>/ws, served by async_app only
+WEBSOCKET_ENABLED = False
+WEBSOCKET_KEEP_ALIVE = 60  # seconds between touches of open shells' sessions
 
 # Logging config
 ADMIN_EMAILS = ''
 LOG_FILE_PATH = ''
+
+# Metrics, served in the Prometheus text format at METRICS_PATH
+METRICS_ENABLED = True
+METRICS_PATH = '/metrics'
+# Scrapes must send "Authorization: Bearer <METRICS_TOKEN>". None serves the
+# metrics to no one.
+METRICS_TOKEN = None
+# METRICS_DIR: a directory shared by the worker processes, so that each
+# scrape reports the totals of all of them. None reports the answering
+# worker only.
+METRICS_DIR = None
+METRICS_FLUSH_EVERY = 5  # seconds between snapshots written to METRICS_DIR
+
+# Profiling: nothing is profiled unless PROFILE_DIR is set
+PROFILE_DIR = None  # directory the pstats dumps are written to
+PROFILE_SAMPLE_RATE = 0  # fraction of requests profiled, 0 to 1
+# Requests whose PROFILE_HEADER is PROFILE_TOKEN are always profiled and may
+# view the summary at PROFILE_SUMMARY_PATH. None disables the header.
+PROFILE_HEADER = 'X-MWS-Profile'
+PROFILE_TOKEN = None
+PROFILE_MAX_DUMPS = 200  # most recent dumps kept
+PROFILE_SUMMARY_PATH = '/profiles'
+PROFILE_SUMMARY_TOP = 25  # functions listed per endpoint
@@ -16,9 +16,13 @@ import os
 
 from flask import Flask
 
+from webapps.lib import decorators, metrics, profiler, quota, util
 from webapps.lib.log import configure_logging
 from webapps.lib.conf import update_config
+from webapps.lib.schema import ensure_schema
 from webapps.lib.util import get_environment
+from webapps.ivs import grading
+from webapps.ivs.initializers import datasets, pool
 from webapps.ivs.views import ivs
 
 
@@ -34,6 +38,15 @@ def create_app():
     update_config(app, 'IVS', environment)
     configure_logging(app, environment)
     app.register_blueprint(ivs)
+    util.init_app(app)
+    quota.init_app(app)
+    decorators.init_app(app)
+    metrics.init_app(app)
+    profiler.init_app(app)
+    ensure_schema(app)
+    datasets.init_app(app)
+    pool.init_app(app)
+    grading.init_app(app)
     return app
 
 
@@ -0,0 +1,266 @@
+#    Copyright 2013 10gen Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Grades sent to the grading server through a durable outbox, so that a slow
+or failing grading server never holds up the request threads.
+
+/verify records each grade in GRADES_COLLECTION and wakes the workers,
+daemon threads that claim pending grades with one find_and_modify, post
+them through a pooled session with GRADING_TIMEOUT, and mark them done or
+failed. Connection errors, timeouts and 5xx answers are retried after
+GRADING_RETRY_DELAY seconds, doubled on every attempt up to
+GRADING_RETRY_MAX_DELAY, until GRADING_MAX_ATTEMPTS have been made. Grades
+claimed by a process that died are claimed again once their lock expires.
+A request waiting on its grade is woken by the worker that finishes it,
+rather than reading the grade until it is done.
+
+The grading credentials are added as each grade is sent, and are never
+stored. Finished grades are removed by a TTL index a week after they
+finish.
+"""
+
+from datetime import datetime, timedelta
+import logging
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from webapps.lib import GRADES_COLLECTION, metrics
+from webapps.lib.db import get_db
+
+_logger = logging.getLogger(__name__)
+
+PENDING = 'pending'
+SENDING = 'sending'
+DONE = 'done'
+FAILED = 'failed'
+
+# Seconds past GRADING_TIMEOUT before a grade being sent may be claimed again
+LOCK_GRACE = 30
+
+_session = None
+_session_lock = threading.Lock()
+_workers = None
+# Events for the grades requests in this process are waiting on, by id
+_waiting = {}
+_waiting_lock = threading.Lock()
+
+
+def get_session(config):
+    """Returns the process' session, whose connections to the grading
+    server are kept open between grades."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=config.get('GRADING_POOL_SIZE', 10))
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _session = session
+        return _session
+
+
+def submit(db, config, course_id, problem_id, user_id, results):
+    """Queues results for the grading server. Returns the grade's id."""
+    now = datetime.utcnow()
+    grade_id = db[GRADES_COLLECTION].insert({
+        'url': '{0}/api/v1/grade/{1}/{2}/{3}'.format(
+            config.get('GRADING_SERVER_URL'), course_id, problem_id,
+            user_id),
+        'user_id': user_id,
+        'results': results,
+        'state': PENDING,
+        'attempts': 0,
+        'next_attempt': now,
+        'created': now
+    })
+    wake()
+    return grade_id
+
+
+def claim(db, config, grade_id=None):
+    """
+    Marks the pending grade due the longest, or grade_id if it is due, as
+    being sent by this process. Returns it, or None if there is none.
+    """
+    now = datetime.utcnow()
+    spec = {'$or': [
+        {'state': PENDING, 'next_attempt': {'$lte': now}},
+        {'state': SENDING, 'locked_until': {'$lt': now}},
+    ]}
+    if grade_id is not None:
+        spec['_id'] = grade_id
+    lock = config.get('GRADING_TIMEOUT', 10) + LOCK_GRACE
+    return db[GRADES_COLLECTION].find_and_modify(
+        spec,
+        {'$set': {'state': SENDING,
+                  'locked_until': now + timedelta(seconds=lock)},
+         '$inc': {'attempts': 1}},
+        sort=[('next_attempt', 1)], new=True)
+
+
+def deliver(db, config, grade):
+    """Posts a claimed grade and records the outcome. Returns the grade's
+    new state."""
+    data = dict(grade['results'],
+                api_key=config.get('GRADING_API_KEY'),
+                api_secret=config.get('GRADING_API_SECRET'))
+    start = time.time()
+    try:
+        response = get_session(config).post(
+            grade['url'], data=data,
+            timeout=config.get('GRADING_TIMEOUT', 10))
+    except requests.RequestException as e:
+        return _retry(db, config, grade, str(e))
+    finally:
+        metrics.observe('mws_grading_duration_seconds', time.time() - start)
+    outcome = {'status': response.status_code, 'body': response.text}
+    if response.status_code == 200:
+        return _finish(db, grade, DONE, outcome)
+    if response.status_code >= 500 or response.status_code == 429:
+        return _retry(db, config, grade, 'HTTP %d' % response.status_code,
+                      outcome)
+    return _finish(db, grade, FAILED, outcome)
+
+
+def _update(db, grade, fields):
+    # Unless the lock expired and another process claimed the grade since
+    db[GRADES_COLLECTION].update(
+        {'_id': grade['_id'], 'state': SENDING,
+         'attempts': grade['attempts']},
+        {'$set': fields})
+
+
+def _finish(db, grade, state, outcome, error=None):
+    fields = {'state': state, 'response': outcome, 'finished': datetime.utcnow()}
+    if error is not None:
+        fields['error'] = error
+    _update(db, grade, fields)
+    metrics.inc('mws_grades_total', outcome=state)
+    with _waiting_lock:
+        finished = _waiting.get(grade['_id'])
+    if finished is not None:
+        finished.set()
+    return state
+
+
+def _retry(db, config, grade, error, outcome=None):
+    if grade['attempts'] >= config.get('GRADING_MAX_ATTEMPTS', 8):
+        _logger.error('Giving up on grade %s after %d attempts: %s' %
+                      (grade['_id'], grade['attempts'], error))
+        return _finish(db, grade, FAILED, outcome, error)
+    delay = min(config.get('GRADING_RETRY_DELAY', 5) *
+                2 ** (grade['attempts'] - 1),
+                config.get('GRADING_RETRY_MAX_DELAY', 600))
+    _update(db, grade, {
+        'state': PENDING,
+        'error': error,
+        'next_attempt': datetime.utcnow() + timedelta(seconds=delay)
+    })
+    metrics.inc('mws_grades_total', outcome='retried')
+    return PENDING
+
+
+def wait(db, config, grade_id, timeout):
+    """
+    Returns the grade grade_id once it is done or failed, or None after
+    timeout seconds. Without workers in this process the grade is sent
+    here if it is due, even with a timeout of 0, as nothing else would
+    send it. With workers this waits for one of them to finish the grade,
+    so a grade sent by another process is only seen once it is checked
+    again.
+    """
+    if _workers is None:
+        grade = claim(db, config, grade_id)
+        if grade is not None:
+            deliver(db, config, grade)
+        return _finished(db, grade_id)
+
+    finished = threading.Event()
+    with _waiting_lock:
+        _waiting[grade_id] = finished
+    try:
+        grade = _finished(db, grade_id)
+        if grade is not None or timeout <= 0:
+            return grade
+        if not finished.wait(timeout):
+            return None
+        return _finished(db, grade_id)
+    finally:
+        with _waiting_lock:
+            _waiting.pop(grade_id, None)
+
+
+def _finished(db, grade_id):
+    grade = db[GRADES_COLLECTION].find_one({'_id': grade_id})
+    if grade is None or grade['state'] in (DONE, FAILED):
+        return grade
+    return None
+
+
+class GradingWorkers(object):
+    """Threads sending the grades due, checking for them every
+    GRADING_POLL_EVERY seconds, or as soon as they are woken."""
+
+    def __init__(self, app, count):
+        self.app = app
+        self.count = count
+        self._wake = threading.Event()
+        self._threads = []
+
+    def start(self):
+        for i in xrange(self.count):
+            thread = threading.Thread(target=self._run,
+                                      name='GradingWorker-%d' % i)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def wake(self):
+        self._wake.set()
+
+    def _run(self):
+        config = self.app.config
+        interval = config.get('GRADING_POLL_EVERY', 5)
+        while True:
+            try:
+                with self.app.app_context():
+                    db = get_db()
+                    grade = claim(db, config)
+                    if grade is not None:
+                        deliver(db, config, grade)
+                        continue
+            except Exception:
+                _logger.exception('Could not send grades')
+            self._wake.wait(interval)
+            self._wake.clear()
+
+
+def wake():
+    if _workers is not None:
+        _workers.wake()
+
+
+def init_app(app):
+    """Starts GRADING_WORKERS threads, if it is set."""
+    global _workers
+    count = app.config.get('GRADING_WORKERS', 0)
+    if count:
+        _workers = GradingWorkers(app, count)
+        _workers.start()
@@ -0,0 +1,77 @@
+#    Copyright 2013 10gen Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+A stand-in for the grading server, to try /verify locally and to test the
+grading outbox against. It accepts grades at the URL the real server uses
+and answers each after STUB_LATENCY seconds. A STUB_FAILURE_RATE fraction
+of grades, picked at random, get a STUB_FAILURE_STATUS error instead.
+
+    python -m webapps.ivs.grading_stub --port 8082 --latency 2
+
+then point GRADING_SERVER_URL at http://localhost:8082.
+"""
+
+import argparse
+import random
+import threading
+import time
+
+from flask import Flask, jsonify, request
+from werkzeug.serving import run_simple
+
+
+def create_app(latency=0, failure_rate=0, failure_status=503):
+    app = Flask(__name__)
+    app.config.update(STUB_LATENCY=latency,
+                      STUB_FAILURE_RATE=failure_rate,
+                      STUB_FAILURE_STATUS=failure_status)
+    # Grades accepted so far, as (course_id, problem_id, user_id, form)
+    app.grades = []
+    lock = threading.Lock()
+
+    @app.route('/api/v1/grade/<course_id>/<problem_id>/<user_id>',
+               methods=['POST'])
+    def grade(course_id, problem_id, user_id):
+        time.sleep(app.config['STUB_LATENCY'])
+        if random.random() < app.config['STUB_FAILURE_RATE']:
+            response = jsonify(success=False, msg='Injected failure')
+            response.status_code = app.config['STUB_FAILURE_STATUS']
+            return response
+        with lock:
+            app.grades.append((course_id, problem_id, user_id,
+                               request.form.to_dict()))
+        return jsonify(success=True, course_id=course_id,
+                       problem_id=problem_id, user_id=user_id)
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Serve a stand-in grading server.')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8082)
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds to wait before answering')
+    parser.add_argument('--failure-rate', type=float, default=0,
+                        help='fraction of grades answered with an error')
+    parser.add_argument('--failure-status', type=int, default=503)
+    args = parser.parse_args()
+    app = create_app(args.latency, args.failure_rate, args.failure_status)
+    run_simple(args.host, args.port, app, threaded=True)
+
+
+if __name__ == '__main__':
+    main()
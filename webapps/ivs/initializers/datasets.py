@@ -0,0 +1,97 @@
+#    Copyright 2013 10gen Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+A process-level cache of the datasets loaded by init scripts, so that a file
+is parsed once rather than on every /init request.
+
+Datasets are cached as batches of BSON-encoded documents, which take less
+memory than the parsed documents and are much cheaper to decode than JSON.
+Entries are keyed by the file's path, mtime and size, so editing a dataset
+makes its next load read the new file. The cache holds at most
+DATASET_CACHE_BYTES of BSON, evicting the least recently used datasets, and
+files larger than DATASET_CACHE_MAX_FILE are not cached at all: they are
+streamed into the collection as before.
+"""
+
+import os
+
+from bson import BSON
+from flask import current_app
+
+from webapps.lib import metrics
+from webapps.lib.cache import SizedLRUCache
+from webapps.ivs.initializers import stream
+
+DATASET_CACHE_BYTES = 128 * 1024 * 1024
+DATASET_CACHE_MAX_FILE = 32 * 1024 * 1024
+
+cache = SizedLRUCache(DATASET_CACHE_BYTES)
+metrics.add_collector(metrics.cache_collector('dataset', cache))
+
+
+def encode(documents):
+    """
+    Returns ([batch of BSON strings], bytes) for documents, grouped as
+    stream.batches would group them.
+    """
+    batches = list(stream.raw_batches(BSON.encode(document)
+                                      for document in documents))
+    return batches, sum(len(encoded) for batch in batches
+                        for encoded in batch)
+
+
+def _load(kind, path, parse):
+    """Returns the cached parse(file) of the file at path, or None if the
+    file is too large to be cached."""
+    stat = os.stat(path)
+    max_file = current_app.config.get('DATASET_CACHE_MAX_FILE',
+                                      DATASET_CACHE_MAX_FILE)
+    if stat.st_size > max_file:
+        return None
+    key = (kind, os.path.realpath(path), stat.st_mtime, stat.st_size)
+
+    def loader():
+        with open(path) as f:
+            return parse(f)
+    return cache.load(key, loader)
+
+
+def load_mongoexport(path):
+    """Returns the batches of the mongoexport file at path, or None if it
+    should be streamed instead."""
+    return _load('mongoexport', path,
+                 lambda f: encode(stream.read_mongoexport(f)))
+
+
+def _encode_collections(f):
+    collections = []
+    total = 0
+    for name, documents in stream.read_collections(f):
+        batches, size = encode(documents)
+        collections.append((name, batches))
+        total += size
+    return collections, total
+
+
+def load_collections(path):
+    """Returns [(collection, batches)] for the JSON file at path, or None if
+    it should be streamed instead."""
+    return _load('collections', path, _encode_collections)
+
+
+def init_app(app):
+    """Sizes the cache from DATASET_CACHE_BYTES."""
+    cache.maxbytes = app.config.get('DATASET_CACHE_BYTES',
+                                    DATASET_CACHE_BYTES)
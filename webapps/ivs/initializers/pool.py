@@ -0,0 +1,204 @@
+#    Copyright 2013 10gen Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Pools of warm sandboxes for init scripts.
+
+A sandbox is a res_id whose collections an init script has already built.
+Its CLIENTS_COLLECTION document has no session_id, so no shell can use it,
+and records the script in 'sandbox' and whether it is 'building' or
+'ready' in 'sandbox_state'. When a student runs a pooled script, claim()
+takes a ready sandbox with one find_and_modify and renames its collections
+into the student's res_id, replacing any of the same name, which is much
+cheaper than loading them. A background thread keeps SANDBOX_POOL[script]
+sandboxes ready for each pooled script, and is woken by every claim.
+
+Only scripts that build their collections from scratch, whatever the
+request, may be pooled: the sandboxes are built with no request.
+
+Ready sandboxes are kept alive by the refills. Sandboxes left behind by a
+process that died expire like any other session.
+"""
+
+from datetime import datetime
+from importlib import import_module
+import logging
+import threading
+import uuid
+
+from pymongo.errors import OperationFailure
+
+from webapps.lib import CLIENTS_COLLECTION, leases, metrics, quota
+from webapps.lib.MWSServerError import MWSServerError
+from webapps.lib.db import get_db
+from webapps.lib.util import UseResId, to_coll_name
+
+_logger = logging.getLogger(__name__)
+
+# Seconds a process keeps the right to refill a script's pool after its last
+# refill. Refills in other processes wait until then.
+LEASE_TTL = 120
+
+_pool = None
+
+
+def load_script(script_name):
+    """Imports the init script; raises ImportError if there is none."""
+    return import_module(
+        'webapps.ivs.initializers.scripts.{0}'.format(script_name))
+
+
+def build(script_name):
+    """Runs the init script into a new sandbox. Returns its res_id."""
+    module = load_script(script_name)
+    res_id = str(uuid.uuid4())
+    clients = get_db()[CLIENTS_COLLECTION]
+    clients.insert({
+        'res_id': res_id,
+        'collections': [],
+        'sandbox': script_name,
+        'sandbox_state': 'building',
+        'timestamp': datetime.now()
+    })
+    try:
+        module.run(res_id, None)
+    except Exception:
+        discard(res_id)
+        raise
+    clients.update({'res_id': res_id}, {'$set': {
+        'sandbox_state': 'ready',
+        'timestamp': datetime.now()
+    }})
+    return res_id
+
+
+def discard(res_id):
+    """Drops whatever is left of a sandbox."""
+    with UseResId(res_id) as db:
+        db.drop_database()
+    get_db()[CLIENTS_COLLECTION].remove({'res_id': res_id})
+
+
+def claim(script_name, res_id):
+    """
+    Moves the collections of a ready sandbox of script_name into res_id.
+    Returns False if there is no ready sandbox or it could not be moved, in
+    which case the script should be run instead. The collections moved
+    before a failure are dropped again, so none of the sandbox is left in
+    res_id.
+    """
+    db = get_db()
+    sandbox = db[CLIENTS_COLLECTION].find_and_modify(
+        {'sandbox': script_name, 'sandbox_state': 'ready'},
+        {'$set': {'sandbox_state': 'claimed', 'timestamp': datetime.now()}})
+    if sandbox is None:
+        metrics.inc('mws_sandbox_claims_total', script=script_name,
+                    outcome='miss')
+        return False
+    wake()
+    moved = []
+    try:
+        with UseResId(res_id) as target:
+            try:
+                for name in sandbox['collections']:
+                    target.ensure_client_collection(name)
+                    moved.append(name)
+                    source = to_coll_name(sandbox['res_id'], name)
+                    destination = to_coll_name(res_id, name)
+                    db[source].rename(destination, dropTarget=True)
+                    quota.forget(db, source)
+                    quota.forget(db, destination)
+            except (OperationFailure, MWSServerError) as e:
+                _logger.warning('Could not move sandbox %s to %s: %s' %
+                                (sandbox['res_id'], res_id, e))
+                for name in moved:
+                    target.drop_collection(name)
+                metrics.inc('mws_sandbox_claims_total', script=script_name,
+                            outcome='failed')
+                return False
+    finally:
+        discard(sandbox['res_id'])
+    metrics.inc('mws_sandbox_claims_total', script=script_name,
+                outcome='hit')
+    return True
+
+
+def refill(config):
+    """
+    Builds the missing sandboxes of every pool this process holds the lease
+    of, and keeps their ready sandboxes alive. Returns the number built.
+    """
+    db = get_db()
+    clients = db[CLIENTS_COLLECTION]
+    built = 0
+    for script_name, size in sorted(config['SANDBOX_POOL'].iteritems()):
+        if not leases.acquire(db, 'sandbox_pool.' + script_name, LEASE_TTL):
+            continue
+        query = {'sandbox': script_name, 'sandbox_state': 'ready'}
+        clients.update(query, {'$set': {'timestamp': datetime.now()}},
+                       multi=True)
+        for _ in xrange(size - clients.find(query).count()):
+            try:
+                build(script_name)
+            except Exception:
+                _logger.exception('Could not build a sandbox for %s' %
+                                  script_name)
+                break
+            built += 1
+    return built
+
+
+class SandboxPool(object):
+    """Refills the pools from a daemon thread every SANDBOX_REFILL_EVERY
+    seconds, or as soon as it is woken."""
+
+    def __init__(self, app):
+        self.app = app
+        self._wake = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run,
+                                        name='SandboxPool')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def wake(self):
+        self._wake.set()
+
+    def _run(self):
+        interval = self.app.config['SANDBOX_REFILL_EVERY']
+        while True:
+            try:
+                with self.app.app_context():
+                    built = refill(self.app.config)
+                if built:
+                    _logger.info('Built %d sandboxes' % built)
+            except Exception:
+                _logger.exception('Could not refill the sandbox pools')
+            self._wake.wait(interval)
+            self._wake.clear()
+
+
+def wake():
+    if _pool is not None:
+        _pool.wake()
+
+
+def init_app(app):
+    """Starts refilling the pools in SANDBOX_POOL, if there are any."""
+    global _pool
+    if app.config.get('SANDBOX_POOL'):
+        _pool = SandboxPool(app)
+        _pool.start()
@@ -0,0 +1,279 @@
+#    Copyright 2013 10gen Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Incremental readers for dataset files, and batched inserts of what they
+read, so that loading a dataset takes the same memory whatever its size.
+
+The readers take an open file and yield documents as they are parsed, a
+READ_SIZE chunk of the file at a time. Extended JSON ($oid, $date, ...) is
+decoded as bson.json_util.loads would. mongodump's .bson files are read
+through a memory map where possible, and their documents are only decoded
+just before they are inserted.
+"""
+
+import json
+import mmap
+import struct
+
+from bson import BSON
+from bson.errors import InvalidBSON
+from bson.json_util import loads, object_hook
+from bson.son import SON
+
+READ_SIZE = 64 * 1024  # bytes read from a dataset file at a time
+INSERT_BATCH_SIZE = 1000  # documents sent per insert
+INSERT_BATCH_BYTES = 8 * 1024 * 1024  # BSON bytes sent per insert
+
+_WHITESPACE = ' \t\n\r'
+_decoder = json.JSONDecoder(object_hook=object_hook)
+
+
+class JSONReader(object):
+    """Reads JSON values one at a time from a file."""
+
+    def __init__(self, f):
+        self.f = f
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        """Reads more of the file, dropping what has been parsed. Returns
+        False at the end of the file."""
+        if self.eof:
+            return False
+        chunk = self.f.read(READ_SIZE)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """Returns the next character that is not whitespace, or '' at the
+        end of the file, without consuming it."""
+        while True:
+            while self.pos < len(self.buf) and \
+                    self.buf[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf) or not self._fill():
+                return self.buf[self.pos:self.pos + 1]
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError('Expected %r at offset %d of the dataset' %
+                             (char, self.pos))
+        self.pos += 1
+
+    def value(self):
+        """Parses the next value, reading until it is complete."""
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buf, self.pos)
+            except ValueError:
+                # Incomplete, unless the whole file has been read
+                if not self._fill():
+                    raise
+                continue
+            if end == len(self.buf) and not self.eof and \
+                    self.buf[self.pos] not in '{["':
+                # A number or literal may continue in the next chunk
+                if self._fill():
+                    continue
+            self.pos = end
+            return value
+
+    def array(self):
+        """Yields the elements of the array that comes next."""
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.peek() == ',':
+                self.pos += 1
+            else:
+                self.expect(']')
+                return
+
+
+def read_mongoexport(f):
+    """
+    Yields the documents of a mongoexport file, with or without --jsonArray:
+    either one document per line or a single array of documents.
+    """
+    reader = JSONReader(f)
+    if reader.peek() == '[':
+        for document in reader.array():
+            yield document
+        return
+    # Anything buffered by peek comes first, then the rest line by line
+    pending = reader.buf[reader.pos:]
+    lines = f if not pending else _prepend(pending, f)
+    for line in lines:
+        if line.strip():
+            yield loads(line)
+
+
+def _prepend(text, f):
+    lines = text.split('\n')
+    tail = lines.pop()
+    for line in lines:
+        yield line
+    for line in f:
+        yield tail + line
+        tail = ''
+    if tail:
+        yield tail
+
+
+def read_collections(f):
+    """
+    Yields (collection, documents) for a file whose top level is an object
+    mapping collection names to arrays of documents. Each documents iterator
+    must be used up before the next pair is read.
+    """
+    reader = JSONReader(f)
+    reader.expect('{')
+    if reader.peek() == '}':
+        return
+    while True:
+        name = reader.value()
+        reader.expect(':')
+        yield name, reader.array()
+        if reader.peek() == ',':
+            reader.pos += 1
+        else:
+            reader.expect('}')
+            return
+
+
+def read_bson(f):
+    """Yields the raw BSON of each document in a file written by mongodump,
+    without decoding it."""
+    try:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, ValueError, EnvironmentError):
+        # Empty files and streams cannot be mapped
+        data = None
+    if data is None:
+        for document in _read_bson_file(f):
+            yield document
+        return
+    try:
+        offset = 0
+        end = len(data)
+        while offset < end:
+            size = _bson_size(data[offset:offset + 4], end - offset)
+            yield data[offset:offset + size]
+            offset += size
+    finally:
+        data.close()
+
+
+def _read_bson_file(f):
+    while True:
+        header = f.read(4)
+        if not header:
+            return
+        size = _bson_size(header)
+        document = header + f.read(size - 4)
+        if len(document) != size:
+            raise InvalidBSON('Truncated document at the end of the dump')
+        yield document
+
+
+def _bson_size(header, remaining=None):
+    if len(header) < 4:
+        raise InvalidBSON('Truncated document at the end of the dump')
+    size = struct.unpack('<i', header)[0]
+    if size < 5 or (remaining is not None and size > remaining):
+        raise InvalidBSON('Invalid document size %d in the dump' % size)
+    return size
+
+
+def read_metadata(f):
+    """Returns the contents of a mongodump .metadata.json file, keeping the
+    order of the fields of index keys."""
+    return json.loads(f.read(),
+                      object_pairs_hook=lambda pairs: object_hook(SON(pairs)))
+
+
+def without_id(documents):
+    for document in documents:
+        document.pop('_id', None)
+        yield document
+
+
+def batches(documents, size=INSERT_BATCH_SIZE, max_bytes=INSERT_BATCH_BYTES):
+    """Groups documents into lists of at most size documents and, unless a
+    single document is larger, max_bytes of BSON."""
+    batch = []
+    batch_bytes = 0
+    for document in documents:
+        document_bytes = len(BSON.encode(document))
+        if batch and (len(batch) >= size or
+                      batch_bytes + document_bytes > max_bytes):
+            yield batch
+            batch = []
+            batch_bytes = 0
+        batch.append(document)
+        batch_bytes += document_bytes
+    if batch:
+        yield batch
+
+
+def raw_batches(documents, size=INSERT_BATCH_SIZE,
+                max_bytes=INSERT_BATCH_BYTES):
+    """Groups BSON-encoded documents as batches groups decoded ones."""
+    batch = []
+    batch_bytes = 0
+    for document in documents:
+        if batch and (len(batch) >= size or
+                      batch_bytes + len(document) > max_bytes):
+            yield batch
+            batch = []
+            batch_bytes = 0
+        batch.append(document)
+        batch_bytes += len(document)
+    if batch:
+        yield batch
+
+
+def insert_encoded(collection, batches, remove_id=False):
+    """Decodes and inserts batches of BSON-encoded documents into
+    collection. Returns how many were inserted."""
+    inserted = 0
+    for batch in batches:
+        documents = [BSON(encoded).decode() for encoded in batch]
+        if remove_id:
+            for document in documents:
+                document.pop('_id', None)
+        collection.insert(documents)
+        inserted += len(documents)
+    return inserted
+
+
+def insert_all(collection, documents):
+    """Inserts documents into collection in batches. Returns how many were
+    inserted."""
+    inserted = 0
+    for batch in batches(documents):
+        collection.insert(batch)
+        inserted += len(batch)
+    return inserted
@@ -0,0 +1,192 @@
+#    Copyright 2013 10gen Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Master copies of the collections an init script sets up, cloned server-side
+into each student's namespace rather than loaded through this process.
+
+A template is loaded once, by the load function of the script that declares
+it, into the reserved res_id template_res_id(name, version), and recorded
+in TEMPLATES_COLLECTION. Its version identifies the dataset files it was
+loaded from, so a template is rebuilt when they change. clone() copies each
+template collection into the student's res_id with an aggregation ending in
+$out, copies its indexes and registers it with ensure_client_collection, so
+documents never leave the database. For example, in an init script:
+
+    def run(res_id, request):
+        templates.clone(res_id, 'zips', load, datasets=['zips.json'])
+
+    def load(res_id):
+        load_data_from_mongoexport(res_id, 'zips.json', 'zips')
+
+Only one process builds a template at a time; others wait up to
+TEMPLATE_BUILD_WAIT seconds for it, then load the datasets themselves.
+Template res_ids never match a session's, and have no CLIENTS_COLLECTION
+document, so the templates are not expired with the sessions.
+"""
+
+from datetime import datetime
+import hashlib
+import logging
+import os
+import time
+
+from flask import current_app
+from pymongo.errors import OperationFailure
+
+from webapps.lib import TEMPLATES_COLLECTION, leases, metrics, quota
+from webapps.lib.db import get_db
+from webapps.lib.util import UseResId, to_coll_name
+from webapps.ivs.initializers.util import _data_file_path
+
+_logger = logging.getLogger(__name__)
+
+TEMPLATE_PREFIX = 'template.'
+# Seconds a process may spend building a template before others may start
+# building it too
+LEASE_TTL = 300
+POLL_EVERY = 0.5  # seconds between checks while waiting for a build
+
+
+def template_res_id(name, version):
+    return '{0}{1}.{2}.'.format(TEMPLATE_PREFIX, name, version)
+
+
+def dataset_version(datasets):
+    """Identifies the current contents of the data files datasets."""
+    stats = []
+    for path in datasets:
+        path = _data_file_path(path)
+        stat = os.stat(path)
+        stats.append((os.path.realpath(path), stat.st_mtime, stat.st_size))
+    return hashlib.md5(repr(stats)).hexdigest()[:12]
+
+
+def _collection_names(db, res_id):
+    return [name[len(res_id):] for name in db.collection_names()
+            if name.startswith(res_id)]
+
+
+def _drop(db, res_id, collections):
+    for name in collections:
+        db.drop_collection(to_coll_name(res_id, name))
+
+
+def build(name, version, load):
+    """
+    Runs load(res_id) into the namespace of the template, records it as the
+    current version of name and drops the version it replaces. Returns the
+    template's TEMPLATES_COLLECTION document.
+    """
+    db = get_db()
+    res_id = template_res_id(name, version)
+    # Whatever an interrupted build left behind
+    _drop(db, res_id, _collection_names(db, res_id))
+    load(res_id)
+    template = {
+        'version': version,
+        'res_id': res_id,
+        'collections': _collection_names(db, res_id),
+        'built': datetime.now()
+    }
+    old = db[TEMPLATES_COLLECTION].find_and_modify(
+        {'_id': name}, {'$set': template}, upsert=True)
+    if old is not None and old.get('res_id') != res_id:
+        _drop(db, old['res_id'], old['collections'])
+    template['_id'] = name
+    return template
+
+
+def _current(db, name, version):
+    return db[TEMPLATES_COLLECTION].find_one({'_id': name,
+                                              'version': version})
+
+
+def _build_or_wait(db, name, version, load):
+    """Builds the template, or waits for another process to. Returns None
+    if it is not ready in time or could not be built."""
+    lease = 'template.' + name
+    deadline = time.time() + current_app.config.get('TEMPLATE_BUILD_WAIT',
+                                                    30)
+    while True:
+        if leases.acquire(db, lease, LEASE_TTL):
+            try:
+                return _current(db, name, version) or \
+                    build(name, version, load)
+            except Exception:
+                _logger.exception('Could not build template %s' % name)
+                return None
+            finally:
+                leases.release(db, lease)
+        if time.time() >= deadline:
+            return None
+        time.sleep(POLL_EVERY)
+        template = _current(db, name, version)
+        if template is not None:
+            return template
+
+
+def copy_indexes(source, destination):
+    """Builds the indexes of the collection source on destination."""
+    for index_name, info in source.index_information().iteritems():
+        if index_name == '_id_':
+            continue
+        options = dict((key, value) for key, value in info.iteritems()
+                       if key not in ('key', 'v', 'ns'))
+        options['name'] = index_name
+        destination.create_index(info['key'], **options)
+
+
+def copy_collections(db, template, res_id):
+    """Materializes the collections of template in res_id, replacing any
+    of the same name."""
+    with UseResId(res_id) as target:
+        for name in template['collections']:
+            target.ensure_client_collection(name)
+            source = db[to_coll_name(template['res_id'], name)]
+            destination = to_coll_name(res_id, name)
+            source.aggregate([{'$out': destination}])
+            copy_indexes(source, db[destination])
+            quota.forget(db, destination)
+
+
+def clone(res_id, name, load, datasets=()):
+    """
+    Sets up the collections of template name in res_id, building the
+    template with load if it is missing or its datasets have changed.
+    Falls back to load(res_id) if the template cannot be used. Returns
+    whether the collections were cloned.
+    """
+    db = get_db()
+    version = dataset_version(datasets)
+    template = _current(db, name, version) or \
+        _build_or_wait(db, name, version, load)
+    if template is not None:
+        try:
+            copy_collections(db, template, res_id)
+        except OperationFailure as e:
+            # Most likely replaced by a newer version meanwhile
+            _logger.warning('Could not clone template %s into %s: %s' %
+                            (name, res_id, e))
+            with UseResId(res_id) as target:
+                for collection in template['collections']:
+                    target.drop_collection(collection)
+        else:
+            metrics.inc('mws_template_clones_total', template=name,
+                        outcome='cloned')
+            return True
+    load(res_id)
+    metrics.inc('mws_template_clones_total', template=name,
+                outcome='loaded')
+    return False
@@ -14,17 +14,16 @@
 
 import os
 import logging
-from subprocess import Popen
-from bson.json_util import loads
+from bson.errors import InvalidBSON
+from pymongo.errors import OperationFailure
 from werkzeug.exceptions import NotFound, InternalServerError
 from webapps.lib.db import get_db
 from webapps.lib.util import get_collection_names, UseResId
+from webapps.ivs.initializers import datasets, stream
 
 
 from flask import current_app
 
-SEEK_SET = 0
-
 _logger = logging.getLogger(__name__)
 
 
@@ -39,25 +38,21 @@ def load_data_from_mongoexport(res_id, export_location, collection_name,
     This file should come from mongoexport, with or without the --jsonArray
     flag. That is to say, it should either be a series of documents, each on
     its own line, or a single array of documents. All documents will be
-    inserted into the given collection.
+    inserted into the given collection in batches, from the dataset cache or,
+    for files too large to cache, as they are read.
     """
     export_location = _data_file_path(export_location)
+    batches = datasets.load_mongoexport(export_location)
+    if batches is not None:
+        with UseResId(res_id) as db:
+            stream.insert_encoded(db[collection_name], batches, remove_id)
+        return
     with open(export_location) as export:
-        first_char = export.read(1)
-        export.seek(0, SEEK_SET)
-        if first_char == '[':
-            # Data is already in an array
-            documents = loads(export.read())
-        else:
-            # Each line of data is an object
-            documents = []
-            for line in export:
-                documents.append(loads(line))
+        documents = stream.read_mongoexport(export)
         if remove_id:
-            _remove_id(documents)
-
+            documents = stream.without_id(documents)
         with UseResId(res_id) as db:
-            db[collection_name].insert(documents)
+            stream.insert_all(db[collection_name], documents)
 
 
 def load_data_from_json(res_id, file_name, remove_id=False):
@@ -66,42 +61,59 @@ def load_data_from_json(res_id, file_name, remove_id=False):
     names which map to an array of documents to be inserted into the collection
     """
     file_name = _data_file_path(file_name)
+    collections = datasets.load_collections(file_name)
+    if collections is not None:
+        with UseResId(res_id) as db:
+            for collection, batches in collections:
+                stream.insert_encoded(db[collection], batches, remove_id)
+        return
     with open(file_name) as json_file:
-        collections = loads(json_file.read())
         with UseResId(res_id) as db:
-            for collection, documents in collections.iteritems():
+            for collection, documents in stream.read_collections(json_file):
                 if remove_id:
-                    _remove_id(documents)
-                db[collection].insert(documents)
+                    documents = stream.without_id(documents)
+                stream.insert_all(db[collection], documents)
 
 
-def load_data_from_mongodump(res_id, dump_location, collection_name):
+def load_data_from_mongodump(res_id, dump_location, collection_name,
+                             restore_indexes=True):
     """
     The dump location should point to a .bson file, not a directory structure
     as created by mongodump. Instead, use the .bson files inside this
-    directory structure.
+    directory structure. Its documents are inserted in batches. Unless
+    restore_indexes is False, the indexes listed in the .metadata.json file
+    next to it, if there is one, are built too.
     """
     dump_location = _data_file_path(dump_location)
     if not os.path.exists(dump_location):
         raise NotFound('Unable to find dump file')
-    p = Popen((
-        'mongorestore',
-        '-d', 'mws',
-        '-c', '%s%s' % (res_id, collection_name),
-        dump_location
-    ))
-    p.communicate()  # Wait for process to finish
-    if p.poll() != 0:
-        raise InternalServerError('Loading dumped data failed')
     with UseResId(res_id) as db:
         db.ensure_client_collection(collection_name)
-
-
-def _remove_id(documents):
-    """ Removes the _id field from each document in the array """
-    for document in documents:
-        if '_id' in document:
-            del document['_id']
+        try:
+            with open(dump_location, 'rb') as dump:
+                stream.insert_encoded(
+                    db[collection_name],
+                    stream.raw_batches(stream.read_bson(dump)))
+            if restore_indexes:
+                _restore_indexes(db[collection_name].coll, dump_location)
+        except (InvalidBSON, ValueError, OperationFailure) as e:
+            _logger.error('Could not load %s: %s' % (dump_location, e))
+            raise InternalServerError('Loading dumped data failed')
+
+
+def _restore_indexes(collection, dump_location):
+    base, _ = os.path.splitext(dump_location)
+    metadata_location = base + '.metadata.json'
+    if not os.path.exists(metadata_location):
+        return
+    with open(metadata_location) as f:
+        metadata = stream.read_metadata(f)
+    for index in metadata.get('indexes', []):
+        if index['name'] == '_id_':
+            continue
+        options = dict((key, value) for key, value in index.iteritems()
+                       if key not in ('key', 'v', 'ns'))
+        collection.create_index(index['key'].items(), **options)
 
 
 def _data_file_path(path):
@@ -13,15 +13,18 @@
 #    limitations under the License.
 
 import json
-import requests
 import traceback
 
+from bson.errors import InvalidId
+from bson.objectid import ObjectId
 from flask import Blueprint, current_app, jsonify, request, session
 
 from importlib import import_module
 from itsdangerous import BadSignature, Signer
 
-from webapps.lib import CLIENTS_COLLECTION
+from webapps.ivs import grading
+from webapps.ivs.initializers import pool
+from webapps.lib import CLIENTS_COLLECTION, GRADES_COLLECTION
 from webapps.lib.db import get_db
 from webapps.lib.decorators import ratelimit
 from webapps.lib.MWSServerError import MWSServerError
@@ -37,14 +40,18 @@ _logger = logging.getLogger(__name__)
 
 
 @ivs.route('/init/<script_name>', methods=['POST'])
-@ratelimit
+@ratelimit(endpoint_class='ivs')
 def init(script_name):
     res_id = _get_res_id()
     try:
-        module = 'webapps.ivs.initializers.scripts.{0}'.format(script_name)
-        module = import_module(module)
+        module = pool.load_script(script_name)
     except ImportError as e:
         raise MWSServerError(404, str(e))
+    if (script_name in current_app.config.get('SANDBOX_POOL', {}) and
+            pool.claim(script_name, res_id)):
+        return jsonify(
+            success=True,
+            msg='Collection initialized successfully')
     try:
         module.run(res_id, request)
     except Exception as e:
@@ -58,7 +65,7 @@ def init(script_name):
 
 
 @ivs.route('/verify/<script_name>', methods=['POST'])
-@ratelimit
+@ratelimit(endpoint_class='ivs')
 def verify(script_name):
     res_id = _get_res_id()
     user_id = _get_user_id()
@@ -79,21 +86,50 @@ def verify(script_name):
             script_name, str(e)))
         _logger.error('Traceback: {0}'.format(traceback.format_exc()))
         raise MWSServerError(500, type(e).__name__, str(e))
-    server_url = current_app.config.get('GRADING_SERVER_URL')
-    # add grading credentials
-    results.update({
-        'api_key': current_app.config.get('GRADING_API_KEY'),
-        'api_secret': current_app.config.get('GRADING_API_SECRET')
-    })
-    post_url = '{0}/api/v1/grade/{1}/{2}/{3}'.format(
-        server_url,
-        course_id,
-        problem_id,
-        user_id)
-    response = requests.post(post_url, data=results)
-    if response.status_code != 200:
-        raise MWSServerError(response.status_code, response.text)
-    return jsonify(**(json.loads(response.text)))
+    db = get_db()
+    grade_id = grading.submit(db, current_app.config, course_id, problem_id,
+                              user_id, results)
+    timeout = current_app.config.get('GRADING_WAIT', 2)
+    grade = grading.wait(db, current_app.config, grade_id, timeout)
+    if grade is None:
+        return _queued(grade_id)
+    return _graded(grade)
+
+
+@ivs.route('/grades/<grade_id>', methods=['GET'])
+@ratelimit(endpoint_class='ivs')
+def grade_status(grade_id):
+    user_id = _get_user_id()
+    try:
+        grade_id = ObjectId(grade_id)
+    except InvalidId:
+        raise MWSServerError(404, 'Unknown grade')
+    db = get_db()
+    grade = db[GRADES_COLLECTION].find_one({'_id': grade_id,
+                                            'user_id': user_id})
+    if grade is None:
+        raise MWSServerError(404, 'Unknown grade')
+    if grade['state'] in (grading.PENDING, grading.SENDING):
+        # Sends a retry that is due when there are no workers to send it
+        grade = grading.wait(db, current_app.config, grade_id, 0)
+        if grade is None:
+            return _queued(grade_id)
+    return _graded(grade)
+
+
+def _queued(grade_id):
+    response = jsonify(success=True, queued=True, grade_id=str(grade_id))
+    response.status_code = 202
+    return response
+
+
+def _graded(grade):
+    response = grade.get('response')
+    if grade['state'] != grading.DONE:
+        if response is None:
+            raise MWSServerError(502, grade.get('error', 'Grading failed'))
+        raise MWSServerError(response['status'], response['body'])
+    return jsonify(**(json.loads(response['body'])))
 
 
 def _get_user_id():
@@ -13,3 +13,8 @@
 #    limitations under the License.
 
 CLIENTS_COLLECTION = 'clients'
+CURSORS_COLLECTION = 'cursors'
+QUOTAS_COLLECTION = 'quotas'
+LEASES_COLLECTION = 'leases'
+TEMPLATES_COLLECTION = 'templates'
+GRADES_COLLECTION = 'grades'
@@ -18,7 +18,8 @@ import yaml
 _ENVVAR = [
     ('ADMIN_EMAILS', str),
     ('DEBUG', bool),
-    ('DB_HOSTS', list)
+    ('DB_HOSTS', list),
+    ('DB_ENGINE', str)
 ]
 _PREFIXED_ENVVAR = [
     # Web Shell server
@@ -0,0 +1,101 @@
+#    Copyright 2013 10gen Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Bookkeeping for the cursors that the find endpoint leaves open on the server.
+
+The keep-alive client never kills cursors on its own, so every cursor id
+handed out to a shell is recorded here along with its owner and the last time
+it was used. Abandoned cursors are then killed by the reaper job instead of
+lingering on mongod until the server-side timeout.
+"""
+
+from datetime import datetime, timedelta
+import logging
+
+from flask import current_app
+from pymongo import ASCENDING
+
+from db import get_db
+import metrics
+from . import CURSORS_COLLECTION
+
+_logger = logging.getLogger(__name__)
+
+
+def register_cursor(res_id, collection_name, cursor_id):
+    """
+    Records an open cursor for res_id. If res_id now holds more than
+    CURSOR_LIMIT_PER_RES_ID cursors, the least recently used ones are killed.
+    """
+    db = get_db()
+    registry = db[CURSORS_COLLECTION]
+    registry.insert({
+        '_id': cursor_id,
+        'res_id': res_id,
+        'collection': collection_name,
+        'last_touched': datetime.now()
+    })
+    metrics.inc('mws_cursors_opened_total')
+
+    limit = current_app.config.get('CURSOR_LIMIT_PER_RES_ID')
+    if limit:
+        excess = registry.find({'res_id': res_id}).count() - limit
+        if excess > 0:
+            oldest = registry.find({'res_id': res_id}, {'_id': 1}).sort(
+                'last_touched', ASCENDING).limit(excess)
+            kill_cursors(db, [c['_id'] for c in oldest])
+
+
+def touch_cursor(res_id, cursor_id):
+    """
+    Marks the cursor as used. Returns False if res_id does not own a cursor
+    with the given id, either because it never did or because it was reaped.
+    """
+    res = get_db()[CURSORS_COLLECTION].update(
+        {'_id': cursor_id, 'res_id': res_id},
+        {'$set': {'last_touched': datetime.now()}}
+    )
+    return res.get('n', 0) > 0
+
+
+def kill_cursors(db, cursor_ids):
+    """Kills the given cursors on the server and forgets about them."""
+    if not cursor_ids:
+        return
+    db.connection.kill_cursors(cursor_ids)
+    res = db[CURSORS_COLLECTION].remove({'_id': {'$in': cursor_ids}})
+    # Only count cursors that were still registered, so that one killed
+    # twice (say by the reaper and by a drain) is counted once
+    metrics.inc('mws_cursors_closed_total', (res or {}).get('n', 0))
+
+
+def reap_idle_cursors(db, idle_timeout, batch_size):
+    """
+    Kills every registered cursor that has not been touched in idle_timeout
+    seconds, batch_size cursors at a time. Returns the number of cursors
+    killed.
+    """
+    expiry = datetime.now() - timedelta(seconds=idle_timeout)
+    registry = db[CURSORS_COLLECTION]
+    reaped = 0
+    while True:
+        idle = registry.find({'last_touched': {'$lt': expiry}},
+                             {'_id': 1}).limit(batch_size)
+        batch = [c['_id'] for c in idle]
+        if not batch:
+            break
+        kill_cursors(db, batch)
+        reaped += len(batch)
+    return reaped
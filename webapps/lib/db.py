@@ -13,18 +13,19 @@
 #    limitations under the License.
 
 import logging
-from urlparse import urlparse
+import os
+import threading
 
 from flask import current_app
 import pymongo
 from pymongo.cursor_manager import CursorManager
+from pymongo.errors import ConnectionFailure
 
+import memory
 from MWSServerError import MWSServerError
 
 _logger = logging.getLogger(__name__)
 
-db = None
-
 
 class KeepAliveCursorManager(CursorManager):
     """A cursor manager that does not kill cursors
@@ -37,40 +38,118 @@ class KeepAliveCursorManager(CursorManager):
         pass
 
 
-def get_keepalive_db(MWSExceptions=True):
-    config = current_app.config
-    try:
+class ConnectionManager(object):
+    """Owns the MongoClients shared by every request in this process.
+
+    DB_ENGINE picks the storage engine behind them: 'mongo' connects to the
+    mongod at DB_HOSTS, 'memory' uses the process-wide client of the
+    in-memory engine, which implements the same part of the pymongo API.
+
+    Two pooled clients are kept per set of connection settings: one for
+    normal traffic and one, using KeepAliveCursorManager, for endpoints that
+    leave cursors open on the server between requests. Clients are created
+    lazily under a lock and are thrown away if the process id changes, so a
+    forked worker never reuses sockets inherited from its parent.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._clients = {}
+
+    def _key(self, config, keepalive):
+        return (config.get('DB_ENGINE', 'mongo'),
+                tuple(config.get('DB_HOSTS')), config.get('DB_PORT'),
+                config.get('username'), bool(config.get('DB_USE_GREENLETS')),
+                bool(keepalive))
+
+    def _check_fork(self):
+        pid = os.getpid()
+        if pid != self._pid:
+            # Sockets belong to the parent; start again from scratch.
+            self._clients = {}
+            self._pid = pid
+
+    def _create_client(self, config, keepalive):
+        engine = config.get('DB_ENGINE', 'mongo')
+        if engine == 'memory':
+            # Cursors are only killed when asked, so the same client serves
+            # normal and keep-alive traffic
+            return memory.get_client()
+        elif engine != 'mongo':
+            raise ValueError('Unknown DB_ENGINE {0}'.format(engine))
+        if keepalive:
+            pool_size = config.get('DB_KEEPALIVE_POOL_SIZE')
+        else:
+            pool_size = config.get('DB_POOL_SIZE')
         client = pymongo.MongoClient(
             ', '.join(config.get('DB_HOSTS')),
-            config.get('DB_PORT'))
-        client.set_cursor_manager(KeepAliveCursorManager)
-        db = client[config.get('DB_NAME')]
+            config.get('DB_PORT'),
+            max_pool_size=pool_size,
+            use_greenlets=bool(config.get('DB_USE_GREENLETS')))
+        if keepalive:
+            client.set_cursor_manager(KeepAliveCursorManager)
         if 'username' in config:
-            db.authenticate(config.get('username'), config.get('password'))
-        return db
-    except Exception as e:
-        if MWSExceptions:
-            _logger.error(e)
-            debug = config['DEBUG']
-            msg = str(e) if debug else 'An unexpected error occurred.'
-            raise MWSServerError(500, msg)
-        raise
+            # The client caches the credentials and applies them to every
+            # socket it opens, so this only has to happen once.
+            client[config.get('DB_NAME')].authenticate(
+                config.get('username'), config.get('password'))
+        return client
 
+    def get_client(self, config, keepalive=False):
+        key = self._key(config, keepalive)
+        with self._lock:
+            self._check_fork()
+            client = self._clients.get(key)
+            if client is None:
+                client = self._create_client(config, keepalive)
+                self._clients[key] = client
+            return client
 
-def get_db(MWSExceptions=True):
-    global db
+    def get_db(self, config, keepalive=False):
+        return self.get_client(config, keepalive)[config.get('DB_NAME')]
+
+    def pool_sizes(self):
+        """Returns the configured max pool size of each open client."""
+        with self._lock:
+            return dict((key, client.max_pool_size)
+                        for key, client in self._clients.items())
+
+    def ping(self, config, keepalive=False):
+        """Returns True if the server answers a ping on the given client. A
+        client that fails the check is dropped so the next request reconnects.
+        """
+        try:
+            self.get_client(config, keepalive).admin.command('ping')
+            return True
+        except ConnectionFailure as e:
+            _logger.warning('Database health check failed: %s', e)
+            self.reconnect(config, keepalive)
+            return False
+
+    def reconnect(self, config=None, keepalive=None):
+        """Disconnects and forgets clients so that the next call to get_client
+        builds new ones. Without arguments every client is dropped.
+        """
+        with self._lock:
+            if config is None:
+                keys = self._clients.keys()
+            elif keepalive is None:
+                keys = [self._key(config, False), self._key(config, True)]
+            else:
+                keys = [self._key(config, keepalive)]
+            for key in keys:
+                client = self._clients.pop(key, None)
+                if client is not None:
+                    client.disconnect()
+
+
+connections = ConnectionManager()
+
+
+def _get_db(keepalive, MWSExceptions):
     config = current_app.config
-    # TODO: Ensure MongoClient connection is still active.
-    if db:
-        return db
     try:
-        client = pymongo.MongoClient(
-            ', '.join(config.get('DB_HOSTS')),
-            config.get('DB_PORT'))
-        db = client[config.get('DB_NAME')]
-        if 'username' in config:
-            db.authenticate(config.get('username'), config.get('password'))
-        return db
+        return connections.get_db(config, keepalive)
     except Exception as e:
         if MWSExceptions:
             _logger.error(e)
@@ -78,3 +157,11 @@ def get_db(MWSExceptions=True):
             msg = str(e) if debug else 'An unexpected error occurred.'
             raise MWSServerError(500, msg)
         raise
+
+
+def get_keepalive_db(MWSExceptions=True):
+    return _get_db(True, MWSExceptions)
+
+
+def get_db(MWSExceptions=True):
+    return _get_db(False, MWSExceptions)
@@ -1,17 +1,48 @@
-from datetime import datetime, timedelta
 from functools import update_wrapper
-from flask import current_app, session
+from flask import current_app, request, session
 
+from . import liveness, metrics
 from .MWSServerError import MWSServerError
+from .cache import LRUCache
 from .db import get_db
+from .ratelimit import get_limits, get_ratelimiter
 from . import CLIENTS_COLLECTION
 
+# Defaults of the ACCESS_CACHE_SIZE and ACCESS_CACHE_TTL settings
+ACCESS_CACHE_SIZE = 10000
+ACCESS_CACHE_TTL = 60
 
-def user_has_access(res_id, session_id):
-    query = {'res_id': res_id, 'session_id': session_id}
-    coll = get_db()[CLIENTS_COLLECTION]
-    return_value = coll.find_one(query)
-    return False if return_value is None else True
+# Cached answers only serve reads: another process may expire the res_id
+# while they are cached, so writes always check CLIENTS_COLLECTION.
+access_cache = LRUCache(ACCESS_CACHE_SIZE, ACCESS_CACHE_TTL)
+metrics.add_collector(metrics.cache_collector('access', access_cache))
+
+
+def init_app(app):
+    """Sizes the access cache from the app config."""
+    access_cache.maxsize = app.config.get('ACCESS_CACHE_SIZE',
+                                          ACCESS_CACHE_SIZE)
+    access_cache.ttl = app.config.get('ACCESS_CACHE_TTL', ACCESS_CACHE_TTL)
+
+
+def user_has_access(res_id, session_id, cached=True):
+    """Whether session_id may use res_id. Unless cached is True, the answer
+    is read from the database, and cached for later reads."""
+    key = (res_id, session_id)
+    has_access = access_cache.get(key) if cached else None
+    if has_access is None:
+        query = {'res_id': res_id, 'session_id': session_id}
+        coll = get_db()[CLIENTS_COLLECTION]
+        with metrics.timed('mws_stage_duration_seconds', stage='access'):
+            has_access = coll.find_one(query, {'_id': 1}) is not None
+        access_cache.set(key, has_access)
+    return has_access
+
+
+def invalidate_access(res_id, session_id):
+    """Drops any cached answer for the pair. Call whenever a clients
+    document is created or removed."""
+    access_cache.invalidate((res_id, session_id))
 
 
 def check_session_id(f):
@@ -19,30 +50,44 @@ def check_session_id(f):
         session_id = session.get('session_id')
         if session_id is None:
             raise MWSServerError(401, 'There is no session_id cookie')
-        if not user_has_access(kwargs['res_id'], session_id):
+        # Requests that may write, and so create collections, must not
+        # act on a res_id that has expired
+        cached = request.method in ('GET', 'HEAD')
+        if not user_has_access(kwargs['res_id'], session_id, cached):
             error = 'Session error. User does not have access to res_id'
             raise MWSServerError(403, error)
+        # Any authorized request keeps the session alive
+        liveness.touch(kwargs['res_id'], session_id)
         return f(*args, **kwargs)
     return update_wrapper(wrapped_function, f)
 
 
-def ratelimit(f):
+def ratelimit(f=None, endpoint_class=None):
+    """Limits requests per session_id. May be applied bare or with an
+    endpoint class whose limits are set in RATELIMIT_LIMITS, e.g.
+    @ratelimit(endpoint_class='write').
+    """
+    if f is None:
+        return lambda f: ratelimit(f, endpoint_class)
+
     def wrapped_function(*args, **kwargs):
-        session_id = session.get('session_id')
-        if session_id is None:
-            error = 'Cannot rate limit without session_id cookie'
-            raise MWSServerError(401, error)
+        charge_ratelimit(endpoint_class)
+        return f(*args, **kwargs)
+    return update_wrapper(wrapped_function, f)
 
-        config = current_app.config
-        coll = get_db()[config['RATELIMIT_COLLECTION']]
-        coll.insert({'session_id': session_id, 'timestamp': datetime.now()})
 
-        delta = timedelta(seconds=config['RATELIMIT_EXPIRY'])
-        expiry = datetime.now() - delta
-        accesses = coll.find({'session_id': session_id,
-                              'timestamp': {'$gt': expiry}})
-        if accesses.count() > config['RATELIMIT_QUOTA']:
-            raise MWSServerError(429, 'Rate limit exceeded')
+def charge_ratelimit(endpoint_class=None, cost=1):
+    """Counts cost requests of endpoint_class against the current session,
+    raising a 429 if that goes over its limit."""
+    session_id = session.get('session_id')
+    if session_id is None:
+        error = 'Cannot rate limit without session_id cookie'
+        raise MWSServerError(401, error)
 
-        return f(*args, **kwargs)
-    return update_wrapper(wrapped_function, f)
+    config = current_app.config
+    quota, expiry = get_limits(config, endpoint_class)
+    key = '{0}:{1}'.format(endpoint_class or 'default', session_id)
+    with metrics.timed('mws_stage_duration_seconds', stage='ratelimit'):
+        allowed = get_ratelimiter(config).hit(key, quota, expiry, cost)
+    if not allowed:
+        raise MWSServerError(429, 'Rate limit exceeded')
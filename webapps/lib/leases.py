@@ -0,0 +1,94 @@
+#    Copyright 2013 10gen Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Leases in LEASES_COLLECTION, used to elect one process in the cluster to
+run each scheduled job.
+
+A lease is a document keyed by the job's name, held by one process until its
+expires time. acquire() takes a lease that is free or expired, or extends
+one this process already holds, with a single find_and_modify; if another
+process holds it, the upsert collides with the existing _id and the call
+returns False. A process that stops renewing its leases, because it died or
+lost its connection, loses them once they expire. Lease times are in UTC,
+so processes in different timezones agree on them.
+"""
+
+from datetime import datetime, timedelta
+import os
+import socket
+
+from pymongo.errors import DuplicateKeyError
+
+from . import LEASES_COLLECTION
+
+_hostname = socket.gethostname()
+
+
+def owner_id():
+    """Identifies this process. Computed on every call so that forked
+    workers get their own."""
+    return '%s:%d' % (_hostname, os.getpid())
+
+
+def acquire(db, name, ttl):
+    """Takes or renews the lease name for ttl seconds. Returns whether this
+    process now holds it."""
+    now = datetime.utcnow()
+    owner = owner_id()
+    query = {'_id': name, '$or': [{'owner': owner},
+                                  {'expires': {'$lt': now}}]}
+    update = {
+        '$set': {'owner': owner, 'expires': now + timedelta(seconds=ttl),
+                 'renewed': now},
+    }
+    try:
+        lease = db[LEASES_COLLECTION].find_and_modify(
+            query, update, upsert=True, new=True)
+    except DuplicateKeyError:
+        # Held by another process
+        return False
+    if lease.get('acquired_by') != owner:
+        # Newly elected
+        db[LEASES_COLLECTION].update(
+            {'_id': name, 'owner': owner},
+            {'$set': {'acquired': now, 'acquired_by': owner}})
+    return True
+
+
+def release(db, name):
+    """Gives up the lease name if this process holds it."""
+    db[LEASES_COLLECTION].update(
+        {'_id': name, 'owner': owner_id()},
+        {'$set': {'expires': datetime.utcnow()}})
+
+
+def record(db, name, fields):
+    """Sets fields on the lease name if this process holds it."""
+    db[LEASES_COLLECTION].update({'_id': name, 'owner': owner_id()},
+                                 {'$set': fields})
+
+
+def get(db, name):
+    return db[LEASES_COLLECTION].find_one({'_id': name})
+
+
+def status(db):
+    """Returns every lease, with whether it is currently held."""
+    now = datetime.utcnow()
+    leases = list(db[LEASES_COLLECTION].find().sort('_id'))
+    for lease in leases:
+        lease['held'] = lease.get('expires') is not None and \
+            lease['expires'] > now
+    return leases
@@ -0,0 +1,86 @@
+#    Copyright 2013 10gen Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+When each session was last seen, buffered in the process and written to
+CLIENTS_COLLECTION in bulk.
+
+Every authorized request touches its session here, which is a dictionary
+update, instead of writing the session's timestamp. flush() writes the
+buffered sessions with one multi update per FLUSH_BATCH_SIZE of them; the
+server flushes on a schedule tied to the session expiry time, and expiry
+allows for that interval so that a session is never expired while its
+activity is still buffered.
+"""
+
+from datetime import datetime
+import logging
+import threading
+
+from pymongo.errors import PyMongoError
+
+from . import CLIENTS_COLLECTION
+
+_logger = logging.getLogger(__name__)
+
+FLUSH_BATCH_SIZE = 500  # sessions written per update
+
+
+class LivenessBuffer(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._seen = {}  # (res_id, session_id) -> datetime
+
+    def __len__(self):
+        return len(self._seen)
+
+    def touch(self, res_id, session_id):
+        now = datetime.now()
+        with self._lock:
+            self._seen[(res_id, session_id)] = now
+
+    def _restore(self, seen):
+        with self._lock:
+            for key, when in seen:
+                if self._seen.get(key, when) <= when:
+                    self._seen[key] = when
+
+    def flush(self, db, batch_size=FLUSH_BATCH_SIZE):
+        """
+        Writes the buffered sessions' timestamps and returns how many were
+        written. Each update sets a batch of sessions to the latest time any
+        of them was seen, which is at most a flush interval late for the
+        others. Sessions that could not be written stay buffered.
+        """
+        with self._lock:
+            seen, self._seen = self._seen, {}
+        seen = sorted(seen.iteritems(), key=lambda item: item[1])
+        clients = db[CLIENTS_COLLECTION]
+        for i in xrange(0, len(seen), batch_size):
+            batch = seen[i:i + batch_size]
+            query = {'$or': [{'res_id': res_id, 'session_id': session_id}
+                             for (res_id, session_id), _ in batch]}
+            try:
+                clients.update(query, {'$set': {'timestamp': batch[-1][1]}},
+                               multi=True)
+            except PyMongoError as e:
+                _logger.error('Could not record session activity: %s' % e)
+                self._restore(seen[i:])
+                return i
+        return len(seen)
+
+
+buffer = LivenessBuffer()
+touch = buffer.touch
+flush = buffer.flush
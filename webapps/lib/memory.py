@@ -0,0 +1,651 @@
+#    Copyright 2013 10gen Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+An in-memory storage engine, used in place of mongod when DB_ENGINE is
+'memory'.
+
+MemoryClient, Database, Collection and Cursor implement the part of the
+pymongo 2.7 API that the apps use, so WrappedDatabase, the quota ledger, the
+cursor registry and the scheduled jobs run on them unchanged. Query
+semantics live in query.
+
+Documents are kept in the process and are lost when it exits. Each process
+has its own copy, so a deployment using this engine must run a single
+worker. Cursors left open by find are held by the client until they are
+exhausted or killed, and are picked up again by id with resume_cursor.
+"""
+
+from collections import OrderedDict
+import copy
+from datetime import datetime, timedelta
+import random
+import threading
+import time
+
+from bson import BSON
+from bson.binary import OLD_UUID_SUBTYPE
+from bson.objectid import ObjectId
+from pymongo.errors import (DuplicateKeyError, InvalidOperation,
+                            OperationFailure)
+
+import query as mongoquery
+
+DEFAULT_BATCH_SIZE = 101  # documents in a first batch, as with mongod
+TTL_SWEEP_EVERY = 60  # seconds between removals of expired documents
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """Returns the process-wide client, so that every connection made by the
+    process sees the same data."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = MemoryClient()
+        return _client
+
+
+class MemoryClient(object):
+    max_pool_size = None
+
+    def __init__(self):
+        # One lock for all data keeps every operation atomic, as a single
+        # document write is on mongod
+        self.lock = threading.RLock()
+        self._databases = {}
+        self._cursors = {}  # cursor id -> _OpenCursor
+
+    def __getitem__(self, name):
+        with self.lock:
+            database = self._databases.get(name)
+            if database is None:
+                database = self._databases[name] = Database(self, name)
+            return database
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    def database_names(self):
+        with self.lock:
+            return [name for name, db in self._databases.iteritems()
+                    if db.collection_names()]
+
+    def drop_database(self, name):
+        with self.lock:
+            self._databases.pop(name, None)
+
+    def disconnect(self):
+        # The data outlives connections to it
+        pass
+
+    def open_cursor(self, state):
+        with self.lock:
+            cursor_id = random.getrandbits(62) + 1
+            while cursor_id in self._cursors:
+                cursor_id = random.getrandbits(62) + 1
+            self._cursors[cursor_id] = state
+            return cursor_id
+
+    def get_cursor(self, cursor_id):
+        return self._cursors.get(cursor_id)
+
+    def kill_cursors(self, cursor_ids):
+        with self.lock:
+            for cursor_id in cursor_ids:
+                self._cursors.pop(cursor_id, None)
+
+    def resume_cursor(self, cursor_id, batch_size=0):
+        return ResumedCursor(self, cursor_id)
+
+
+class Database(object):
+    def __init__(self, client, name):
+        self._client = client
+        self._name = name
+        self._collections = {}
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def connection(self):
+        return self._client
+
+    def __getitem__(self, name):
+        with self._client.lock:
+            collection = self._collections.get(name)
+            if collection is None:
+                collection = self._collections[name] = Collection(self, name)
+            return collection
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    def _fix_incoming(self, son, collection):
+        return son
+
+    def authenticate(self, *args, **kwargs):
+        return True
+
+    def collection_names(self, include_system_collections=True):
+        with self._client.lock:
+            return sorted(name for name, coll in self._collections.iteritems()
+                          if coll.exists)
+
+    def drop_collection(self, name_or_collection):
+        name = getattr(name_or_collection, 'name', name_or_collection)
+        self[name].clear()
+
+    def resume_cursor(self, cursor_id, batch_size=0):
+        return self._client.resume_cursor(cursor_id, batch_size)
+
+    def command(self, command, value=1, **kwargs):
+        if isinstance(command, basestring):
+            command = {command: value}
+        name, value = iter(command.items()).next()
+        if name == 'ping':
+            return {'ok': 1.0}
+        if name == 'collstats':
+            with self._client.lock:
+                collection = self._collections.get(value)
+                if collection is None or not collection.exists:
+                    raise OperationFailure(
+                        "command %r failed: ns not found" % command)
+                return collection.stats()
+        if name == 'dropDatabase':
+            with self._client.lock:
+                for collection in self._collections.itervalues():
+                    collection.clear()
+            return {'ok': 1.0}
+        raise OperationFailure("command %r failed: no such cmd: %s" %
+                               (command, name))
+
+
+def _id_key(value):
+    return mongoquery.sort_key(value)
+
+
+def _spec(spec):
+    if spec is None:
+        return {}
+    if not isinstance(spec, dict):
+        return {'_id': spec}
+    return spec
+
+
+def _fields(fields):
+    if fields is None or isinstance(fields, dict):
+        return fields
+    return dict((field, 1) for field in fields)
+
+
+def _index_name(keys):
+    return '_'.join('%s_%s' % (field, direction) for field, direction in keys)
+
+
+class Collection(object):
+    def __init__(self, database, name):
+        self._database = database
+        self._name = name
+        self._lock = database.connection.lock
+        self.clear()
+
+    def clear(self):
+        """Drops every document and index; the collection no longer exists
+        until it is written to again."""
+        with self._lock:
+            self.exists = False
+            self._documents = OrderedDict()  # id key -> document
+            self._sizes = {}  # id key -> BSON size of the document
+            self._size = 0
+            self._indexes = OrderedDict(
+                [('_id_', {'key': [('_id', 1)], 'v': 1})])
+            self._ttl_swept = 0
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def full_name(self):
+        return '%s.%s' % (self._database.name, self._name)
+
+    @property
+    def database(self):
+        return self._database
+
+    @property
+    def uuid_subtype(self):
+        return OLD_UUID_SUBTYPE
+
+    def __repr__(self):
+        return 'Collection(%r, %r)' % (self._database.name, self._name)
+
+    # Storage
+
+    def _store(self, document, check_keys=False):
+        size = len(BSON.encode(document, check_keys))
+        key = _id_key(document['_id'])
+        self._size += size - self._sizes.get(key, 0)
+        self._sizes[key] = size
+        self._documents[key] = document
+        self.exists = True
+
+    def _insert(self, document):
+        if '_id' not in document:
+            document['_id'] = ObjectId()
+        key = _id_key(document['_id'])
+        if key in self._documents:
+            raise DuplicateKeyError(
+                'E11000 duplicate key error index: %s.$_id_  dup key: '
+                '{ : %r }' % (self.full_name, document['_id']), 11000)
+        self._store(copy.deepcopy(document), check_keys=True)
+
+    def _delete(self, document):
+        key = _id_key(document['_id'])
+        del self._documents[key]
+        self._size -= self._sizes.pop(key)
+
+    def _matching(self, spec):
+        """Returns the stored documents matching spec, in natural order."""
+        self._expire()
+        spec = _spec(spec)
+        _id = spec.get('_id', {})
+        if not isinstance(_id, dict) and mongoquery._regex(_id) is None:
+            # Looking up a single document by _id, as the ledgers do
+            document = self._documents.get(_id_key(_id))
+            if document is None or not mongoquery.match(document, spec):
+                return []
+            return [document]
+        return [d for d in self._documents.itervalues()
+                if mongoquery.match(d, spec)]
+
+    def _expire(self):
+        """Removes documents past the expiry of a TTL index, at most every
+        TTL_SWEEP_EVERY seconds, as mongod's TTL monitor does."""
+        ttls = [(info['key'][0][0], info['expireAfterSeconds'])
+                for info in self._indexes.itervalues()
+                if 'expireAfterSeconds' in info]
+        if not ttls or time.time() - self._ttl_swept < TTL_SWEEP_EVERY:
+            return
+        self._ttl_swept = time.time()
+        now = datetime.utcnow()
+        for field, seconds in ttls:
+            expiry = now - timedelta(seconds=seconds)
+            for document in self._documents.values():
+                dates = [v for v in mongoquery.resolve(document, field)
+                         if isinstance(v, datetime)]
+                if dates and min(dates) < expiry:
+                    self._delete(document)
+
+    def _updated(self, document, update):
+        """Returns a copy of document with update applied."""
+        if mongoquery.is_replacement(update):
+            updated = copy.deepcopy(update)
+            if '_id' in updated and \
+                    not mongoquery.values_equal(updated['_id'],
+                                                document['_id']):
+                raise OperationFailure('The _id field cannot be changed')
+            updated['_id'] = document['_id']
+        else:
+            updated = copy.deepcopy(document)
+            mongoquery.apply_update(updated, update)
+        return updated
+
+    def stats(self):
+        count = len(self._documents)
+        return {
+            'ns': self.full_name,
+            'count': count,
+            'size': self._size,
+            'avgObjSize': self._size // count if count else 0,
+            'storageSize': self._size,
+            'nindexes': len(self._indexes),
+            'ok': 1.0
+        }
+
+    # pymongo Collection API
+
+    def insert(self, doc_or_docs, manipulate=True, *args, **kwargs):
+        many = isinstance(doc_or_docs, list)
+        documents = doc_or_docs if many else [doc_or_docs]
+        if not documents:
+            raise InvalidOperation('cannot do an empty bulk insert')
+        ids = []
+        with self._lock:
+            for document in documents:
+                if not manipulate:
+                    document = dict(document)
+                self._insert(document)
+                ids.append(document['_id'])
+        return ids if many else ids[0]
+
+    def save(self, to_save, *args, **kwargs):
+        if '_id' not in to_save:
+            return self.insert(to_save)
+        self.update({'_id': to_save['_id']}, to_save, True)
+        return to_save['_id']
+
+    def update(self, spec, document, upsert=False, manipulate=False,
+               safe=None, multi=False, *args, **kwargs):
+        if not isinstance(document, dict):
+            raise TypeError('document must be an instance of dict')
+        with self._lock:
+            if multi and mongoquery.is_replacement(document):
+                raise OperationFailure(
+                    'multi update only works with $ operators')
+            matched = self._matching(spec)
+            if not multi:
+                matched = matched[:1]
+            modified = 0
+            for original in matched:
+                updated = self._updated(original, document)
+                if not mongoquery.values_equal(updated, original):
+                    self._store(updated)
+                    modified += 1
+            result = {'ok': 1, 'n': len(matched), 'nModified': modified}
+            if not matched and upsert:
+                inserted = mongoquery.upsert_document(spec, document)
+                self._insert(inserted)
+                result['n'] = 1
+                result['upserted'] = [{'index': 0, '_id': inserted['_id']}]
+        result['updatedExisting'] = bool(result['n']) and \
+            'upserted' not in result
+        return result
+
+    def remove(self, spec_or_id=None, safe=None, multi=True, *args,
+               **kwargs):
+        with self._lock:
+            matched = self._matching(spec_or_id)
+            if not multi:
+                matched = matched[:1]
+            for document in matched:
+                self._delete(document)
+        return {'ok': 1, 'n': len(matched)}
+
+    def find(self, spec=None, fields=None, skip=0, limit=0, sort=None,
+             *args, **kwargs):
+        cursor = Cursor(self, spec, _fields(fields), skip, limit)
+        if sort:
+            cursor.sort(sort)
+        return cursor
+
+    def find_one(self, spec_or_id=None, *args, **kwargs):
+        for document in self.find(_spec(spec_or_id), *args,
+                                  **kwargs).limit(-1):
+            return document
+        return None
+
+    def count(self):
+        with self._lock:
+            self._expire()
+            return len(self._documents)
+
+    def find_and_modify(self, query={}, update=None, upsert=False, sort=None,
+                        full_response=False, new=False, fields=None,
+                        remove=False, **kwargs):
+        if bool(update) == bool(remove):
+            raise ValueError('Must either update or remove')
+        with self._lock:
+            matched = self._matching(query)
+            if sort:
+                matched = mongoquery.sort(list(matched),
+                                          mongoquery.normalize_sort(sort))
+            result = None
+            if matched and remove:
+                result = matched[0]
+                self._delete(result)
+            elif matched:
+                updated = self._updated(matched[0], update)
+                self._store(updated)
+                result = updated if new else matched[0]
+            elif upsert and not remove:
+                inserted = mongoquery.upsert_document(query, update)
+                self._insert(inserted)
+                if new:
+                    result = self._documents[_id_key(inserted['_id'])]
+            if result is not None:
+                result = mongoquery.project(result, _fields(fields))
+        if full_response:
+            return {'value': result, 'ok': 1.0}
+        return result
+
+    def aggregate(self, pipeline, **kwargs):
+        out = None
+        if isinstance(pipeline, list) and pipeline and \
+                isinstance(pipeline[-1], dict) and \
+                pipeline[-1].keys() == ['$out']:
+            # As with mongod, the results replace the documents of the
+            # target collection, which keeps its indexes
+            out = pipeline[-1]['$out']
+            pipeline = pipeline[:-1]
+        with self._lock:
+            self._expire()
+            documents = list(self._documents.itervalues())
+            result = mongoquery.aggregate(documents, pipeline)
+            if out is None:
+                return {'result': result, 'ok': 1.0}
+            target = self._database[out]
+            target._documents = OrderedDict()
+            target._sizes = {}
+            target._size = 0
+            for document in result:
+                target._insert(document)
+            target.exists = True
+            return {'result': [], 'ok': 1.0}
+
+    def create_index(self, key_or_list, cache_for=300, **kwargs):
+        keys = mongoquery.normalize_sort(key_or_list)
+        name = kwargs.pop('name', None) or _index_name(keys)
+        for option in ('background', 'drop_dups', 'dropDups'):
+            kwargs.pop(option, None)
+        info = dict(kwargs, key=keys, v=1)
+        with self._lock:
+            existing = self._indexes.get(name)
+            if existing is not None and existing != info:
+                raise OperationFailure(
+                    'Index with name: %s already exists with different '
+                    'options' % name)
+            if kwargs.get('unique'):
+                raise OperationFailure('unique indexes are not supported by '
+                                       'the memory engine')
+            self._indexes[name] = info
+            self.exists = True
+        return name
+
+    ensure_index = create_index
+
+    def index_information(self):
+        with self._lock:
+            return copy.deepcopy(dict(self._indexes))
+
+    def drop(self):
+        self._database.drop_collection(self._name)
+
+    def rename(self, new_name, **kwargs):
+        with self._lock:
+            if not self.exists:
+                raise OperationFailure('source namespace does not exist')
+            target = self._database[new_name]
+            if target.exists and not kwargs.get('dropTarget'):
+                raise OperationFailure('target namespace exists')
+            for attr in ('exists', '_documents', '_sizes', '_size',
+                         '_indexes', '_ttl_swept'):
+                setattr(target, attr, getattr(self, attr))
+            self.clear()
+
+
+class _OpenCursor(object):
+    """The results of a query, and how far a client has read them."""
+
+    def __init__(self, documents):
+        self.documents = documents
+        self.position = 0
+
+    @property
+    def exhausted(self):
+        return self.position >= len(self.documents)
+
+
+class Cursor(object):
+    def __init__(self, collection, spec, fields, skip, limit):
+        self._collection = collection
+        self._client = collection.database.connection
+        self._spec = _spec(spec)
+        self._fields = fields
+        self._skip = skip or 0
+        self._limit = limit or 0
+        self._sort = None
+        self._batch_size = 0
+        self._state = None
+        self.cursor_id = 0
+
+    def _check_unstarted(self):
+        if self._state is not None:
+            raise InvalidOperation('cannot set options after executing query')
+
+    def batch_size(self, batch_size):
+        if batch_size < 0:
+            raise ValueError('batch_size must be >= 0')
+        self._check_unstarted()
+        self._batch_size = batch_size
+        return self
+
+    def sort(self, key_or_list, direction=None):
+        self._check_unstarted()
+        self._sort = mongoquery.normalize_sort(key_or_list, direction)
+        return self
+
+    def skip(self, skip):
+        self._check_unstarted()
+        self._skip = skip
+        return self
+
+    def limit(self, limit):
+        self._check_unstarted()
+        self._limit = limit
+        return self
+
+    def _results(self, with_limit_and_skip=True):
+        with self._client.lock:
+            documents = self._collection._matching(self._spec)
+            if self._sort:
+                documents = mongoquery.sort(list(documents), self._sort)
+            if with_limit_and_skip:
+                if self._skip:
+                    documents = documents[self._skip:]
+                if self._limit:
+                    documents = documents[:abs(self._limit)]
+            return [mongoquery.project(d, self._fields) for d in documents]
+
+    def count(self, with_limit_and_skip=False):
+        with self._client.lock:
+            documents = self._collection._matching(self._spec)
+            count = len(documents)
+        if with_limit_and_skip:
+            count = max(count - self._skip, 0)
+            if self._limit:
+                count = min(count, abs(self._limit))
+        return count
+
+    def _execute(self):
+        self._state = _OpenCursor(self._results())
+        first_batch = self._batch_size or DEFAULT_BATCH_SIZE
+        if self._limit:
+            first_batch = min(first_batch, abs(self._limit))
+        # A negative limit asks for a single batch and no cursor
+        if self._limit >= 0 and len(self._state.documents) > first_batch:
+            self.cursor_id = self._client.open_cursor(self._state)
+
+    @property
+    def alive(self):
+        return self._state is None or not self._state.exhausted
+
+    def __getitem__(self, index):
+        self._check_unstarted()
+        if isinstance(index, slice):
+            if index.step is not None or (index.start or 0) < 0 or \
+                    (index.stop or 0) < 0:
+                raise IndexError('Cursor slices must be positive and have '
+                                 'no step')
+            start = index.start or 0
+            self._skip += start
+            if index.stop is not None:
+                self._limit = max(index.stop - start, 0) or -1
+            return self
+        documents = self._results()
+        if not 0 <= index < len(documents):
+            raise IndexError('no such item for Cursor instance')
+        return documents[index]
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self._state is None:
+            self._execute()
+        return _next(self._client, self._state, self.cursor_id)
+
+
+def _next(client, state, cursor_id):
+    with client.lock:
+        if state.exhausted:
+            raise StopIteration
+        document = state.documents[state.position]
+        state.position += 1
+        if state.exhausted and cursor_id:
+            # mongod closes a cursor once it has returned every document
+            client.kill_cursors([cursor_id])
+        return document
+
+
+class ResumedCursor(object):
+    """A cursor opened by an earlier request, picked up again by id. Reading
+    it raises OperationFailure if the cursor has been killed."""
+
+    def __init__(self, client, cursor_id):
+        self._client = client
+        self.cursor_id = cursor_id
+        self._finished = False
+
+    def batch_size(self, batch_size):
+        return self
+
+    @property
+    def alive(self):
+        return not self._finished and \
+            self._client.get_cursor(self.cursor_id) is not None
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self._finished:
+            raise StopIteration
+        state = self._client.get_cursor(self.cursor_id)
+        if state is None:
+            raise OperationFailure('cursor id %r not valid at server' %
+                                   self.cursor_id)
+        try:
+            return _next(self._client, state, self.cursor_id)
+        finally:
+            self._finished = state.exhausted
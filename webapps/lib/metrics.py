@@ -0,0 +1,387 @@
+#    Copyright 2013 10gen Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+In-process counters and histograms, exposed in the Prometheus text format.
+
+Every metric is declared in METRICS. Recording one is a dictionary update
+under a lock, so it is cheap enough to do on every request and every Mongo
+operation. init_app times each request and adds a METRICS_PATH route that
+renders the metrics.
+
+Each worker process keeps its own figures. When METRICS_DIR is set, workers
+also write a snapshot of their figures there, at most every
+METRICS_FLUSH_EVERY seconds, and the metrics endpoint sums the snapshots of
+all workers, so a scrape sees the same totals whichever worker answers it.
+Each worker also rewrites its snapshot every interval while idle, so one
+not written for STALE_FLUSHES intervals belongs to a worker that exited,
+and is deleted rather than summed.
+
+The endpoint is only served to scrapes sending METRICS_TOKEN as a bearer
+token.
+"""
+
+from bisect import bisect_left
+import glob
+import json
+import logging
+import os
+import threading
+import time
+
+from flask import Response, g, request
+
+from MWSServerError import MWSServerError
+
+_logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+JOB_BUCKETS = (0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+STALE_FLUSHES = 3  # flush intervals without a snapshot before it is dropped
+
+# name -> (type, help, histogram buckets)
+METRICS = {
+    'mws_http_requests_total': (
+        'counter', 'Requests handled, by endpoint and status code.', None),
+    'mws_http_request_duration_seconds': (
+        'histogram', 'Time spent handling requests.', LATENCY_BUCKETS),
+    'mws_http_response_bytes_total': (
+        'counter', 'Bytes of response bodies returned.', None),
+    'mws_stage_duration_seconds': (
+        'histogram', 'Time spent in rate limiting and quota checks.',
+        LATENCY_BUCKETS),
+    'mws_mongo_operations_total': (
+        'counter', 'Operations sent to Mongo on behalf of res_ids.', None),
+    'mws_cursors_opened_total': (
+        'counter', 'Cursors left open for a shell by find.', None),
+    'mws_cursors_closed_total': (
+        'counter', 'Registered cursors killed.', None),
+    'mws_scheduler_job_duration_seconds': (
+        'histogram', 'Time taken by scheduled jobs.', JOB_BUCKETS),
+    'mws_sandbox_claims_total': (
+        'counter', 'Init script requests, by whether a warm sandbox was '
+        'used.', None),
+    'mws_template_clones_total': (
+        'counter', 'Collections set up from template datasets, by whether '
+        'they were cloned or loaded.', None),
+    'mws_grades_total': (
+        'counter', 'Attempts to send grades, by outcome.', None),
+    'mws_grading_duration_seconds': (
+        'histogram', 'Time taken by the grading server to answer.',
+        LATENCY_BUCKETS),
+    'mws_cache_entries': (
+        'gauge', 'Entries held by in-process caches.', None),
+    'mws_cache_bytes': (
+        'gauge', 'Bytes held by size-bounded in-process caches.', None),
+    'mws_cache_hits_total': (
+        'counter', 'In-process cache hits.', None),
+    'mws_cache_misses_total': (
+        'counter', 'In-process cache misses.', None),
+}
+
+
+def _key(labels):
+    return tuple(sorted(labels.iteritems()))
+
+
+class Registry(object):
+    """Holds the figures of one process. Safe to use from any thread."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {}  # (name, labels) -> number
+        self._histograms = {}  # (name, labels) -> [bucket counts, sum, count]
+        self._collectors = []
+
+    def inc(self, name, value=1, **labels):
+        key = (name, _key(labels))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        buckets = METRICS[name][2]
+        key = (name, _key(labels))
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = [[0] * len(buckets), 0.0, 0]
+            i = bisect_left(buckets, value)
+            if i < len(buckets):
+                hist[0][i] += 1
+            hist[1] += value
+            hist[2] += 1
+
+    def add_collector(self, collector):
+        """collector() is called on every snapshot and returns
+        [(name, labels, value)] for figures read rather than recorded, such
+        as cache sizes."""
+        self._collectors.append(collector)
+
+    def snapshot(self):
+        """Returns the figures as a JSON serializable dict."""
+        values = []
+        with self._lock:
+            for (name, labels), value in self._values.iteritems():
+                values.append([name, labels, value])
+            histograms = [[name, labels, list(hist[0]), hist[1], hist[2]]
+                          for (name, labels), hist
+                          in self._histograms.iteritems()]
+        for collector in self._collectors:
+            for name, labels, value in collector():
+                values.append([name, _key(labels), value])
+        return {'values': values, 'histograms': histograms}
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+            self._histograms.clear()
+
+
+registry = Registry()
+inc = registry.inc
+observe = registry.observe
+add_collector = registry.add_collector
+
+
+def cache_collector(name, cache):
+    """Returns a collector reporting the stats() of an LRUCache or
+    SizedLRUCache."""
+    def collect():
+        stats = cache.stats()
+        figures = [('mws_cache_entries', {'cache': name}, stats['size']),
+                   ('mws_cache_hits_total', {'cache': name}, stats['hits']),
+                   ('mws_cache_misses_total', {'cache': name},
+                    stats['misses'])]
+        if 'bytes' in stats:
+            figures.append(('mws_cache_bytes', {'cache': name},
+                            stats['bytes']))
+        return figures
+    return collect
+
+
+class timed(object):
+    """Context manager observing the time taken by its block in the
+    histogram name."""
+
+    def __init__(self, name, **labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        observe(self.name, time.time() - self.start, **self.labels)
+
+
+def merge(snapshots):
+    """Sums snapshots into {(name, labels): value} and
+    {(name, labels): [bucket counts, sum, count]}."""
+    values = {}
+    histograms = {}
+    for snap in snapshots:
+        for name, labels, value in snap['values']:
+            key = (name, tuple(tuple(label) for label in labels))
+            values[key] = values.get(key, 0) + value
+        for name, labels, buckets, total, count in snap['histograms']:
+            key = (name, tuple(tuple(label) for label in labels))
+            hist = histograms.get(key)
+            if hist is None:
+                histograms[key] = [list(buckets), total, count]
+            else:
+                hist[0] = [a + b for a, b in zip(hist[0], buckets)]
+                hist[1] += total
+                hist[2] += count
+    return values, histograms
+
+
+def _escape(value):
+    return unicode(value).replace('\\', '\\\\').replace(
+        '"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('%s="%s"' % (k, _escape(v)) for k, v in pairs) + '}'
+
+
+def _number(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def render(snapshots):
+    """Renders snapshots, summed, in the Prometheus text format."""
+    values, histograms = merge(snapshots)
+    lines = []
+    for name in sorted(METRICS):
+        kind, description, buckets = METRICS[name]
+        lines.append('# HELP %s %s' % (name, description))
+        lines.append('# TYPE %s %s' % (name, kind))
+        if kind == 'histogram':
+            for (n, labels), (counts, total, count) in sorted(
+                    histograms.iteritems()):
+                if n != name:
+                    continue
+                cumulative = 0
+                for bound, bucket in zip(buckets, counts):
+                    cumulative += bucket
+                    lines.append('%s_bucket%s %d' % (
+                        name, _labels(labels, [('le', repr(bound))]),
+                        cumulative))
+                lines.append('%s_bucket%s %d' % (
+                    name, _labels(labels, [('le', '+Inf')]), count))
+                lines.append('%s_sum%s %s' % (name, _labels(labels),
+                                              _number(total)))
+                lines.append('%s_count%s %d' % (name, _labels(labels), count))
+        else:
+            for (n, labels), value in sorted(values.iteritems()):
+                if n == name:
+                    lines.append('%s%s %s' % (name, _labels(labels),
+                                              _number(value)))
+    return '\n'.join(lines) + '\n'
+
+
+class SnapshotWriter(object):
+    """Writes this process' snapshot to directory, at most every interval
+    seconds, and reads back the snapshots of all processes."""
+
+    def __init__(self, directory, interval):
+        self.directory = directory
+        self.interval = interval
+        self._last = 0
+        self._lock = threading.Lock()
+        self._flusher_pid = None
+
+    @property
+    def path(self):
+        # Recomputed so that workers forked after init_app use their own file
+        return os.path.join(self.directory, 'metrics-%d.json' % os.getpid())
+
+    def maybe_flush(self):
+        if self._flusher_pid != os.getpid():
+            self._start_flusher()
+        now = time.time()
+        if now - self._last < self.interval:
+            return
+        with self._lock:
+            if now - self._last < self.interval:
+                return
+            self._last = now
+        self.flush()
+
+    def _start_flusher(self):
+        # Keeps an idle worker's snapshot from going stale. Started on the
+        # first request of each process, as threads do not survive a fork.
+        with self._lock:
+            if self._flusher_pid == os.getpid():
+                return
+            self._flusher_pid = os.getpid()
+
+        def run():
+            while True:
+                time.sleep(self.interval)
+                self.flush()
+        thread = threading.Thread(target=run, name='MetricsFlusher')
+        thread.daemon = True
+        thread.start()
+
+    def flush(self):
+        path = self.path
+        tmp = path + '.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(registry.snapshot(), f)
+            os.rename(tmp, path)
+        except (IOError, OSError) as e:
+            _logger.error('Could not write metrics to %s: %s' % (path, e))
+
+    def snapshots(self):
+        """This process' live snapshot and the last one of every other that
+        is still writing them."""
+        own = self.path
+        snaps = [registry.snapshot()]
+        stale = time.time() - STALE_FLUSHES * self.interval
+        for path in glob.glob(os.path.join(self.directory, 'metrics-*.json')):
+            if path == own:
+                continue
+            try:
+                if os.path.getmtime(path) < stale:
+                    os.remove(path)
+                    continue
+                with open(path) as f:
+                    snaps.append(json.load(f))
+            except (IOError, OSError, ValueError) as e:
+                _logger.warning('Could not read metrics from %s: %s' %
+                                (path, e))
+        return snaps
+
+
+def init_app(app):
+    """Times every request to app and adds the metrics endpoint."""
+    if not app.config.get('METRICS_ENABLED', True):
+        return
+    path = app.config.get('METRICS_PATH', '/metrics')
+    directory = app.config.get('METRICS_DIR')
+    writer = None
+    if directory:
+        writer = SnapshotWriter(directory,
+                                app.config.get('METRICS_FLUSH_EVERY', 5))
+
+    @app.before_request
+    def start_timer():
+        g.metrics_start = time.time()
+
+    @app.after_request
+    def record_request(response):
+        start = getattr(g, 'metrics_start', None)
+        if start is None or request.path == path:
+            return response
+        endpoint = request.endpoint or 'unmatched'
+        inc('mws_http_requests_total', endpoint=endpoint,
+            method=request.method, status=response.status_code)
+        observe('mws_http_request_duration_seconds', time.time() - start,
+                endpoint=endpoint)
+        if response.is_streamed:
+            response.response = _count_bytes(response.response, endpoint)
+        else:
+            inc('mws_http_response_bytes_total',
+                response.content_length or 0, endpoint=endpoint)
+        if writer is not None:
+            writer.maybe_flush()
+        return response
+
+    def metrics_view():
+        token = app.config.get('METRICS_TOKEN')
+        if (not token or
+                request.headers.get('Authorization') != 'Bearer ' + token):
+            raise MWSServerError(403, 'Not authorized to view metrics')
+        snaps = writer.snapshots() if writer else [registry.snapshot()]
+        return Response(render(snaps),
+                        mimetype='text/plain; version=0.0.4')
+    app.add_url_rule(path, 'metrics', metrics_view)
+
+
+def _count_bytes(body, endpoint):
+    sent = 0
+    try:
+        for chunk in body:
+            sent += len(chunk)
+            yield chunk
+    finally:
+        inc('mws_http_response_bytes_total', sent, endpoint=endpoint)
@@ -0,0 +1,172 @@
+#    Copyright 2013 10gen Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Profiles a sample of requests with cProfile.
+
+init_app profiles PROFILE_SAMPLE_RATE of the requests to app, and every
+request whose PROFILE_HEADER carries PROFILE_TOKEN. Each profile is written
+to PROFILE_DIR as a pstats file named after the endpoint and the time, and
+only the PROFILE_MAX_DUMPS most recent files are kept. PROFILE_SUMMARY_PATH
+serves the functions taking the most time, per endpoint, over all the files
+kept, to requests carrying the token.
+
+Nothing is profiled unless PROFILE_DIR is set.
+"""
+
+import cProfile
+import glob
+import logging
+import os
+import pstats
+import random
+import re
+import threading
+import time
+
+from flask import g, jsonify, request
+
+from MWSServerError import MWSServerError
+
+_logger = logging.getLogger(__name__)
+
+DUMP_SUFFIX = '.pstats'
+_UNSAFE_CHARS = re.compile(r'[^A-Za-z0-9_.]')
+
+
+def dump_name(endpoint, timestamp=None):
+    """Returns the name of the file holding a profile of endpoint."""
+    if timestamp is None:
+        timestamp = time.time()
+    # Dashes are replaced in the endpoint, so endpoint_of can split on them
+    return '%s-%d-%d%s' % (_UNSAFE_CHARS.sub('_', endpoint),
+                           int(timestamp * 1000), os.getpid(), DUMP_SUFFIX)
+
+
+def endpoint_of(path):
+    return os.path.basename(path).split('-', 1)[0]
+
+
+def dumps(directory):
+    """Returns the dump files in directory, oldest first."""
+    paths = glob.glob(os.path.join(directory, '*' + DUMP_SUFFIX))
+    return sorted(paths, key=lambda p: int(os.path.basename(p).split('-')[1]))
+
+
+def rotate(directory, keep):
+    """Removes all but the keep most recent dumps in directory."""
+    paths = dumps(directory)
+    for path in paths[:max(len(paths) - keep, 0)]:
+        try:
+            os.remove(path)
+        except OSError:
+            # Removed concurrently by another worker
+            pass
+
+
+def summarize(directory, top):
+    """
+    Returns {endpoint: {'requests': n, 'functions': [...]}}, listing for each
+    endpoint the top functions by cumulative time over all its dumps.
+    """
+    by_endpoint = {}
+    for path in dumps(directory):
+        by_endpoint.setdefault(endpoint_of(path), []).append(path)
+
+    summary = {}
+    for endpoint, paths in by_endpoint.iteritems():
+        stats = None
+        loaded = 0
+        for path in paths:
+            try:
+                if stats is None:
+                    stats = pstats.Stats(path)
+                else:
+                    stats.add(path)
+                loaded += 1
+            except (IOError, EOFError, ValueError) as e:
+                # Rotated away or still being written
+                _logger.debug('Skipping profile %s: %s' % (path, e))
+        if stats is None:
+            continue
+        functions = []
+        for (filename, line, name), (_, calls, total, cumulative, _) in \
+                stats.stats.iteritems():
+            functions.append({
+                'function': '%s:%d(%s)' % (filename, line, name),
+                'calls': calls,
+                'total_time': total,
+                'cumulative_time': cumulative
+            })
+        functions.sort(key=lambda f: f['cumulative_time'], reverse=True)
+        summary[endpoint] = {'requests': loaded, 'functions': functions[:top]}
+    return summary
+
+
+class RequestProfiler(object):
+    def __init__(self, app):
+        config = app.config
+        self.directory = config['PROFILE_DIR']
+        self.sample_rate = config.get('PROFILE_SAMPLE_RATE', 0)
+        self.header = config.get('PROFILE_HEADER', 'X-MWS-Profile')
+        self.token = config.get('PROFILE_TOKEN')
+        self.max_dumps = config.get('PROFILE_MAX_DUMPS', 200)
+        self.top = config.get('PROFILE_SUMMARY_TOP', 25)
+        self._lock = threading.Lock()
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def authorized(self):
+        return bool(self.token) and \
+            request.headers.get(self.header) == self.token
+
+    def start(self):
+        if random.random() < self.sample_rate or self.authorized():
+            g.profile = cProfile.Profile()
+            g.profile.enable()
+
+    def stop(self, exc=None):
+        profile = getattr(g, 'profile', None)
+        if profile is None:
+            return
+        profile.disable()
+        g.profile = None
+        endpoint = request.endpoint or 'unmatched'
+        path = os.path.join(self.directory, dump_name(endpoint))
+        try:
+            profile.dump_stats(path)
+        except (IOError, OSError) as e:
+            _logger.error('Could not write profile to %s: %s' % (path, e))
+            return
+        with self._lock:
+            rotate(self.directory, self.max_dumps)
+
+    def summary_view(self):
+        if not self.authorized():
+            raise MWSServerError(403, 'Not authorized to view profiles')
+        return jsonify(summarize(self.directory, self.top))
+
+
+def init_app(app):
+    """Profiles requests to app if PROFILE_DIR is set."""
+    if not app.config.get('PROFILE_DIR'):
+        return None
+    profiler = RequestProfiler(app)
+    app.before_request(profiler.start)
+    # teardown rather than after_request, so that requests that raise are
+    # profiled too
+    app.teardown_request(profiler.stop)
+    app.add_url_rule(app.config.get('PROFILE_SUMMARY_PATH', '/profiles'),
+                     'profiles', profiler.summary_view)
+    return profiler
@@ -0,0 +1,861 @@
+#    Copyright 2013 10gen Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Query, projection, sort, update and aggregation semantics for the in-memory
+storage engine, written against plain documents.
+
+These follow mongod 2.6 for the features the mws and ivs apps use. Anything
+else raises OperationFailure with a message saying it is unsupported, rather
+than silently giving a different answer than mongod would.
+"""
+
+import copy
+from datetime import datetime
+import re
+
+from bson.objectid import ObjectId
+from pymongo.errors import OperationFailure
+
+try:
+    from bson.regex import Regex
+except ImportError:
+    Regex = None
+
+_MISSING = object()
+_PATTERN_TYPE = type(re.compile(''))
+
+
+def _regex(value):
+    """Returns value as a compiled pattern if it is a regular expression."""
+    if isinstance(value, _PATTERN_TYPE):
+        return value
+    if Regex is not None and isinstance(value, Regex):
+        return value.try_compile()
+    return None
+
+
+def _type_rank(value):
+    """The position of the type of value in mongod's comparison order."""
+    if value is None or value is _MISSING:
+        return 1
+    if isinstance(value, bool):
+        return 8
+    if isinstance(value, (int, long, float)):
+        return 2
+    if isinstance(value, basestring):
+        return 3
+    if isinstance(value, dict):
+        return 4
+    if isinstance(value, (list, tuple)):
+        return 5
+    if isinstance(value, ObjectId):
+        return 7
+    if isinstance(value, datetime):
+        return 9
+    if _regex(value) is not None:
+        return 11
+    return 6
+
+
+def sort_key(value):
+    """Returns a key ordering values like mongod orders BSON values."""
+    rank = _type_rank(value)
+    if rank == 1:
+        return (rank, None)
+    if rank == 4:
+        # Documents decoded from JSON have lost their field order, so fields
+        # are compared by name
+        return (rank, tuple(sorted((k, sort_key(v))
+                                   for k, v in value.iteritems())))
+    if rank == 5:
+        return (rank, tuple(sort_key(v) for v in value))
+    if rank == 11:
+        return (rank, _regex(value).pattern)
+    return (rank, value)
+
+
+def values_equal(a, b):
+    return sort_key(a) == sort_key(b)
+
+
+def split_path(path):
+    return path.split('.')
+
+
+def resolve(document, path):
+    """
+    Returns the values found at the dotted path in document. Arrays met on
+    the way are looked into, so 'a.b' finds b in every document of array a.
+    An empty list means the path is missing.
+    """
+    return _resolve(document, split_path(path))
+
+
+def _resolve(value, parts):
+    if not parts:
+        return [value]
+    head, rest = parts[0], parts[1:]
+    if isinstance(value, dict):
+        if head in value:
+            return _resolve(value[head], rest)
+        return []
+    if isinstance(value, list):
+        found = []
+        if head.isdigit():
+            index = int(head)
+            if index < len(value):
+                found.extend(_resolve(value[index], rest))
+        for item in value:
+            if isinstance(item, dict):
+                found.extend(_resolve(item, parts))
+        return found
+    return []
+
+
+def _with_elements(values):
+    """values, plus the elements of those that are arrays."""
+    expanded = []
+    for value in values:
+        expanded.append(value)
+        if isinstance(value, list):
+            expanded.extend(value)
+    return expanded
+
+
+def _comparable(a, b):
+    # As in mongod, $gt and friends only compare values of the same type
+    return _type_rank(a) == _type_rank(b)
+
+
+def _compare_op(op):
+    def compare(candidates, operand):
+        for value in _with_elements(candidates):
+            if not _comparable(value, operand):
+                continue
+            a, b = sort_key(value), sort_key(operand)
+            if op == '$gt' and a > b or op == '$gte' and a >= b or \
+                    op == '$lt' and a < b or op == '$lte' and a <= b:
+                return True
+        return False
+    return compare
+
+
+def _eq(candidates, operand):
+    if operand is None and not candidates:
+        return True
+    pattern = _regex(operand)
+    for value in _with_elements(candidates):
+        if pattern is not None and isinstance(value, basestring):
+            if pattern.search(value):
+                return True
+        elif values_equal(value, operand):
+            return True
+    return False
+
+
+def _in(candidates, operand):
+    if not isinstance(operand, list):
+        raise OperationFailure('$in needs an array')
+    return any(_eq(candidates, value) for value in operand)
+
+
+def _all(candidates, operand):
+    if not isinstance(operand, list):
+        raise OperationFailure('$all needs an array')
+    if not operand:
+        return False
+    for value in operand:
+        if isinstance(value, dict) and '$elemMatch' in value:
+            if not _elem_match(candidates, value['$elemMatch']):
+                return False
+        elif not _eq(candidates, value):
+            return False
+    return True
+
+
+def _size(candidates, operand):
+    return any(isinstance(v, list) and len(v) == operand for v in candidates)
+
+
+def _exists(candidates, operand):
+    return bool(candidates) == bool(operand)
+
+
+def _mod(candidates, operand):
+    if not isinstance(operand, list) or len(operand) != 2 or not operand[0]:
+        raise OperationFailure('bad $mod')
+    divisor, remainder = operand
+    return any(isinstance(v, (int, long, float)) and
+               not isinstance(v, bool) and int(v) % divisor == remainder
+               for v in _with_elements(candidates))
+
+
+def _regex_op(candidates, operand, options=''):
+    pattern = _regex(operand)
+    if pattern is None:
+        flags = 0
+        for option in options:
+            flags |= {'i': re.I, 'm': re.M, 's': re.S, 'x': re.X}.get(option, 0)
+        pattern = re.compile(operand, flags)
+    return any(isinstance(v, basestring) and pattern.search(v)
+               for v in _with_elements(candidates))
+
+
+def _elem_match(candidates, operand):
+    if not isinstance(operand, dict):
+        raise OperationFailure('$elemMatch needs an Object')
+    operators = operand and all(k.startswith('$') for k in operand)
+    for value in candidates:
+        if not isinstance(value, list):
+            continue
+        for element in value:
+            if operators:
+                if _match_operators([element], operand):
+                    return True
+            elif isinstance(element, dict) and match(element, operand):
+                return True
+    return False
+
+
+def _type(candidates, operand):
+    ranks = {1: 2, 16: 2, 18: 2, 2: 3, 3: 4, 4: 5, 7: 7, 8: 8, 9: 9, 10: 1,
+             11: 11}
+    if operand not in ranks:
+        raise OperationFailure('$type %r is not supported by the memory '
+                               'engine' % operand)
+    return any(_type_rank(v) == ranks[operand]
+               for v in _with_elements(candidates))
+
+
+_OPERATORS = {
+    '$eq': _eq,
+    '$ne': lambda c, o: not _eq(c, o),
+    '$gt': _compare_op('$gt'),
+    '$gte': _compare_op('$gte'),
+    '$lt': _compare_op('$lt'),
+    '$lte': _compare_op('$lte'),
+    '$in': _in,
+    '$nin': lambda c, o: not _in(c, o),
+    '$all': _all,
+    '$size': _size,
+    '$exists': _exists,
+    '$mod': _mod,
+    '$elemMatch': _elem_match,
+    '$type': _type,
+}
+
+
+def _is_operator_document(value):
+    return isinstance(value, dict) and bool(value) and \
+        all(k.startswith('$') for k in value)
+
+
+def _match_operators(candidates, operators):
+    for op, operand in operators.iteritems():
+        if op == '$regex':
+            if not _regex_op(candidates, operand, operators.get('$options', '')):
+                return False
+        elif op == '$options':
+            if '$regex' not in operators:
+                raise OperationFailure('$options needs a $regex')
+        elif op == '$not':
+            if _is_operator_document(operand):
+                if _match_operators(candidates, operand):
+                    return False
+            elif _regex(operand) is not None:
+                if _eq(candidates, operand):
+                    return False
+            else:
+                raise OperationFailure('$not needs a regex or a document')
+        elif op in _OPERATORS:
+            if not _OPERATORS[op](candidates, operand):
+                return False
+        else:
+            raise OperationFailure('unknown operator: %s' % op)
+    return True
+
+
+def match(document, query):
+    """Returns True if document matches the query document."""
+    if not query:
+        return True
+    for key, condition in query.iteritems():
+        if key == '$and':
+            if not all(match(document, q) for q in _clauses(key, condition)):
+                return False
+        elif key == '$or':
+            if not any(match(document, q) for q in _clauses(key, condition)):
+                return False
+        elif key == '$nor':
+            if any(match(document, q) for q in _clauses(key, condition)):
+                return False
+        elif key.startswith('$'):
+            raise OperationFailure('unknown top level operator: %s' % key)
+        else:
+            candidates = resolve(document, key)
+            if _is_operator_document(condition):
+                if not _match_operators(candidates, condition):
+                    return False
+            elif not _eq(candidates, condition):
+                return False
+    return True
+
+
+def _clauses(operator, condition):
+    if not isinstance(condition, list) or not condition:
+        raise OperationFailure('%s needs a nonempty array' % operator)
+    return condition
+
+
+def equality_fields(query):
+    """Returns the fields a query pins to a single value, which an upsert
+    copies into the document it inserts."""
+    fields = {}
+    for key, condition in (query or {}).iteritems():
+        if key == '$and':
+            for clause in condition:
+                fields.update(equality_fields(clause))
+        elif key.startswith('$'):
+            continue
+        elif _is_operator_document(condition):
+            if '$eq' in condition:
+                fields[key] = condition['$eq']
+        elif _regex(condition) is None:
+            fields[key] = condition
+    return fields
+
+
+# Projection
+
+
+def project(document, fields):
+    """Returns a copy of document with only the projected fields."""
+    if not fields:
+        return copy.deepcopy(document)
+    include_id = fields.get('_id', True)
+    others = [(k, v) for k, v in fields.iteritems() if k != '_id']
+    if any(isinstance(v, dict) for _, v in others):
+        raise OperationFailure('projection operators are not supported by '
+                               'the memory engine')
+    inclusive = [bool(v) for _, v in others]
+    if others and any(inclusive) and not all(inclusive):
+        raise OperationFailure(
+            'Projection cannot have a mix of inclusion and exclusion.')
+
+    if others and all(inclusive):
+        result = {}
+        if include_id and '_id' in document:
+            result['_id'] = document['_id']
+        for path, _ in others:
+            _copy_path(document, result, split_path(path))
+    else:
+        result = dict(document)
+        if not include_id:
+            result.pop('_id', None)
+        for path, _ in others:
+            _remove_path(result, split_path(path))
+    return copy.deepcopy(result)
+
+
+def _copy_path(source, target, parts):
+    head, rest = parts[0], parts[1:]
+    if head not in source:
+        return
+    value = source[head]
+    if not rest:
+        target[head] = value
+    elif isinstance(value, dict):
+        _copy_path(value, target.setdefault(head, {}), rest)
+    elif isinstance(value, list):
+        items = target.setdefault(head, [])
+        for item in value:
+            if isinstance(item, dict):
+                projected = {}
+                _copy_path(item, projected, rest)
+                items.append(projected)
+
+
+def _remove_path(document, parts):
+    head, rest = parts[0], parts[1:]
+    if head not in document:
+        return
+    if not rest:
+        del document[head]
+        return
+    value = document[head]
+    if isinstance(value, dict):
+        value = document[head] = dict(value)
+        _remove_path(value, rest)
+    elif isinstance(value, list):
+        items = document[head] = []
+        for item in value:
+            if isinstance(item, dict):
+                item = dict(item)
+                _remove_path(item, rest)
+            items.append(item)
+
+
+# Sort
+
+
+def normalize_sort(key_or_list, direction=None):
+    if isinstance(key_or_list, basestring):
+        return [(key_or_list, direction or 1)]
+    if isinstance(key_or_list, dict):
+        return key_or_list.items()
+    return list(key_or_list)
+
+
+def _sort_value(document, path, descending):
+    values = _with_elements(resolve(document, path))
+    values = [v for v in values if not isinstance(v, list)] or values
+    if not values:
+        return sort_key(None)
+    keys = [sort_key(v) for v in values]
+    return max(keys) if descending else min(keys)
+
+
+def sort(documents, spec):
+    """Sorts documents in place by the [(path, direction)] spec."""
+    # Sorting is stable, so sorting by each key from the last to the first
+    # orders by all of them
+    for path, direction in reversed(spec):
+        descending = int(direction) < 0
+        documents.sort(key=lambda d: _sort_value(d, path, descending),
+                       reverse=descending)
+    return documents
+
+
+# Update
+
+
+def is_replacement(update):
+    keys = list(update)
+    operators = [k.startswith('$') for k in keys]
+    if any(operators) and not all(operators):
+        raise OperationFailure('Unknown modifier: %s' %
+                               [k for k in keys if not k.startswith('$')][0])
+    return not any(operators)
+
+
+def _parent(document, path, create):
+    """Returns (container, last part) for path, creating missing embedded
+    documents if create is set, or (None, None) if the path is missing."""
+    parts = split_path(path)
+    value = document
+    for part in parts[:-1]:
+        if '$' in part:
+            raise OperationFailure('the positional operator is not supported '
+                                   'by the memory engine')
+        if isinstance(value, list) and part.isdigit():
+            index = int(part)
+            while create and len(value) <= index:
+                value.append(None)
+            if index >= len(value):
+                return None, None
+            if value[index] is None and create:
+                value[index] = {}
+            value = value[index]
+        elif isinstance(value, dict):
+            if part not in value:
+                if not create:
+                    return None, None
+                value[part] = {}
+            value = value[part]
+        else:
+            if not create:
+                return None, None
+            raise OperationFailure(
+                "cannot use the part (%s of %s) to traverse the element" %
+                (part, path))
+        if not isinstance(value, (dict, list)):
+            if not create:
+                return None, None
+            raise OperationFailure(
+                "cannot use the part (%s of %s) to traverse the element" %
+                (part, path))
+    return value, parts[-1]
+
+
+def _get(container, key, default=_MISSING):
+    if isinstance(container, list):
+        if key.isdigit() and int(key) < len(container):
+            return container[int(key)]
+        return default
+    return container.get(key, default)
+
+
+def _set(container, key, value):
+    if isinstance(container, list):
+        if not key.isdigit():
+            raise OperationFailure('cannot set field %s of an array' % key)
+        index = int(key)
+        while len(container) <= index:
+            container.append(None)
+        container[index] = value
+    else:
+        container[key] = value
+
+
+def _unset(container, key):
+    if isinstance(container, list):
+        if key.isdigit() and int(key) < len(container):
+            container[int(key)] = None
+    else:
+        container.pop(key, None)
+
+
+def _number(value, op, path):
+    if isinstance(value, bool) or not isinstance(value, (int, long, float)):
+        raise OperationFailure('Cannot apply %s to a value of non-numeric '
+                               'type. field %s' % (op, path))
+    return value
+
+
+def _array(document, path, op):
+    container, key = _parent(document, path, True)
+    current = _get(container, key)
+    if current is _MISSING:
+        current = []
+        _set(container, key, current)
+    elif not isinstance(current, list):
+        raise OperationFailure('The field %s must be an array for %s' %
+                               (path, op))
+    return current
+
+
+def _each(value):
+    if isinstance(value, dict) and '$each' in value:
+        return list(value['$each'])
+    return [value]
+
+
+def _pull_matches(element, condition):
+    if _is_operator_document(condition):
+        return _match_operators([element], condition)
+    if isinstance(condition, dict) and isinstance(element, dict):
+        return match(element, condition)
+    return _eq([element], condition)
+
+
+def apply_update(document, update, inserting=False):
+    """Applies the update operators in update to document, in place."""
+    for op, fields in update.iteritems():
+        if not isinstance(fields, dict):
+            raise OperationFailure('Modifier %s needs a document' % op)
+        for path, value in fields.iteritems():
+            if path == '_id' or path.startswith('_id.'):
+                if op not in ('$setOnInsert',) or not inserting:
+                    raise OperationFailure("Mod on _id not allowed")
+            _apply(document, op, path, value, inserting)
+
+
+def _apply(document, op, path, value, inserting):
+    if op == '$set' or op == '$setOnInsert' and inserting:
+        container, key = _parent(document, path, True)
+        _set(container, key, copy.deepcopy(value))
+    elif op == '$setOnInsert':
+        pass
+    elif op == '$unset':
+        container, key = _parent(document, path, False)
+        if container is not None:
+            _unset(container, key)
+    elif op in ('$inc', '$mul'):
+        _number(value, op, path)
+        container, key = _parent(document, path, True)
+        current = _get(container, key)
+        if current is _MISSING:
+            current = 0
+        _number(current, op, path)
+        _set(container, key, current + value if op == '$inc'
+             else current * value)
+    elif op in ('$min', '$max'):
+        container, key = _parent(document, path, True)
+        current = _get(container, key)
+        if current is _MISSING or \
+                (op == '$min' and sort_key(value) < sort_key(current)) or \
+                (op == '$max' and sort_key(value) > sort_key(current)):
+            _set(container, key, copy.deepcopy(value))
+    elif op == '$currentDate':
+        container, key = _parent(document, path, True)
+        _set(container, key, datetime.utcnow())
+    elif op == '$rename':
+        if not isinstance(value, basestring):
+            raise OperationFailure('$rename target must be a string')
+        container, key = _parent(document, path, False)
+        if container is None or _get(container, key) is _MISSING:
+            return
+        moved = _get(container, key)
+        _unset(container, key)
+        target, target_key = _parent(document, value, True)
+        _set(target, target_key, moved)
+    elif op in ('$push', '$pushAll'):
+        items = value if op == '$pushAll' else _each(value)
+        _array(document, path, op).extend(copy.deepcopy(items))
+    elif op == '$addToSet':
+        current = _array(document, path, op)
+        for item in _each(value):
+            if not any(values_equal(item, v) for v in current):
+                current.append(copy.deepcopy(item))
+    elif op == '$pop':
+        container, key = _parent(document, path, False)
+        current = None if container is None else _get(container, key, None)
+        if isinstance(current, list) and current:
+            if value == -1:
+                current.pop(0)
+            else:
+                current.pop()
+    elif op in ('$pull', '$pullAll'):
+        container, key = _parent(document, path, False)
+        current = None if container is None else _get(container, key, None)
+        if isinstance(current, list):
+            if op == '$pullAll':
+                kept = [v for v in current
+                        if not any(values_equal(v, p) for p in value)]
+            else:
+                kept = [v for v in current if not _pull_matches(v, value)]
+            current[:] = kept
+    else:
+        raise OperationFailure('Unknown modifier: %s' % op)
+
+
+def upsert_document(query, update):
+    """Returns the document an upsert inserts when nothing matches."""
+    if is_replacement(update):
+        document = copy.deepcopy(update)
+        fields = equality_fields(query)
+        if '_id' in fields and '_id' not in document:
+            document['_id'] = fields['_id']
+        return document
+    document = {}
+    for path, value in equality_fields(query).iteritems():
+        container, key = _parent(document, path, True)
+        _set(container, key, copy.deepcopy(value))
+    apply_update(document, update, inserting=True)
+    return document
+
+
+# Aggregation
+
+
+def _expression(document, expression):
+    if isinstance(expression, basestring) and expression.startswith('$'):
+        values = resolve(document, expression[1:])
+        if not values:
+            return _MISSING
+        return values[0] if len(values) == 1 else values
+    if isinstance(expression, dict):
+        if _is_operator_document(expression):
+            return _operator_expression(document, expression)
+        return dict((k, _expression(document, v))
+                    for k, v in expression.iteritems())
+    if isinstance(expression, list):
+        return [_expression(document, v) for v in expression]
+    return expression
+
+
+def _arguments(document, operands):
+    if not isinstance(operands, list):
+        operands = [operands]
+    values = [_expression(document, v) for v in operands]
+    return [None if v is _MISSING else v for v in values]
+
+
+_EXPRESSIONS = {
+    '$add': lambda args: sum(args),
+    '$subtract': lambda args: args[0] - args[1],
+    '$multiply': lambda args: reduce(lambda a, b: a * b, args, 1),
+    '$divide': lambda args: args[0] / float(args[1]),
+    '$mod': lambda args: args[0] % args[1],
+    '$concat': lambda args: None if None in args else u''.join(args),
+    '$toLower': lambda args: (args[0] or u'').lower(),
+    '$toUpper': lambda args: (args[0] or u'').upper(),
+    '$size': lambda args: len(args[0]),
+    '$literal': lambda args: args[0],
+    '$eq': lambda args: values_equal(args[0], args[1]),
+    '$ne': lambda args: not values_equal(args[0], args[1]),
+    '$gt': lambda args: sort_key(args[0]) > sort_key(args[1]),
+    '$gte': lambda args: sort_key(args[0]) >= sort_key(args[1]),
+    '$lt': lambda args: sort_key(args[0]) < sort_key(args[1]),
+    '$lte': lambda args: sort_key(args[0]) <= sort_key(args[1]),
+    '$and': lambda args: all(args),
+    '$or': lambda args: any(args),
+    '$not': lambda args: not args[0],
+    '$cond': lambda args: args[1] if args[0] else args[2],
+    '$ifNull': lambda args: args[1] if args[0] is None else args[0],
+}
+
+
+def _operator_expression(document, expression):
+    if len(expression) != 1:
+        raise OperationFailure('an expression takes exactly one operator')
+    op, operands = expression.items()[0]
+    if op == '$literal':
+        return operands
+    if op == '$cond' and isinstance(operands, dict):
+        operands = [operands.get('if'), operands.get('then'),
+                    operands.get('else')]
+    if op not in _EXPRESSIONS:
+        raise OperationFailure('expression %s is not supported by the memory '
+                               'engine' % op)
+    try:
+        return _EXPRESSIONS[op](_arguments(document, operands))
+    except (TypeError, ValueError, IndexError, ZeroDivisionError) as e:
+        raise OperationFailure('%s failed: %s' % (op, e))
+
+
+def _stage_project(documents, spec):
+    projected = []
+    for document in documents:
+        include_id = spec.get('_id', True)
+        result = {}
+        if include_id and '_id' in document:
+            result['_id'] = document['_id']
+        excluded = []
+        for path, value in spec.iteritems():
+            if path == '_id' and value in (0, 1, True, False):
+                continue
+            if value in (0, False):
+                excluded.append(path)
+            elif value in (1, True):
+                _copy_path(document, result, split_path(path))
+            else:
+                computed = _expression(document, value)
+                if computed is not _MISSING:
+                    container, key = _parent(result, path, True)
+                    _set(container, key, computed)
+        if excluded:
+            raise OperationFailure('The top-level _id field is the only field '
+                                   'currently supported for exclusion')
+        projected.append(result)
+    return projected
+
+
+def _accumulate(op, values):
+    present = [v for v in values if v is not _MISSING]
+    if op == '$sum':
+        return sum(v for v in present
+                   if isinstance(v, (int, long, float)) and
+                   not isinstance(v, bool))
+    if op == '$avg':
+        numbers = [v for v in present
+                   if isinstance(v, (int, long, float)) and
+                   not isinstance(v, bool)]
+        return sum(numbers) / float(len(numbers)) if numbers else None
+    if op == '$min':
+        present = [v for v in present if v is not None]
+        return min(present, key=sort_key) if present else None
+    if op == '$max':
+        return max(present, key=sort_key) if present else None
+    if op == '$first':
+        return None if values[0] is _MISSING else values[0]
+    if op == '$last':
+        return None if values[-1] is _MISSING else values[-1]
+    if op == '$push':
+        return present
+    if op == '$addToSet':
+        unique = []
+        for value in present:
+            if not any(values_equal(value, u) for u in unique):
+                unique.append(value)
+        return unique
+    raise OperationFailure('unknown group operator %s' % op)
+
+
+def _stage_group(documents, spec):
+    if '_id' not in spec:
+        raise OperationFailure('a group specification must include an _id')
+    groups = []
+    members = {}
+    for document in documents:
+        key = _expression(document, spec['_id'])
+        if key is _MISSING:
+            key = None
+        hashable = sort_key(key)
+        if hashable not in members:
+            members[hashable] = []
+            groups.append((key, hashable))
+        members[hashable].append(document)
+
+    results = []
+    for key, hashable in groups:
+        result = {'_id': key}
+        for field, accumulator in spec.iteritems():
+            if field == '_id':
+                continue
+            if not _is_operator_document(accumulator) or \
+                    len(accumulator) != 1:
+                raise OperationFailure('the group aggregate field %s must be '
+                                       'defined as an expression inside an '
+                                       'object' % field)
+            op, expression = accumulator.items()[0]
+            values = [_expression(d, expression) for d in members[hashable]]
+            result[field] = _accumulate(op, values)
+        results.append(result)
+    return results
+
+
+def _stage_unwind(documents, path):
+    if not isinstance(path, basestring) or not path.startswith('$'):
+        raise OperationFailure('$unwind needs a field path starting with $')
+    path = path[1:]
+    unwound = []
+    for document in documents:
+        container, key = _parent(document, path, False)
+        value = _MISSING if container is None else _get(container, key)
+        if value is _MISSING or value is None:
+            continue
+        if not isinstance(value, list):
+            raise OperationFailure('$unwind: value at end of field path '
+                                   'must be an array')
+        for item in value:
+            copied = copy.deepcopy(document)
+            container, key = _parent(copied, path, False)
+            _set(container, key, item)
+            unwound.append(copied)
+    return unwound
+
+
+def aggregate(documents, pipeline):
+    """Runs the aggregation pipeline over documents and returns the
+    results."""
+    if isinstance(pipeline, dict):
+        pipeline = [pipeline]
+    if not isinstance(pipeline, list):
+        raise OperationFailure('pipeline must be an array of objects')
+    for stage in pipeline:
+        if not isinstance(stage, dict) or len(stage) != 1:
+            raise OperationFailure('A pipeline stage specification object '
+                                   'must contain exactly one field.')
+        name, spec = stage.items()[0]
+        if name == '$match':
+            documents = [d for d in documents if match(d, spec)]
+        elif name == '$project':
+            documents = _stage_project(documents, spec)
+        elif name == '$group':
+            documents = _stage_group(documents, spec)
+        elif name == '$sort':
+            documents = sort(list(documents), normalize_sort(
+                spec.items() if isinstance(spec, dict) else spec))
+        elif name == '$skip':
+            documents = documents[spec:]
+        elif name == '$limit':
+            documents = documents[:spec]
+        elif name == '$unwind':
+            documents = _stage_unwind(documents, spec)
+        else:
+            raise OperationFailure('exception: Unrecognized pipeline stage '
+                                   'name: %r' % name)
+    return [copy.deepcopy(d) for d in documents]
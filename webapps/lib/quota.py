@@ -0,0 +1,187 @@
+#    Copyright 2013 10gen Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+A ledger of how many bytes and documents each res_id collection holds, used
+to enforce QUOTA_COLLECTION_SIZE without running collstats on every write.
+
+Each collection has one document in QUOTAS_COLLECTION, keyed by its qualified
+name. Writes reserve their size with a single conditional $inc, which fails if
+the collection would go over quota. Entries are seeded from collstats the
+first time they are needed, and reconcile() periodically resets them to the
+real figures to correct the estimates made for updates and removes.
+
+Removes are charged back at the average document size, taken from the
+figures each reservation returns and kept per process in usage_cache, so
+that a remove usually costs a single $inc as well.
+"""
+
+from datetime import datetime
+import logging
+
+from bson import BSON
+from bson.objectid import ObjectId
+from flask import current_app
+from pymongo import ASCENDING
+from pymongo.errors import DuplicateKeyError, OperationFailure
+
+import metrics
+from cache import LRUCache
+from MWSServerError import MWSServerError
+from . import QUOTAS_COLLECTION
+
+_logger = logging.getLogger(__name__)
+
+# Defaults of the QUOTA_USAGE_CACHE_SIZE and QUOTA_USAGE_CACHE_TTL settings
+USAGE_CACHE_SIZE = 10000
+USAGE_CACHE_TTL = 60
+
+# Qualified collection name -> (bytes, count) last seen in its ledger entry
+usage_cache = LRUCache(USAGE_CACHE_SIZE, USAGE_CACHE_TTL)
+metrics.add_collector(metrics.cache_collector('quota_usage', usage_cache))
+
+# Bytes added to a document by the _id that is generated when inserting it
+ID_SIZE = len(BSON.encode({'_id': ObjectId()})) - len(BSON.encode({}))
+
+
+def init_app(app):
+    """Sizes the usage cache from the app config."""
+    usage_cache.maxsize = app.config.get('QUOTA_USAGE_CACHE_SIZE',
+                                         USAGE_CACHE_SIZE)
+    usage_cache.ttl = app.config.get('QUOTA_USAGE_CACHE_TTL', USAGE_CACHE_TTL)
+
+
+def insert_size(documents):
+    """Returns (bytes, count) for documents as they will be stored."""
+    if not isinstance(documents, list):
+        documents = [documents]
+    size = 0
+    for document in documents:
+        size += len(BSON.encode(document))
+        if '_id' not in document:
+            size += ID_SIZE
+    return size, len(documents)
+
+
+def _collstats(db, name):
+    try:
+        stats = db.command({'collstats': name})
+    except OperationFailure:
+        return 0, 0
+    return stats.get('size', 0), stats.get('count', 0)
+
+
+def _seed(coll):
+    """Creates the ledger entry for coll from collstats if it is missing."""
+    db = coll.db.db
+    size, count = _collstats(db, coll.name)
+    try:
+        db[QUOTAS_COLLECTION].insert({
+            '_id': coll.name,
+            'res_id': coll.res_id,
+            'size': size,
+            'count': count,
+            'reconciled': datetime.utcnow()
+        })
+    except DuplicateKeyError:
+        # Seeded concurrently by another request
+        pass
+
+
+def usage(coll):
+    """Returns (bytes, count) recorded for the WrappedCollection coll."""
+    ledger = coll.db.db[QUOTAS_COLLECTION]
+    doc = ledger.find_one({'_id': coll.name}, {'size': 1, 'count': 1})
+    if doc is None:
+        _seed(coll)
+        doc = ledger.find_one({'_id': coll.name}, {'size': 1, 'count': 1})
+    usage_cache.set(coll.name, (doc['size'], doc['count']))
+    return doc['size'], doc['count']
+
+
+def reserve(coll, size, count=0):
+    """
+    Adds size bytes and count documents to the ledger entry of the
+    WrappedCollection coll, or raises a 403 if that would take the collection
+    past QUOTA_COLLECTION_SIZE.
+    """
+    with metrics.timed('mws_stage_duration_seconds', stage='quota'):
+        reserved = _reserve(coll, size, count)
+    if not reserved:
+        raise MWSServerError(403, 'Collection size exceeded')
+
+
+def _reserve(coll, size, count):
+    quota = current_app.config['QUOTA_COLLECTION_SIZE']
+    ledger = coll.db.db[QUOTAS_COLLECTION]
+    spec = {'_id': coll.name, 'size': {'$lte': quota - size}}
+    update = {'$inc': {'size': size, 'count': count}}
+    doc = ledger.find_and_modify(spec, update, new=True)
+    if doc is None and ledger.find_one({'_id': coll.name}, {'_id': 1}) is None:
+        # No entry yet, rather than over quota
+        _seed(coll)
+        doc = ledger.find_and_modify(spec, update, new=True)
+    if doc is None:
+        return False
+    usage_cache.set(coll.name, (doc['size'], doc['count']))
+    return True
+
+
+def adjust(coll, size, count=0):
+    """Adds size bytes and count documents (either may be negative) to the
+    ledger entry of coll without checking the quota."""
+    if size or count:
+        coll.db.db[QUOTAS_COLLECTION].update(
+            {'_id': coll.name},
+            {'$inc': {'size': size, 'count': count}}
+        )
+
+
+def release_removed(coll, removed):
+    """Takes removed documents of average size off the ledger entry of
+    coll."""
+    if not removed:
+        return
+    figures = usage_cache.get(coll.name)
+    size, count = figures if figures is not None else usage(coll)
+    average = size // count if count else 0
+    freed, released = min(size, average * removed), min(count, removed)
+    adjust(coll, -freed, -released)
+    usage_cache.set(coll.name, (size - freed, count - released))
+
+
+def forget(db, name):
+    """Drops the ledger entry for the qualified collection name."""
+    db[QUOTAS_COLLECTION].remove({'_id': name})
+    usage_cache.invalidate(name)
+
+
+def reconcile(db, batch_size):
+    """
+    Resets the batch_size least recently reconciled ledger entries to the
+    figures reported by collstats. Returns the number of entries checked.
+    """
+    ledger = db[QUOTAS_COLLECTION]
+    entries = ledger.find({}, {'_id': 1}).sort(
+        'reconciled', ASCENDING).limit(batch_size)
+    checked = 0
+    for entry in entries:
+        size, count = _collstats(db, entry['_id'])
+        ledger.update({'_id': entry['_id']}, {'$set': {
+            'size': size,
+            'count': count,
+            'reconciled': datetime.utcnow()
+        }})
+        checked += 1
+    return checked
@@ -0,0 +1,129 @@
+#    Copyright 2013 10gen Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Rate limiting backends used by the ratelimit decorator.
+
+A backend answers a single question: may another request be made for this
+key, given a quota of requests per expiry seconds? A request may be charged
+more than once with cost, as the batch endpoint does for each operation it
+carries. The backend is chosen with the RATELIMIT_BACKEND setting.
+"""
+
+from datetime import datetime, timedelta
+import threading
+import time
+
+from pymongo.errors import DuplicateKeyError
+
+from db import get_db
+
+
+class TokenBucketRateLimiter(object):
+    """
+    Keeps a token bucket per key in process memory. Buckets hold up to quota
+    tokens and refill at quota / expiry tokens per second. Limits are enforced
+    per worker process, so the effective limit is multiplied by the number of
+    workers serving a session.
+    """
+    # Idle buckets are pruned once this many are held
+    max_buckets = 10000
+
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def hit(self, key, quota, expiry, cost=1):
+        now = time.time()
+        rate = float(quota) / expiry
+        with self._lock:
+            tokens, last, _ = self._buckets.get(key, (quota, now, expiry))
+            tokens = min(quota, tokens + (now - last) * rate)
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+            self._buckets[key] = (tokens, now, expiry)
+            if len(self._buckets) > self.max_buckets:
+                self._prune(now)
+        return allowed
+
+    def _prune(self, now):
+        # A bucket untouched for a whole expiry period is full again, so
+        # forgetting it does not change any answer.
+        for key, (_, last, expiry) in self._buckets.items():
+            if now - last > expiry:
+                del self._buckets[key]
+
+
+class MongoRateLimiter(object):
+    """
+    Counts requests per key in fixed windows of expiry seconds, one document
+    per key and window, shared by every process using the same database. Each
+    request is a single atomic $inc; documents carry an 'expires' date and are
+    removed by the TTL index declared in schema once their window is over.
+    """
+    def __init__(self, collection_name):
+        self.collection_name = collection_name
+
+    def hit(self, key, quota, expiry, cost=1):
+        # The TTL index compares expires with the current UTC time
+        now = datetime.utcnow()
+        window = int(time.time()) // expiry
+        coll = get_db()[self.collection_name]
+        query = {'_id': '{0}:{1}'.format(key, window)}
+        update = {
+            '$inc': {'count': cost},
+            '$setOnInsert': {'expires': now + timedelta(seconds=expiry)}
+        }
+        try:
+            doc = coll.find_and_modify(query, update, upsert=True, new=True)
+        except DuplicateKeyError:
+            # Lost an upsert race with another request; the document exists
+            # now, so the retry is a plain update.
+            doc = coll.find_and_modify(query, update, upsert=True, new=True)
+        return doc['count'] <= quota
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_ratelimiter(config):
+    """Returns the process-wide limiter for the configured backend."""
+    backend = config.get('RATELIMIT_BACKEND', 'mongo')
+    collection_name = config['RATELIMIT_COLLECTION']
+    key = (backend, collection_name)
+    with _limiters_lock:
+        limiter = _limiters.get(key)
+        if limiter is None:
+            if backend == 'memory':
+                limiter = TokenBucketRateLimiter()
+            elif backend == 'mongo':
+                limiter = MongoRateLimiter(collection_name)
+            else:
+                raise ValueError(
+                    'Unknown RATELIMIT_BACKEND {0}'.format(backend))
+            _limiters[key] = limiter
+        return limiter
+
+
+def get_limits(config, endpoint_class=None):
+    """
+    Returns (quota, expiry) for the endpoint class, falling back to
+    RATELIMIT_QUOTA and RATELIMIT_EXPIRY for classes without an entry in
+    RATELIMIT_LIMITS.
+    """
+    limits = (config.get('RATELIMIT_LIMITS') or {}).get(endpoint_class, {})
+    return (limits.get('quota', config['RATELIMIT_QUOTA']),
+            limits.get('expiry', config['RATELIMIT_EXPIRY']))
@@ -0,0 +1,145 @@
+#    Copyright 2013 10gen Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+The indexes required by the internal collections.
+
+Every index the server and ivs apps rely on is declared here. ensure_schema
+is called from both create_app factories: it builds whatever is missing,
+which is a no-op for indexes that already exist, and logs any drift between
+the declared indexes and those actually present. Indexes are never dropped.
+"""
+
+import logging
+
+from pymongo import ASCENDING
+from pymongo.errors import OperationFailure, PyMongoError
+
+from db import get_db
+from . import (CLIENTS_COLLECTION, CURSORS_COLLECTION, GRADES_COLLECTION,
+               QUOTAS_COLLECTION)
+
+_logger = logging.getLogger(__name__)
+
+# collection -> [(keys, options)]
+INDEXES = {
+    CLIENTS_COLLECTION: [
+        # user_has_access, create_mws_resource and the ivs lookups
+        ([('session_id', ASCENDING)], {}),
+        # get_collection_names and the collection registry
+        ([('res_id', ASCENDING)], {}),
+        # expire_sessions
+        ([('timestamp', ASCENDING)], {}),
+        # the ivs sandbox pools
+        ([('sandbox', ASCENDING), ('sandbox_state', ASCENDING)],
+         {'sparse': True}),
+    ],
+    CURSORS_COLLECTION: [
+        # register_cursor evicts the least recently used cursors of a res_id
+        ([('res_id', ASCENDING), ('last_touched', ASCENDING)], {}),
+        # reap_idle_cursors
+        ([('last_touched', ASCENDING)], {}),
+    ],
+    QUOTAS_COLLECTION: [
+        # expire_sessions
+        ([('res_id', ASCENDING)], {}),
+        # reconcile
+        ([('reconciled', ASCENDING)], {}),
+    ],
+    GRADES_COLLECTION: [
+        # claim
+        ([('state', ASCENDING), ('next_attempt', ASCENDING)], {}),
+        # finished grades are removed a week later
+        ([('finished', ASCENDING)], {'expireAfterSeconds': 7 * 24 * 3600}),
+    ],
+}
+
+# Options compared when checking an existing index against its declaration
+_COMPARED_OPTIONS = ('unique', 'expireAfterSeconds')
+
+
+def declared_indexes(config):
+    """Returns {collection: [(keys, options)]} for the given app config."""
+    indexes = dict((name, list(specs)) for name, specs in INDEXES.iteritems())
+    # Rate limit windows are removed by mongod once they have expired
+    indexes[config['RATELIMIT_COLLECTION']] = [
+        ([('expires', ASCENDING)], {'expireAfterSeconds': 0}),
+    ]
+    return indexes
+
+
+def ensure_indexes(db, config):
+    """
+    Builds every declared index in the background, so that a build on a
+    large collection does not block it while the app starts. Returns the
+    number that could not be built, which happens when an index on the same
+    keys exists with other options.
+    """
+    failed = 0
+    for collection, specs in declared_indexes(config).iteritems():
+        for keys, options in specs:
+            try:
+                db[collection].create_index(keys, background=True,
+                                            **options)
+            except OperationFailure as e:
+                _logger.error('Could not build index %s on %s: %s' %
+                              (keys, collection, e))
+                failed += 1
+    return failed
+
+
+def index_drift(db, config):
+    """
+    Compares the declared indexes with those present. Returns a list of
+    (collection, problem, keys) tuples, where problem is 'missing',
+    'mismatched' (present with other options) or 'undeclared'.
+    """
+    drift = []
+    for collection, specs in sorted(declared_indexes(config).iteritems()):
+        actual = {}
+        for name, info in db[collection].index_information().iteritems():
+            if name != '_id_':
+                actual[tuple(tuple(k) for k in info['key'])] = info
+        for keys, options in specs:
+            key = tuple((field, direction) for field, direction in keys)
+            info = actual.pop(key, None)
+            if info is None:
+                drift.append((collection, 'missing', list(key)))
+            elif any(info.get(opt) != options.get(opt)
+                     for opt in _COMPARED_OPTIONS):
+                drift.append((collection, 'mismatched', list(key)))
+        for key in sorted(actual):
+            drift.append((collection, 'undeclared', list(key)))
+    return drift
+
+
+def ensure_schema(app):
+    """
+    Builds missing indexes if ENSURE_INDEXES is set, then logs any drift.
+    Failures are logged rather than raised so that the app still starts if
+    the database is unavailable.
+    """
+    with app.app_context():
+        try:
+            db = get_db(MWSExceptions=False)
+            if app.config.get('ENSURE_INDEXES', True):
+                ensure_indexes(db, app.config)
+            drift = index_drift(db, app.config)
+        except PyMongoError as e:
+            app.logger.error('Could not check indexes: %s' % e)
+            return None
+        for collection, problem, keys in drift:
+            app.logger.warning('Index drift on %s: %s index %s' %
+                               (collection, problem, keys))
+        return drift
@@ -15,7 +15,10 @@
 from pymongo.collection import Collection
 from pymongo.database import Database
 from pymongo.errors import OperationFailure
+from cache import LRUCache
 from db import get_db
+import metrics
+import quota
 from MWSServerError import MWSServerError
 from flask import current_app
 from . import CLIENTS_COLLECTION
@@ -25,16 +28,45 @@ import os
 
 _logger = logging.getLogger(__name__)
 
+# Defaults of the COLLECTION_CACHE_SIZE and COLLECTION_CACHE_TTL settings
+COLLECTION_CACHE_SIZE = 10000
+COLLECTION_CACHE_TTL = 60
+
+# res_id -> frozenset of the collection names registered in CLIENTS_COLLECTION.
+# A name missing from the cached set is always re-checked against the database
+# before it is treated as unknown, so collections created by other processes
+# are never hidden, and a write only registers a name that is missing there
+# too. Dropping a collection or expiring a res_id invalidates the entry in the
+# process that did it; other processes see it once their entry expires.
+collection_cache = LRUCache(COLLECTION_CACHE_SIZE, COLLECTION_CACHE_TTL)
+metrics.add_collector(metrics.cache_collector('collection', collection_cache))
+
+
+def init_app(app):
+    """Sizes the collection cache from the app config."""
+    collection_cache.maxsize = app.config.get('COLLECTION_CACHE_SIZE',
+                                              COLLECTION_CACHE_SIZE)
+    collection_cache.ttl = app.config.get('COLLECTION_CACHE_TTL',
+                                          COLLECTION_CACHE_TTL)
+
+
+def _fetch_collection_names(db, res_id):
+    metrics.inc('mws_mongo_operations_total', operation='find_one',
+                source='registry')
+    one = db[CLIENTS_COLLECTION].find_one(
+        {'res_id': res_id}, {'collections': 1, '_id': 0}
+    )
+    names = one['collections'] if one else None
+    collection_cache.set(res_id, frozenset(names or []))
+    return names
+
 
 def get_collection_names(res_id):
     """
     Get the collection names associated with a given resource id. Should not be
     called from within a 'with UseResId(res_id)' block.
     """
-    one = get_db()[CLIENTS_COLLECTION].find_one(
-        {'res_id': res_id}, {'collections': 1, '_id': 0}
-    )
-    return one['collections']
+    return _fetch_collection_names(get_db(), res_id)
 
 
 def get_environment(basedir):
@@ -51,7 +83,42 @@ def get_environment(basedir):
 def to_coll_name(res_id, name):
     return "{0}{1}".format(res_id, name)
 
+
+class EmptyCursor(object):
+    """Stands in for the cursor of a query on a collection that does not
+    exist, so that such queries never reach the database."""
+    cursor_id = 0
+    alive = False
+
+    def batch_size(self, *args, **kwargs):
+        return self
+
+    def sort(self, *args, **kwargs):
+        return self
+
+    def skip(self, *args, **kwargs):
+        return self
+
+    def limit(self, *args, **kwargs):
+        return self
+
+    def count(self, *args, **kwargs):
+        return 0
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        raise StopIteration
+
+
 class WrappedCollection(object):
+    """
+    A collection in the namespace of a res_id. Collections are registered
+    with the res_id only by operations that can create them; reads, updates
+    and removes on a collection the res_id does not have return an empty
+    result without touching the database.
+    """
 
     def __init__(self, db, coll_name, res_id):
         self.res_id = res_id
@@ -59,11 +126,19 @@ class WrappedCollection(object):
         self.db = db
         self.unqualified_name = coll_name
 
-        self.db.ensure_client_collection(coll_name)
-
         coll_name = to_coll_name(self.res_id, coll_name)
         self.coll = self.db.db[coll_name]
 
+    def _exists(self):
+        return self.db.has_client_collection(self.unqualified_name)
+
+    def _ensure_exists(self):
+        self.db.ensure_client_collection(self.unqualified_name)
+
+    def _count(self, operation):
+        metrics.inc('mws_mongo_operations_total', operation=operation,
+                    source='user')
+
 
     @property
     def name(self):
@@ -78,36 +153,67 @@ class WrappedCollection(object):
         return self.coll.uuid_subtype
 
     def insert(self, *args, **kwargs):
+        self._ensure_exists()
+        self._count('insert')
         return self.coll.insert(*args, **kwargs)
 
     def update(self, *args, **kwargs):
+        upsert = args[2] if len(args) > 2 else kwargs.get('upsert', False)
+        if upsert:
+            self._ensure_exists()
+        elif not self._exists():
+            return {'ok': 1.0, 'n': 0, 'nModified': 0,
+                    'updatedExisting': False}
+        self._count('update')
         return self.coll.update(*args, **kwargs)
 
     def save(self, *args, **kwargs):
+        self._ensure_exists()
+        self._count('save')
         return self.coll.save(*args, **kwargs)
 
     def find(self, *args, **kwargs):
+        if not self._exists():
+            return EmptyCursor()
+        self._count('find')
         return self.coll.find(*args, **kwargs)
 
     def find_one(self, *args, **kwargs):
+        if not self._exists():
+            return None
+        self._count('find_one')
         return self.coll.find_one(*args, **kwargs)
 
     def count(self, *args, **kwargs):
+        if not self._exists():
+            return 0
+        self._count('count')
         return self.coll.count(*args, **kwargs)
 
     def find_and_modify(self, *args, **kwargs):
+        self._ensure_exists()
+        self._count('find_and_modify')
         return self.coll.find_and_modify(*args, **kwargs)
 
     def aggregate(self, *args, **kwargs):
+        # Passed through so that invalid pipelines still report the server's
+        # error, even on a collection that does not exist.
+        self._count('aggregate')
         return self.coll.aggregate(*args, **kwargs)
 
     def remove(self, *args, **kwargs):
+        if not self._exists():
+            return {'ok': 1.0, 'n': 0}
+        self._count('remove')
         return self.coll.remove(*args, **kwargs)
 
     def drop(self):
         return self.db.drop_collection(self.unqualified_name)
 
     def size(self):
+        if not self._exists():
+            return 0
+        self._count('collstats')
         try:
             return self.db.db.command({'collstats': self.coll.name}).get('size', 0)
         except OperationFailure as e:
@@ -142,33 +248,52 @@ class WrappedDatabase(object):
             self.drop_collection(collection)
 
     def drop_collection(self, name):
+        metrics.inc('mws_mongo_operations_total', operation='drop',
+                    source='user')
         self.db.drop_collection(to_coll_name(self.res_id, name))
+        quota.forget(self.db, to_coll_name(self.res_id, name))
         self.remove_client_collection(name)
 
+    def has_client_collection(self, name):
+        names = collection_cache.get(self.res_id)
+        if names is not None and name in names:
+            return True
+        names = _fetch_collection_names(self.db, self.res_id)
+        return names is not None and name in names
+
     def ensure_client_collection(self, name):
+        names = collection_cache.get(self.res_id)
+        if names is not None and name in names:
+            return
+        names = _fetch_collection_names(self.db, self.res_id)
+        if names is None:
+            # Nothing to register against
+            return
+        if name in names:
+            # Registered by another process
+            return
         limit = current_app.config.get('QUOTA_NUM_COLLECTIONS')
+        if limit is not None and len(names) + 1 > limit:
+            raise MWSServerError(429, 'Max number of collections exceeded')
 
-        if limit is not None:
-            data = self.db[CLIENTS_COLLECTION].find_one(
-                {'res_id': self.res_id},
-                {'collections': 1}
-            )
-
-            if data and len(set(data['collections']).union([name])) > limit:
-                raise MWSServerError(429, 'Max number of collections exceeded')
-
+        metrics.inc('mws_mongo_operations_total', operation='update',
+                    source='registry')
         self.db[CLIENTS_COLLECTION].update(
             {'res_id': self.res_id},
             {'$addToSet': {'collections': name}},
             multi=True
         )
+        collection_cache.set(self.res_id, frozenset(names).union([name]))
 
     def remove_client_collection(self, name):
+        metrics.inc('mws_mongo_operations_total', operation='update',
+                    source='registry')
         self.db[CLIENTS_COLLECTION].update(
             {'res_id': self.res_id},
             {'$pull': {'collections': name}},
             multi=True
         )
+        collection_cache.invalidate(self.res_id)
 
 
 class UseResId:
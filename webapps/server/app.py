@@ -12,12 +12,15 @@
 #    See the License for the specific language governing permissions and
 #    limitations under the License.
 
+import atexit
 import os
 from flask import Flask, redirect
 import logging
 
+from webapps.lib import decorators, metrics, profiler, quota, util
 from webapps.lib.conf import update_config
 from webapps.lib.log import configure_logging
+from webapps.lib.schema import ensure_schema
 from webapps.lib.util import get_environment
 from webapps.server import crontab
 from webapps.server.views import mws
@@ -50,7 +53,15 @@ def create_app():
     update_config(app, 'SERVER', environment)
     configure_logging(app, environment)
     app.register_blueprint(mws)
+    util.init_app(app)
+    quota.init_app(app)
+    decorators.init_app(app)
+    metrics.init_app(app)
+    profiler.init_app(app)
+    ensure_schema(app)
     crontab.run_scheduler(app)
+    crontab.add_status_view(app)
+    atexit.register(crontab.flush_liveness, app)
     return app
 
 
@@ -0,0 +1,83 @@
+#    Copyright 2013 10gen Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Serves the server app from gevent instead of a WSGI thread per request.
+
+    python -m webapps.server.async_app
+
+The standard library is patched so that every socket operation, including
+those pymongo makes, yields to other requests instead of blocking, and
+each request runs in its own greenlet. A process can then hold open
+ASYNC_MAX_CONNECTIONS requests at once, most of them idle shells waiting
+on keep-alive or a short query, where a threaded server would need a
+thread for each.
+
+The app, its URLs, sessions, rate limiting and quotas are exactly those of
+webapps.server.app. CPU bound work such as BSON and JSON encoding still
+runs one request at a time, so run a process per core behind the load
+balancer. gevent is only needed by this entry point and is not a
+requirement of the threaded one.
+
+With WEBSOCKET_ENABLED set, shells may also send their commands over a
+WebSocket (see websocket.py), which needs gevent-websocket.
+"""
+
+try:
+    from gevent import monkey
+except ImportError:
+    raise ImportError('webapps.server.async_app needs gevent; install it '
+                      'with pip install gevent')
+# Must happen before anything else imports socket, threading or time
+monkey.patch_all()
+
+import logging
+
+from gevent.pool import Pool
+from gevent.pywsgi import WSGIServer
+
+from webapps.lib.db import connections
+from webapps.server.app import app
+
+_logger = logging.getLogger(__name__)
+
+
+def configure(app):
+    """Makes the app's Mongo clients greenlet aware. Clients created while
+    the app was set up, such as the one that built the indexes, are
+    dropped and rebuilt on first use."""
+    app.config['DB_USE_GREENLETS'] = True
+    connections.reconnect()
+    return app
+
+
+def serve(app):
+    host, port = app.config['HOST'], app.config['PORT']
+    pool = Pool(app.config['ASYNC_MAX_CONNECTIONS'])
+    options = {}
+    if app.config['WEBSOCKET_ENABLED']:
+        try:
+            from geventwebsocket.handler import WebSocketHandler
+        except ImportError:
+            raise ImportError('WEBSOCKET_ENABLED needs gevent-websocket; '
+                              'install it with pip install gevent-websocket')
+        options['handler_class'] = WebSocketHandler
+    server = WSGIServer((host, port), app, spawn=pool, log=None, **options)
+    _logger.info('Serving on %s:%s with up to %s concurrent requests',
+                 host, port, app.config['ASYNC_MAX_CONNECTIONS'])
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    serve(configure(app))
@@ -12,35 +12,334 @@
 #    See the License for the specific language governing permissions and
 #    limitations under the License.
 
+"""
+The jobs run in the background of the server app.
+
+Every process starts a scheduler, but each job only runs in the process
+holding its lease (see lib/leases.py), so the cluster runs it once per
+interval whichever hosts and workers are up. Session expiry may also be
+split by res_id across processes while its backlog is large. The leases,
+and the last run recorded on each, are shown at SCHEDULER_STATUS_PATH to
+requests sending SCHEDULER_STATUS_TOKEN.
+"""
+
 from datetime import datetime, timedelta
+from functools import partial
+import logging
+from multiprocessing.pool import ThreadPool
+import random
+import time
+
 from apscheduler.scheduler import Scheduler
+from bson.json_util import dumps
+from flask import Response, request
+from pymongo import ASCENDING
+from pymongo.errors import OperationFailure, PyMongoError
+
+from webapps.lib import (CLIENTS_COLLECTION, QUOTAS_COLLECTION, leases,
+    liveness, metrics, quota)
+from webapps.lib.cursors import reap_idle_cursors
 from webapps.lib.db import get_db
-from webapps.lib.util import to_coll_name
+from webapps.lib.decorators import invalidate_access
+from webapps.lib.MWSServerError import MWSServerError
+from webapps.lib.util import collection_cache, to_coll_name
+
+_logger = logging.getLogger(__name__)
 
 EXPIRE_SESSION_EVERY = 600
 EXPIRE_SESSION_DURATION = 1800
+EXPIRE_SESSION_BATCH_SIZE = 500  # sessions removed per round trip
+EXPIRE_SESSION_DROP_THREADS = 4  # collections dropped concurrently
+EXPIRE_SESSION_TIME_BUDGET = 60  # seconds a sweep may run before yielding
+# Expired sessions waiting at the start of a sweep beyond which it is split
+# by res_id into EXPIRE_SESSION_PARTITIONS, run by different processes
+EXPIRE_SESSION_PARTITION_BACKLOG = 5000
+EXPIRE_SESSION_PARTITIONS = 4
+
+# Seconds between writes of each process' buffered session activity. Expiry
+# waits this much longer, so buffered activity is always written in time.
+LIVENESS_FLUSH_EVERY = EXPIRE_SESSION_DURATION // 10
+
+# Seconds a lease outlives its job's interval, so that the holder renews it
+# before anyone else can take it
+LEASE_GRACE = 60
+EXPIRE_LEASE = 'expire_sessions'
+
+# Totals across sweeps, and figures for the most recent one
+expiry_metrics = {
+    'runs': 0,
+    'sessions_expired': 0,
+    'collections_dropped': 0,
+    'last_sessions_expired': 0,
+    'last_collections_dropped': 0,
+    'last_duration': 0.0,
+    'last_run': None,
+}
+
+
+def run_recorded(db, lease, name, job):
+    """
+    Runs job(), recording how long it takes, and stores the run as the
+    last_run of the lease. Dict results, the figures of the run, are stored
+    with it.
+    """
+    run = {'started': datetime.utcnow()}
+    started = time.time()
+    try:
+        with metrics.timed('mws_scheduler_job_duration_seconds', job=name):
+            result = job()
+        if isinstance(result, dict):
+            run['result'] = result
+        return result
+    except Exception as e:
+        run['error'] = str(e)
+        raise
+    finally:
+        run['duration'] = time.time() - started
+        leases.record(db, lease, {'last_run': run})
+
+
+def exclusive_job(name, job, app, interval):
+    """Wraps job(app) for the scheduler, running it only in the process
+    holding the lease for name."""
+    def run():
+        with app.app_context():
+            db = get_db(MWSExceptions=False)
+            if leases.acquire(db, name, interval + LEASE_GRACE):
+                run_recorded(db, name, name, partial(job, app))
+    return run
 
 
 def run_scheduler(app):
     scheduler = Scheduler()
 
-    expire_wrapper = lambda: expire_sessions(app)
+    interval = app.config['CURSOR_REAP_EVERY']
+    reap_wrapper = exclusive_job('reap_cursors', reap_cursors, app, interval)
+    scheduler.add_interval_job(reap_wrapper, seconds=interval)
+
+    interval = app.config['QUOTA_RECONCILE_EVERY']
+    reconcile_wrapper = exclusive_job('reconcile_quotas', reconcile_quotas,
+                                      app, interval)
+    scheduler.add_interval_job(reconcile_wrapper, seconds=interval)
+
+    # Every process has its own buffer to flush
+    flush_wrapper = partial(flush_liveness, app)
+    scheduler.add_interval_job(flush_wrapper, seconds=LIVENESS_FLUSH_EVERY)
+
+    expire_wrapper = partial(run_expiry, app)
     scheduler.add_interval_job(expire_wrapper, seconds=EXPIRE_SESSION_EVERY)
 
     scheduler.start()
     print "APScheduler started successfully"
 
 
-def expire_sessions(app):
+def add_status_view(app):
+    """Shows the scheduler's leases at SCHEDULER_STATUS_PATH, to requests
+    sending SCHEDULER_STATUS_TOKEN as a bearer token."""
+    path = app.config.get('SCHEDULER_STATUS_PATH')
+    if not path:
+        return
+
+    def scheduler_status():
+        token = app.config.get('SCHEDULER_STATUS_TOKEN')
+        if (not token or
+                request.headers.get('Authorization') != 'Bearer ' + token):
+            raise MWSServerError(403, 'Not authorized to view the scheduler')
+        owner = leases.owner_id()
+        jobs = []
+        for lease in leases.status(get_db()):
+            lease['name'] = lease.pop('_id')
+            lease['is_self'] = lease.get('owner') == owner
+            jobs.append(lease)
+        body = {'owner': owner, 'leases': jobs, 'expiry': expiry_metrics}
+        return Response(dumps(body), mimetype='application/json')
+    app.add_url_rule(path, 'scheduler_status', scheduler_status)
+
+
+def expiry_cutoff():
+    """Sessions last kept alive before this have expired, even allowing for
+    activity not yet flushed."""
+    return datetime.now() - timedelta(
+        seconds=EXPIRE_SESSION_DURATION + LIVENESS_FLUSH_EVERY)
+
+
+def expiry_backlog(db, limit):
+    """Counts expired sessions, up to limit."""
+    query = {'timestamp': {'$lt': expiry_cutoff()}}
+    return db[CLIENTS_COLLECTION].find(query).limit(limit).count(True)
+
+
+def res_id_range(partition, partitions):
+    """
+    Returns the query selecting one of partitions ranges of res_ids. res_ids
+    are random UUIDs, so ranges of their first two hex digits split them
+    evenly; the first and last ranges are open so every res_id is in one.
+    """
+    bounds = {}
+    if partition > 0:
+        bounds['$gte'] = '%02x' % (256 * partition // partitions)
+    if partition < partitions - 1:
+        bounds['$lt'] = '%02x' % (256 * (partition + 1) // partitions)
+    return {'res_id': bounds} if bounds else {}
+
+
+def run_expiry(app):
+    """
+    Scheduled in every process. The holder of the expire_sessions lease
+    sweeps on its own while fewer than EXPIRE_SESSION_PARTITION_BACKLOG
+    sessions have expired. Past that it splits the sweep into
+    EXPIRE_SESSION_PARTITIONS and takes the first, and every other process
+    takes whichever of the rest it can get the lease of. The holder then
+    sweeps the partitions no other process has taken, so that the backlog
+    drains even when there is only one process.
+    """
+    ttl = EXPIRE_SESSION_EVERY + LEASE_GRACE
+    with app.app_context():
+        db = get_db(MWSExceptions=False)
+        if leases.acquire(db, EXPIRE_LEASE, ttl):
+            partitions = 1
+            backlog = expiry_backlog(db, EXPIRE_SESSION_PARTITION_BACKLOG + 1)
+            if backlog > EXPIRE_SESSION_PARTITION_BACKLOG:
+                partitions = EXPIRE_SESSION_PARTITIONS
+            leases.record(db, EXPIRE_LEASE, {'partitions': partitions})
+            if partitions == 1:
+                run_recorded(db, EXPIRE_LEASE, EXPIRE_LEASE,
+                             partial(expire_sessions, app))
+                return
+            run_recorded(db, EXPIRE_LEASE, EXPIRE_LEASE,
+                         partial(expire_sessions, app, (0, partitions)))
+            for partition in xrange(1, partitions):
+                _expire_partition(app, db, partition, partitions, ttl)
+        else:
+            leader = leases.get(db, EXPIRE_LEASE) or {}
+            partitions = leader.get('partitions', 1)
+            others = range(1, partitions)
+            random.shuffle(others)
+            for partition in others:
+                if _expire_partition(app, db, partition, partitions, ttl):
+                    break
+
+
+def _expire_partition(app, db, partition, partitions, ttl):
+    """Sweeps partition if its lease can be had. Returns whether it was."""
+    lease = '%s.%d' % (EXPIRE_LEASE, partition)
+    if not leases.acquire(db, lease, ttl):
+        return False
+    run_recorded(db, lease, EXPIRE_LEASE,
+                 partial(expire_sessions, app, (partition, partitions)))
+    return True
+
+
+def _drop_collection(db, name):
+    try:
+        db.drop_collection(name)
+    except OperationFailure as e:
+        _logger.warning('Failed to drop %s: %s' % (name, e))
+        return 0
+    return 1
+
+
+def expire_sessions(app, partition=None):
+    """
+    Removes sessions idle for EXPIRE_SESSION_DURATION, oldest first, along
+    with their collections. Sessions are read off the timestamp index and
+    removed EXPIRE_SESSION_BATCH_SIZE at a time, and their collections are
+    dropped by a pool of EXPIRE_SESSION_DROP_THREADS threads. A sweep stops
+    starting new batches after EXPIRE_SESSION_TIME_BUDGET seconds; whatever
+    is left is picked up by the next one. partition, a (partition,
+    partitions) pair, limits the sweep to that range of res_ids. Returns the
+    sweep's figures.
+    """
+    with app.app_context():
+        db = get_db(MWSExceptions=False)
+        clients = db[CLIENTS_COLLECTION]
+
+        started = time.time()
+        exp = expiry_cutoff()
+        selected = res_id_range(*partition) if partition else {}
+        expired = 0
+        dropped = 0
+        pool = ThreadPool(EXPIRE_SESSION_DROP_THREADS)
+        try:
+            while time.time() - started < EXPIRE_SESSION_TIME_BUDGET:
+                query = dict(selected, timestamp={'$lt': exp})
+                fields = {'res_id': 1, 'session_id': 1, 'collections': 1}
+                sessions = list(clients.find(query, fields)
+                                .sort('timestamp', ASCENDING)
+                                .limit(EXPIRE_SESSION_BATCH_SIZE))
+                if not sessions:
+                    break
+
+                ids = [sess['_id'] for sess in sessions]
+                clients.remove({'_id': {'$in': ids}, 'timestamp': {'$lt': exp}})
+                # A session kept alive since it was read stays, and so do
+                # its collections
+                kept = set(doc['_id'] for doc in
+                           clients.find({'_id': {'$in': ids}}, {'_id': 1}))
+                sessions = [sess for sess in sessions
+                            if sess['_id'] not in kept]
+
+                res_ids = [sess['res_id'] for sess in sessions]
+                db[QUOTAS_COLLECTION].remove({'res_id': {'$in': res_ids}})
+                names = []
+                for sess in sessions:
+                    invalidate_access(sess['res_id'], sess.get('session_id'))
+                    collection_cache.invalidate(sess['res_id'])
+                    # Todo: Only remove collections if no one else is using
+                    # this res_id
+                    for c in sess.get('collections', []):
+                        names.append(to_coll_name(sess['res_id'], c))
+                dropped += sum(pool.map(partial(_drop_collection, db), names))
+                expired += len(sessions)
+        finally:
+            pool.close()
+            pool.join()
+
+        duration = time.time() - started
+        expiry_metrics['runs'] += 1
+        expiry_metrics['sessions_expired'] += expired
+        expiry_metrics['collections_dropped'] += dropped
+        expiry_metrics['last_sessions_expired'] = expired
+        expiry_metrics['last_collections_dropped'] = dropped
+        expiry_metrics['last_duration'] = duration
+        expiry_metrics['last_run'] = datetime.utcnow()
+        app.logger.info('Expired %d sessions dead before %s and dropped %d '
+                        'collections in %.2fs' % (expired, exp, dropped,
+                                                  duration))
+        return {
+            'sessions_expired': expired,
+            'collections_dropped': dropped,
+            'duration': duration
+        }
+
+
+def flush_liveness(app):
+    """Writes this process' buffered session activity. Also called when
+    the process exits."""
+    with app.app_context():
+        try:
+            db = get_db(MWSExceptions=False)
+            with metrics.timed('mws_scheduler_job_duration_seconds',
+                               job='flush_liveness'):
+                flushed = liveness.flush(db)
+        except PyMongoError as e:
+            app.logger.error('Could not record session activity: %s' % e)
+            return
+        app.logger.info('Recorded activity of %d sessions' % flushed)
+
+
+def reap_cursors(app):
+    with app.app_context():
+        db = get_db(MWSExceptions=False)
+        reaped = reap_idle_cursors(db, app.config['CURSOR_IDLE_TIMEOUT'],
+                                   app.config['CURSOR_REAP_BATCH_SIZE'])
+        app.logger.info('Killed %d idle cursors' % reaped)
+        return {'cursors_killed': reaped}
+
+
+def reconcile_quotas(app):
     with app.app_context():
         db = get_db(MWSExceptions=False)
-        delta = timedelta(seconds=EXPIRE_SESSION_DURATION)
-        exp = datetime.now() - delta
-        sessions = db.clients.find({'timestamp': {'$lt': exp}})
-        for sess in sessions:
-            db.clients.remove(sess)
-            # Todo: Only remove collections if no one else is using this res_id
-            res_id = sess['res_id']
-            for c in sess['collections']:
-                db.drop_collection(to_coll_name(res_id, c))
-        app.logger.info('Timed out expired sessions dead before %s' % exp)
+        checked = quota.reconcile(db, app.config['QUOTA_RECONCILE_BATCH_SIZE'])
+        app.logger.info('Reconciled %d collection quotas' % checked)
+        return {'quotas_checked': checked}
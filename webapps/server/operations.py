@@ -0,0 +1,512 @@
+#    Copyright 2013 10gen Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+The database operations behind the mws API.
+
+Each operation takes the res_id, the collection name and the already parsed
+JSON parameters of the request, and returns a result that can be serialized
+with bson.json_util. Errors are raised as MWSServerError. The HTTP views and
+the batch endpoint both dispatch here through OPERATIONS.
+"""
+
+from itertools import islice
+import logging
+
+from bson import BSON
+from bson.errors import BSONError, InvalidBSON, InvalidStringData
+from flask import current_app
+from pymongo.command_cursor import CommandCursor
+from pymongo.errors import (InvalidDocument, OperationFailure,
+    InvalidId, DuplicateKeyError)
+
+from webapps.lib import memory, quota
+from webapps.lib.MWSServerError import MWSServerError
+from webapps.lib.cursors import kill_cursors, register_cursor, touch_cursor
+from webapps.lib.db import get_keepalive_db
+from webapps.lib.util import UseResId
+
+_logger = logging.getLogger(__name__)
+
+pretty_insert = 'WriteResult({{ "nInserted" : {0} }})'
+pretty_bulk_insert = """BulkWriteResult({{
+    "writeErrors" : [ ],
+    "writeConcernErrors" : [ ],
+    "nInserted" : {0},
+    "nUpserted" : 0,
+    "nMatched" : 0,
+    "nModified" : 0,
+    "nRemoved" : 0,
+    "upserted" : [ ]
+}})"""
+pretty_update = 'WriteResult({{ "nMatched" : {0}, "nUpserted" : 0, "nModified" : {1} }})'
+pretty_upsert = 'WriteResult({{ "nMatched" : {0}, "nUpserted" : {1}, "nModified" : {2}, "_id": {3} }})'
+pretty_remove = 'WriteResult({{ "nRemoved" : {0} }})'
+
+
+def recreate_cursor(collection, cursor_id, retrieved, batch_size):
+    """
+    Creates and returns a Cursor object based on an existing cursor in the
+    in the server. If cursor_id is invalid, the returned cursor will raise
+    OperationFailure on read. If batch_size is -1, then all remaining documents
+    on the cursor are returned.
+    """
+    if cursor_id == 0:
+        return None
+
+    database = collection.db.db
+    if isinstance(database, memory.Database):
+        # The memory engine keeps open cursors itself
+        return database.resume_cursor(cursor_id, batch_size)
+
+    cursor_info = {'id': cursor_id, 'firstBatch': []}
+    _logger.info(
+        "collection: {0} cursor_info: {1} retrieved {2} batch_size {3}"
+        .format(collection, cursor_id, retrieved, batch_size))
+    cursor = CommandCursor(collection, cursor_info, 0,
+                           retrieved=retrieved)
+    cursor.batch_size(batch_size)
+
+    return cursor
+
+
+def kill_cursor(collection, cursor_id):
+    kill_cursors(collection.db.db, [cursor_id])
+
+
+def validate_document_or_list(document):
+    if isinstance(document, list):
+        for d in document:
+            validate_document(d)
+    else:
+        validate_document(document)
+
+
+def validate_document(document):
+    if not isinstance(document, dict):
+        raise MWSServerError(400,
+            u"Could not validate '{0}', expected a document".format(document))
+    try:
+        BSON.encode(document)
+    except (InvalidDocument,
+        TypeError,
+        InvalidId,
+        BSONError,
+        InvalidBSON,
+        InvalidStringData
+        ) as e:
+        raise MWSServerError(400, str(e))
+
+
+def calculate_document_size(document):
+    req_size = 0
+    if isinstance(document, list):
+        for d in document:
+            req_size += calculate_document_size(d)
+    else:
+        req_size = len(BSON.encode(document))
+    return req_size
+
+
+def estimated_count(coll):
+    """
+    Returns the number of documents in the WrappedCollection coll from
+    collection metadata, without running a query.
+    """
+    try:
+        return coll.db.db.command({'collstats': coll.name}).get('count', 0)
+    except OperationFailure:
+        # The collection has not been created yet
+        return 0
+
+
+def apply_skip_limit(count, skip, limit):
+    count = max(count - skip, 0)
+    return min(count, limit) if limit else count
+
+
+# Read Methods
+
+
+def count(res_id, collection_name, params):
+    """
+    Counts the documents matching 'query', after 'skip' and 'limit' if given.
+    With 'estimate' set, an unfiltered count is read from collection metadata
+    instead of being counted.
+    """
+    query = params.get('query')
+    skip = params.get('skip') or 0
+    limit = params.get('limit') or 0
+    with UseResId(res_id) as db:
+        coll = db[collection_name]
+        if params.get('estimate') and not query:
+            return apply_skip_limit(estimated_count(coll), skip, limit)
+        try:
+            cursor = coll.find(query, skip=skip, limit=limit)
+            return cursor.count(with_limit_and_skip=True)
+        except InvalidDocument as e:
+            raise MWSServerError(400, str(e))
+
+
+def find_one(res_id, collection_name, params):
+    with UseResId(res_id) as db:
+        query = params.get('query')
+        projection = params.get('projection')
+        coll = db[collection_name]
+        return coll.find_one(query, projection)
+
+
+def find(res_id, collection_name, params):
+    """
+    Runs a query and returns its first batch. The number of matching
+    documents costs a second query, so it is only included when asked for
+    with 'with_count': true, or 'estimated' to read it from collection
+    metadata when the query has no filter.
+    """
+    result = {}
+    batch_size = current_app.config['CURSOR_BATCH_SIZE']
+    with UseResId(res_id, db=get_keepalive_db()) as db:
+        limit = params.get('limit', 0)
+        coll = db[collection_name]
+        query = params.get('query')
+        projection = params.get('projection')
+        skip = params.get('skip', 0)
+        sort = params.get('sort', {})
+        sort = sort.items()
+
+        cursor = coll.find(spec=query, fields=projection, skip=skip,
+                           limit=limit)
+        cursor.batch_size(batch_size)
+
+        if len(sort) > 0:
+            cursor.sort(sort)
+
+        # count is only available before cursor is read so we include it
+        # in the first response
+        with_count = params.get('with_count')
+        if with_count == 'estimated' and not query:
+            result['count'] = apply_skip_limit(estimated_count(coll),
+                                               skip or 0, limit or 0)
+        elif with_count:
+            result['count'] = cursor.count(with_limit_and_skip=True)
+
+        num_to_return = min(limit, batch_size) if limit else batch_size
+
+        try:
+            result['result'] = []
+            for i in range(num_to_return):
+                try:
+                    result['result'].append(cursor.next())
+                except StopIteration:
+                    break
+        except OperationFailure as e:
+            raise MWSServerError(400, 'Cursor not found')
+
+        # cursor_id is too big as a number, use a string instead. A cursor
+        # that has been exhausted or reached its limit is reported as 0.
+        cursor_id = cursor.cursor_id if cursor.alive else 0
+        result['cursor_id'] = str(cursor_id or 0)
+        if cursor_id:
+            register_cursor(res_id, collection_name, cursor_id)
+        # close the Cursor object, but keep the cursor alive on the server
+        del cursor
+
+        return result
+
+
+def _remaining(params):
+    """Returns how many documents are left under the 'limit' of the original
+    query, or None if it had no limit."""
+    limit = params.get('limit') or 0
+    if not limit:
+        return None
+    return max(limit - params.get('retrieved', 0), 0)
+
+
+def next(res_id, collection_name, params):
+    if params.get('drain_cursor', False):
+        documents = drain(res_id, collection_name, params)
+        try:
+            return {'result': list(documents), 'empty_cursor': True}
+        finally:
+            documents.close()
+
+    result = {}
+    batch_size = current_app.config['CURSOR_BATCH_SIZE']
+    with UseResId(res_id, db=get_keepalive_db()) as db:
+        coll = db[collection_name]
+        cursor_id = int(params.get('cursor_id'))
+        retrieved = params.get('retrieved', 0)
+        remaining = _remaining(params)
+        num_to_return = batch_size if remaining is None else \
+            min(remaining, batch_size)
+
+        if not touch_cursor(res_id, cursor_id):
+            raise MWSServerError(400, 'Cursor not found')
+
+        cursor = recreate_cursor(coll, cursor_id, retrieved, batch_size)
+        try:
+            result['result'] = []
+            for i in range(num_to_return):
+                try:
+                    result['result'].append(cursor.next())
+                except StopIteration:
+                    break
+        except OperationFailure as e:
+            raise MWSServerError(400, 'Cursor not found')
+
+        # kill cursor on server if all results are returned
+        if not cursor.alive or len(result['result']) < batch_size:
+            result['empty_cursor'] = True
+            kill_cursor(coll, long(cursor_id))
+
+        return result
+
+
+def drain(res_id, collection_name, params):
+    """
+    Returns an iterator over the documents left on the cursor in params, up
+    to the 'limit' of the original query. The cursor is checked before this
+    returns, but documents are only fetched, CURSOR_DRAIN_BATCH_SIZE at a
+    time, as the iterator is consumed, so the caller may stream them out
+    without holding the whole result. The iterator raises MWSServerError if
+    the cursor is lost part way through. The cursor is killed once the
+    iterator is exhausted or closed; a caller that may not consume it must
+    close it.
+    """
+    batch_size = current_app.config['CURSOR_DRAIN_BATCH_SIZE']
+    with UseResId(res_id, db=get_keepalive_db()) as db:
+        coll = db[collection_name]
+        cursor_id = int(params.get('cursor_id'))
+        retrieved = params.get('retrieved', 0)
+
+        if not touch_cursor(res_id, cursor_id):
+            raise MWSServerError(400, 'Cursor not found')
+
+        cursor = recreate_cursor(coll, cursor_id, retrieved, batch_size)
+        return DrainedCursor(coll, cursor, long(cursor_id),
+                             _remaining(params))
+
+
+class DrainedCursor(object):
+    """The iterator returned by drain. Unlike a generator's finally, close
+    kills the cursor even if iteration never started, as when the response
+    streaming it is dropped before its first chunk."""
+
+    def __init__(self, coll, cursor, cursor_id, limit):
+        self._coll = coll
+        self._documents = islice(cursor, limit)
+        self._cursor_id = cursor_id
+        self._closed = False
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self._closed:
+            raise StopIteration
+        try:
+            return self._documents.next()
+        except StopIteration:
+            self.close()
+            raise
+        except OperationFailure as e:
+            self.close()
+            raise MWSServerError(400, 'Cursor not found')
+
+    def close(self):
+        # The server closes an exhausted cursor itself, but one stopped at
+        # its limit or abandoned mid-stream stays open; either way it leaves
+        # the registry.
+        if not self._closed:
+            self._closed = True
+            kill_cursor(self._coll, self._cursor_id)
+
+
+def aggregate(res_id, collection_name, params):
+    _logger.info("json: {0}".format(params))
+    with UseResId(res_id) as db:
+        try:
+            return db[collection_name].aggregate(params)
+        except (InvalidId,
+            TypeError,
+            InvalidDocument,
+            OperationFailure) as e:
+            raise MWSServerError(400, str(e))
+
+
+# Write Methods
+
+
+def insert(res_id, collection_name, params):
+    document = params.get('document')
+    if document is None:
+        raise MWSServerError(400,
+            "no object passed to insert!")
+
+    validate_document_or_list(document)
+    req_size, req_count = quota.insert_size(document)
+
+    # Insert document
+    with UseResId(res_id) as db:
+        coll = db[collection_name]
+        # Check quota
+        quota.reserve(coll, req_size, req_count)
+
+        # Attempt Insert
+        try:
+            res = coll.insert(document)
+        except (DuplicateKeyError, OperationFailure) as e:
+            quota.adjust(coll, -req_size, -req_count)
+            raise MWSServerError(400, str(e))
+        except Exception:
+            quota.adjust(coll, -req_size, -req_count)
+            raise
+        if isinstance(res, list):
+            pretty_response = pretty_bulk_insert.format(len(res))
+        else:
+            pretty_response = pretty_insert.format(1)
+    return {'pretty': pretty_response}
+
+
+def update(res_id, collection_name, params):
+    query = params.get('query')
+    update = params.get('update')
+    upsert = params.get('upsert', False)
+    multi = params.get('multi', False)
+    if query is None or update is None:
+        error = 'update requires spec and document arguments'
+        raise MWSServerError(400, error)
+
+
+    with UseResId(res_id) as db:
+        # Check quota
+        coll = db[collection_name]
+        # Every document the update matches is charged the size of the
+        # update. It would be nice if we were able to make a more
+        # conservative estimate of the space difference that an update will
+        # cause. (especially if it results in smaller documents)
+        # Only one document's worth is checked against the quota up front,
+        # as how many a multi update matches is only known once it has run.
+        update_size = calculate_document_size(update)
+        quota.reserve(coll, update_size)
+
+        # Attempt Update
+        try:
+            res = coll.update(query, update, upsert, multi=multi)
+        except (DuplicateKeyError,
+            InvalidDocument,
+            InvalidId,
+            TypeError,
+            OperationFailure) as e:
+            quota.adjust(coll, -update_size)
+            raise MWSServerError(400, str(e))
+        except Exception:
+            quota.adjust(coll, -update_size)
+            raise
+        _logger.info("res: {0}".format(res))
+        n_matched = 0 if res.get('upserted') else res.get('n')
+        n_upserted = 1 if res.get('upserted') else 0
+        n_modified = res.get('nModified', 0)
+        # Settle the reservation for the documents actually written, which
+        # needs no further write for a single update of one document
+        quota.adjust(coll, update_size * (res.get('n', 0) - 1), n_upserted)
+        if n_upserted:
+            _id = res.get('upserted')[0].get('_id')
+            pretty_response = pretty_upsert.format(n_matched, n_upserted, n_modified, _id)
+        else:
+            pretty_response = pretty_update.format(n_matched, n_modified)
+        return {'pretty': pretty_response}
+
+
+def save(res_id, collection_name, params):
+    document = params.get('document')
+    if document is None:
+        raise MWSServerError(400,
+            "'document' argument not found in the save request.")
+
+
+    validate_document(document)
+    req_size, req_count = quota.insert_size(document)
+
+
+    # Get database
+    with UseResId(res_id) as db:
+        coll = db[collection_name]
+        # Check quota. Saving over an existing document is charged as if it
+        # were new; reconciliation corrects the difference later.
+        quota.reserve(coll, req_size, req_count)
+
+        # Save document
+        try:
+            if "_id" not in document:
+                res = coll.insert(document)
+                if res:
+                    res_len = len(res) if isinstance(res, list) else 1
+                    pretty_response = pretty_insert.format(res_len)
+            else:
+                res = coll.update({"_id": document["_id"]},
+                    document, True)
+                n_matched = 0 if res.get('upserted') else 1
+                n_upserted = 1 if res.get('upserted') else 0
+                quota.adjust(coll, 0, n_upserted - req_count)
+                n_modified = res.get('nModified', 0)
+                if n_upserted:
+                    _id = res.get('upserted')[0].get('_id')
+                    pretty_response = pretty_upsert.format(n_matched, n_upserted, n_modified, _id)
+                else:
+                    pretty_response = pretty_update.format(n_matched, n_modified)
+            return {'pretty': pretty_response}
+        except (InvalidId, TypeError, InvalidDocument, DuplicateKeyError) as e:
+            quota.adjust(coll, -req_size, -req_count)
+            raise MWSServerError(400, str(e))
+        except Exception:
+            quota.adjust(coll, -req_size, -req_count)
+            raise
+
+
+def remove(res_id, collection_name, params):
+    constraint = params.get('constraint') or {}
+    options = params.get('options') or {}
+    multi = not options.get('justOne')
+
+    with UseResId(res_id) as db:
+        collection = db[collection_name]
+        try:
+            res = collection.remove(constraint, multi=multi)
+            quota.release_removed(collection, res.get('n'))
+            pretty_response = pretty_remove.format(res.get('n'))
+        except (InvalidDocument, InvalidId, TypeError, OperationFailure) as e:
+            raise MWSServerError(400, str(e))
+        return {'pretty': pretty_response}
+
+
+def drop(res_id, collection_name, params):
+    with UseResId(res_id) as db:
+        db.drop_collection(collection_name)
+
+
+# Operation name -> (function, rate limit endpoint class)
+OPERATIONS = {
+    'count': (count, 'read'),
+    'find_one': (find_one, 'read'),
+    'find': (find, 'read'),
+    'next': (next, 'read'),
+    'aggregate': (aggregate, None),
+    'insert': (insert, 'write'),
+    'update': (update, 'write'),
+    'save': (save, 'write'),
+    'remove': (remove, 'write'),
+    'drop': (drop, 'write'),
+}
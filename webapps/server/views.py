@@ -13,47 +13,36 @@
 #    limitations under the License.
 
 import logging
-from datetime import datetime, timedelta
-from functools import update_wrapper
+from datetime import datetime
 import uuid
 
-from bson import BSON
 from bson.json_util import dumps, loads
-from flask import Blueprint, current_app, make_response, request, session
+from flask import (Blueprint, Response, current_app, request, session,
+    stream_with_context)
 app = current_app
-from pymongo.errors import (InvalidDocument, OperationFailure,
-    InvalidId, DuplicateKeyError)
-from pymongo.command_cursor import CommandCursor
-from pymongo.errors import InvalidDocument, OperationFailure
+from pymongo.errors import InvalidId
 
 from webapps.lib import CLIENTS_COLLECTION
 from webapps.lib.MWSServerError import MWSServerError
-from webapps.lib.db import get_db, get_keepalive_db
-from webapps.lib.decorators import check_session_id, ratelimit
+from webapps.lib.db import get_db
+from webapps.lib.decorators import (
+    charge_ratelimit,
+    check_session_id,
+    invalidate_access,
+    ratelimit
+)
 from webapps.lib.util import (
     UseResId,
     get_collection_names
 )
+from webapps.server import operations, websocket
+from webapps.server.operations import OPERATIONS
 
 _logger = logging.getLogger(__name__)
 
 mws = Blueprint('mws', __name__, url_prefix='/mws')
 
-pretty_insert = 'WriteResult({{ "nInserted" : {0} }})'
-pretty_bulk_insert = """BulkWriteResult({{
-    "writeErrors" : [ ],
-    "writeConcernErrors" : [ ],
-    "nInserted" : {0},
-    "nUpserted" : 0,
-    "nMatched" : 0,
-    "nModified" : 0,
-    "nRemoved" : 0,
-    "upserted" : [ ]
-}})"""
-pretty_update = 'WriteResult({{ "nMatched" : {0}, "nUpserted" : 0, "nModified" : {1} }})'
-pretty_upsert = 'WriteResult({{ "nMatched" : {0}, "nUpserted" : {1}, "nModified" : {2}, "_id": {3} }})'
-pretty_remove = 'WriteResult({{ "nRemoved" : {0} }})'
-
+NDJSON_MIMETYPE = 'application/x-ndjson'
 
 
 def generate_res_id():
@@ -84,31 +73,50 @@ def to_json(result):
         raise MWSServerError(500, error)
 
 
-
-def recreate_cursor(collection, cursor_id, retrieved, batch_size):
+def stream_ndjson(documents):
     """
-    Creates and returns a Cursor object based on an existing cursor in the
-    in the server. If cursor_id is invalid, the returned cursor will raise
-    OperationFailure on read. If batch_size is -1, then all remaining documents
-    on the cursor are returned.
+    Writes one JSON document per line. If the documents cannot all be read,
+    the last line is an error in the same form as MWSServerError bodies.
     """
-    if cursor_id == 0:
-        return None
+    try:
+        for document in documents:
+            yield dumps(document) + '\n'
+    except MWSServerError as e:
+        yield e.get_body(None) + '\n'
 
-    cursor_info = {'id': cursor_id, 'firstBatch': []}
-    _logger.info(
-        "collection: {0} cursor_info: {1} retrieved {2} batch_size {3}"
-        .format(collection, cursor_id, retrieved, batch_size))
-    cursor = CommandCursor(collection, cursor_info, 0,
-                           retrieved=retrieved)
-    cursor.batch_size(batch_size)
 
-    return cursor
+def stream_json_result(documents):
+    """
+    Writes {"result": [...], "empty_cursor": true}, the body of a drained
+    next request, one document at a time. If the documents cannot all be
+    read, "error" takes the place of "empty_cursor".
+    """
+    yield '{"result": ['
+    separator = ''
+    try:
+        for document in documents:
+            yield separator + dumps(document)
+            separator = ', '
+    except MWSServerError as e:
+        yield '], "error": ' + e.get_body(None) + '}'
+    else:
+        yield '], "empty_cursor": true}'
 
 
-def kill_cursor(collection, cursor_id):
-    client = collection.db.db.connection
-    client.kill_cursors([cursor_id])
+def buffer_chunks(pieces, size):
+    """Joins small pieces of a streamed body into chunks of about size
+    bytes, so each document does not become its own write."""
+    buf = []
+    buffered = 0
+    for piece in pieces:
+        buf.append(piece)
+        buffered += len(piece)
+        if buffered >= size:
+            yield ''.join(buf)
+            buf = []
+            buffered = 0
+    if buf:
+        yield ''.join(buf)
 
 
 @mws.after_request
@@ -118,40 +126,6 @@ def no_cache(response):
     return response
 
 
-def validate_document_or_list(document):
-    if isinstance(document, list):
-        for d in document:
-            validate_document(d)
-    else:
-        validate_document(document)
-
-
-def validate_document(document):
-    if not isinstance(document, dict):
-        raise MWSServerError(400,
-            u"Could not validate '{0}', expected a document".format(document))
-    try:
-        BSON.encode(document)
-    except (InvalidDocument,
-        TypeError,
-        InvalidId,
-        BSONError,
-        InvalidBSON,
-        InvalidStringData
-        ) as e:
-        raise MWSServerError(400, str(e))
-
-
-def calculate_document_size(document):
-    req_size = 0
-    if isinstance(document, list):
-        for d in document:
-            req_size += calculate_document_size(d)
-    else:
-        req_size = len(BSON.encode(document))
-    return req_size
-
-
 @mws.route('/', methods=['POST'])
 def create_mws_resource():
     session_id = session.get('session_id', str(uuid.uuid4()))
@@ -172,6 +146,7 @@ def create_mws_resource():
             'session_id': session_id,
             'timestamp': datetime.now()
         })
+        invalidate_access(res_id, session_id)
         is_new = True
     return to_json({'res_id': res_id, 'is_new': is_new})
 
@@ -179,152 +154,76 @@ def create_mws_resource():
 @mws.route('/<res_id>/keep-alive', methods=['POST'])
 @check_session_id
 def keep_mws_alive(res_id):
-    clients = get_db()[CLIENTS_COLLECTION]
-    clients.update({'session_id': session.get('session_id'), 'res_id': res_id},
-                   {'$set': {'timestamp': datetime.now()}})
+    # check_session_id has recorded the activity; see lib/liveness.py
     return empty_success()
 
 
-# Read Methods
+@mws.route('/<res_id>/ws', methods=['GET'])
+@check_session_id
+def mws_websocket(res_id):
+    """Answers the shell's commands over a WebSocket; see websocket.py."""
+    socket = request.environ.get('wsgi.websocket')
+    if socket is None or not current_app.config['WEBSOCKET_ENABLED']:
+        raise MWSServerError(400, 'Expected a WebSocket connection')
+    websocket.serve(socket, res_id, session['session_id'])
+    return empty_success()
 
 
-@mws.route('/<res_id>/db/<collection_name>/count', methods=['GET'])
-@check_session_id
-@ratelimit
-def db_count(res_id, collection_name):
-    parse_get_json()
-    with UseResId(res_id) as db:
-        query = request.json.get('query')
-        coll = db[collection_name]
-        count = coll.find(query).count()
-        return to_json(count)
+# Read Methods
 
 
 @mws.route('/<res_id>/db/<collection_name>/find_one', methods=['GET'])
 @check_session_id
-@ratelimit
+@ratelimit(endpoint_class='read')
 def db_find_one(res_id, collection_name):
     parse_get_json()
-    with UseResId(res_id) as db:
-        query = request.json.get('query')
-        projection = request.json.get('projection')
-        coll = db[collection_name]
-        doc = coll.find_one(query, projection)
-        return to_json(doc)
+    return to_json(operations.find_one(res_id, collection_name, request.json))
 
 
 @mws.route('/<res_id>/db/<collection_name>/find', methods=['GET'])
 @check_session_id
-@ratelimit
+@ratelimit(endpoint_class='read')
 def db_collection_find(res_id, collection_name):
     parse_get_json()
-    result = {}
-    batch_size = current_app.config['CURSOR_BATCH_SIZE']
-    with UseResId(res_id, db=get_keepalive_db()) as db:
-        limit = request.json.get('limit', 0)
-        coll = db[collection_name]
-        query = request.json.get('query')
-        projection = request.json.get('projection')
-        skip = request.json.get('skip', 0)
-        sort = request.json.get('sort', {})
-        sort = sort.items()
-
-        cursor = coll.find(spec=query, fields=projection, skip=skip,
-                           limit=limit)
-        cursor.batch_size(batch_size)
-
-        if len(sort) > 0:
-            cursor.sort(sort)
-
-        # count is only available before cursor is read so we include it
-        # in the first response
-        result['count'] = cursor.count(with_limit_and_skip=True)
-        count = result['count']
-
-
-        num_to_return = min(limit, batch_size) if limit else batch_size
-
-        try:
-            result['result'] = []
-            for i in range(num_to_return):
-                try:
-                    result['result'].append(cursor.next())
-                except StopIteration:
-                    break
-        except OperationFailure as e:
-            return MWSServerError(400, 'Cursor not found')
-
-        # cursor_id is too big as a number, use a string instead
-        result['cursor_id'] = str(cursor.cursor_id)
-        # close the Cursor object, but keep the cursor alive on the server
-        del cursor
-
-        return to_json(result)
+    return to_json(operations.find(res_id, collection_name, request.json))
 
 
 @mws.route('/<res_id>/db/<collection_name>/next', methods=['GET'])
 @check_session_id
-@ratelimit
+@ratelimit(endpoint_class='read')
 def db_cursor_next(res_id, collection_name):
     parse_get_json()
-    result = {}
-    batch_size = current_app.config['CURSOR_BATCH_SIZE']
-    with UseResId(res_id, db=get_keepalive_db()) as db:
-        coll = db[collection_name]
-        cursor_id = int(request.json.get('cursor_id'))
-        retrieved = request.json.get('retrieved', 0)
-        drain_cursor = request.json.get('drain_cursor', False)
-        batch_size = -1 if drain_cursor else current_app.config['CURSOR_BATCH_SIZE']
-
-        cursor = recreate_cursor(coll, cursor_id, retrieved, batch_size)
-        try:
-            result['result'] = []
-            for i in range(batch_size):
-                try:
-                    result['result'].append(cursor.next())
-                except StopIteration:
-                    result['empty_cursor'] = True
-                    break
-        except OperationFailure as e:
-            return MWSServerError(400, 'Cursor not found')
-
-        # kill cursor on server if all results are returned
-        if result.get('empty_cursor'):
-            kill_cursor(coll, long(cursor_id))
-
-        return to_json(result)
+    if request.json.get('drain_cursor', False):
+        documents = operations.drain(res_id, collection_name, request.json)
+        mimetypes = ['application/json', NDJSON_MIMETYPE]
+        if request.accept_mimetypes.best_match(mimetypes) == NDJSON_MIMETYPE:
+            body = stream_ndjson(documents)
+            mimetype = NDJSON_MIMETYPE
+        else:
+            body = stream_json_result(documents)
+            mimetype = 'application/json'
+        chunks = buffer_chunks(body, current_app.config['STREAM_CHUNK_SIZE'])
+        response = Response(stream_with_context(chunks), mimetype=mimetype)
+        # Kills the cursor even if the body is dropped before it is read
+        response.call_on_close(documents.close)
+        return response
+    return to_json(operations.next(res_id, collection_name, request.json))
+
 
 @mws.route('/<res_id>/db/<collection_name>/aggregate', methods=['GET'])
 @check_session_id
 def db_collection_aggregate(res_id, collection_name):
     parse_get_json()
-    _logger.info("json: {0}".format(request.json))
-    with UseResId(res_id) as db:
-        try:
-            result = db[collection_name].aggregate(request.json)
-        except (InvalidId,
-            TypeError,
-            InvalidDocument,
-            OperationFailure) as e:
-            raise MWSServerError(400, str(e))
-    return to_json(result)
+    return to_json(operations.aggregate(res_id, collection_name, request.json))
 
 
 @mws.route('/<res_id>/db/<collection_name>/count', methods=['GET'])
 @check_session_id
-@ratelimit
+@ratelimit(endpoint_class='read')
 def db_collection_count(res_id, collection_name):
     parse_get_json()
-
-    query = request.json.get('query')
-
-    with UseResId(res_id) as db:
-        coll = db[collection_name]
-        try:
-            count = coll.find(query).count()
-            return to_json({'count': count})
-        except InvalidDocument as e:
-            raise MWSServerError(400, str(e))
+    count = operations.count(res_id, collection_name, request.json)
+    return to_json({'count': count})
 
 
 # Write Methods
@@ -332,163 +231,109 @@ def db_collection_count(res_id, collection_name):
 
 @mws.route('/<res_id>/db/<collection_name>/insert', methods=['POST'])
 @check_session_id
-@ratelimit
+@ratelimit(endpoint_class='write')
 def db_collection_insert(res_id, collection_name):
     parse_get_json()
-
-    document = request.json.get('document')
-    if document is None:
-        raise MWSServerError(400,
-            "no object passed to insert!")
-
-    validate_document_or_list(document)
-    req_size = calculate_document_size(document)
-
-    # Insert document
-    with UseResId(res_id) as db:
-        # Check quota
-        size = db[collection_name].size()
-        if size + req_size > current_app.config['QUOTA_COLLECTION_SIZE']:
-            raise MWSServerError(403, 'Collection size exceeded')
-
-        # Attempt Insert
-        try:
-            res = db[collection_name].insert(document)
-        except (DuplicateKeyError, OperationFailure) as e:
-            raise MWSServerError(400, str(e))
-        if isinstance(res, list):
-            pretty_response = pretty_bulk_insert.format(len(res))
-        else:
-            pretty_response = pretty_insert.format(1)
-    return to_json({'pretty': pretty_response})
+    return to_json(operations.insert(res_id, collection_name, request.json))
 
 
 @mws.route('/<res_id>/db/<collection_name>/update', methods=['PUT'])
 @check_session_id
-@ratelimit
+@ratelimit(endpoint_class='write')
 def db_collection_update(res_id, collection_name):
     parse_get_json()
-
-    query = request.json.get('query')
-    update = request.json.get('update')
-    upsert = request.json.get('upsert', False)
-    multi = request.json.get('multi', False)
-    if query is None or update is None:
-        error = 'update requires spec and document arguments'
-        raise MWSServerError(400, error)
-
-
-    with UseResId(res_id) as db:
-        # Check quota
-        coll = db[collection_name]
-        # Computation of worst case size increase - update size * docs affected
-        # It would be nice if we were able to make a more conservative estimate
-        # of the space difference that an update will cause. (especially if it
-        # results in smaller documents)
-        # TODO: Make this more intelligent. I'm not sure that this even makes sense.
-        affected = coll.find(query).count()
-        req_size = calculate_document_size(update) * affected
-
-        size = db[collection_name].size()
-
-        if size + req_size > current_app.config['QUOTA_COLLECTION_SIZE']:
-            raise MWSServerError(403, 'Collection size exceeded')
-
-        # Attempt Update
-        try:
-            res = db[collection_name].update(query, update, upsert, multi=multi)
-            _logger.info("res: {0}".format(res))
-            n_matched = 0 if res.get('upserted') else res.get('n') 
-            n_upserted = 1 if res.get('upserted') else 0
-            n_modified = res.get('nModified', 0)
-            if n_upserted:
-                _id = res.get('upserted')[0].get('_id')
-                pretty_response = pretty_upsert.format(n_matched, n_upserted, n_modified, _id)
-            else:
-                pretty_response = pretty_update.format(n_matched, n_modified)
-            return to_json({'pretty': pretty_response})
-        except (DuplicateKeyError,
-            InvalidDocument,
-            InvalidId,
-            TypeError,
-            OperationFailure) as e:
-            raise MWSServerError(400, str(e))
+    return to_json(operations.update(res_id, collection_name, request.json))
 
 
 @mws.route('/<res_id>/db/<collection_name>/save', methods=['POST'])
 @check_session_id
-@ratelimit
+@ratelimit(endpoint_class='write')
 def db_collection_save(res_id, collection_name):
     parse_get_json()
-
-    document = request.json.get('document')
-    if document is None:
-        raise MWSServerError(400,
-            "'document' argument not found in the save request.")
-
-
-    validate_document(document)
-    req_size = calculate_document_size(document)
-
-
-    # Get database
-    with UseResId(res_id) as db:
-        # Check quota
-        size = db[collection_name].size()
-        if size + req_size > current_app.config['QUOTA_COLLECTION_SIZE']:
-            raise MWSServerError(403, 'Collection size exceeded')
-
-        # Save document
-        try:
-            if "_id" not in document:
-                res = db[collection_name].insert(document)
-                if res:
-                    res_len = len(res) if isinstance(res, list) else 1
-                    pretty_response = pretty_insert.format(res_len)
-            else:
-                res = db[collection_name].update({"_id": document["_id"]},
-                    document, True)
-                n_matched = 0 if res.get('upserted') else 1
-                n_upserted = 1 if res.get('upserted') else 0
-                n_modified = res.get('nModified', 0)
-                if n_upserted:
-                    _id = res.get('upserted')[0].get('_id')
-                    pretty_response = pretty_upsert.format(n_matched, n_upserted, n_modified, _id)
-                else:
-                    pretty_response = pretty_update.format(n_matched, n_modified)
-            return to_json({'pretty': pretty_response})
-        except (InvalidId, TypeError, InvalidDocument, DuplicateKeyError) as e:
-            raise MWSServerError(400, str(e))
+    return to_json(operations.save(res_id, collection_name, request.json))
 
 
 @mws.route('/<res_id>/db/<collection_name>/remove', methods=['DELETE'])
 @check_session_id
-@ratelimit
+@ratelimit(endpoint_class='write')
 def db_collection_remove(res_id, collection_name):
     parse_get_json()
-    constraint = request.json.get('constraint') if request.json else {}
-    options = request.json and request.json.get('options', False)
-    multi = not options.get('justOne')
-
-    with UseResId(res_id) as db:
-        collection = db[collection_name]
-        try:
-            res = collection.remove(constraint, multi=multi)
-            pretty_response = pretty_remove.format(res.get('n'))
-        except (InvalidDocument, InvalidId, TypeError, OperationFailure) as e:
-            raise MWSServerError(400, str(e))
-        return to_json({'pretty': pretty_response})
+    return to_json(operations.remove(res_id, collection_name, request.json))
 
 
 @mws.route('/<res_id>/db/<collection_name>/drop', methods=['DELETE'])
 @check_session_id
-@ratelimit
+@ratelimit(endpoint_class='write')
 def db_collection_drop(res_id, collection_name):
-    with UseResId(res_id) as db:
-        db.drop_collection(collection_name)
+    operations.drop(res_id, collection_name, {})
     return empty_success()
 
 
+@mws.route('/<res_id>/batch', methods=['POST'])
+@check_session_id
+def db_batch(res_id):
+    """
+    Runs a list of operations in one request. The body is
+    {'operations': [{'op': ..., 'collection': ..., 'params': {...}}, ...],
+     'ordered': true}, where op is any key of OPERATIONS and params is what
+    the single operation endpoint takes as its JSON body.
+
+    Each operation counts against the rate limit of its endpoint class as if
+    it had been sent on its own. The response holds one {'result': ...} or
+    {'error': ...} entry per operation that was run; an ordered batch stops
+    at the first error.
+    """
+    parse_get_json()
+    ops = request.json.get('operations')
+    ordered = request.json.get('ordered', True)
+    if not isinstance(ops, list):
+        raise MWSServerError(400, 'batch requires a list of operations')
+    max_ops = current_app.config['BATCH_MAX_OPERATIONS']
+    if len(ops) > max_ops:
+        error = 'batch may hold at most {0} operations'.format(max_ops)
+        raise MWSServerError(400, error)
+
+    # Validate the whole batch up front so nothing runs if any of it is bad
+    costs = {}
+    for i, op in enumerate(ops):
+        if (not isinstance(op, dict) or op.get('op') not in OPERATIONS or
+                not isinstance(op.get('collection'), basestring) or
+                not isinstance(op.get('params', {}), dict)):
+            raise MWSServerError(400, 'Invalid operation', 'index {0}'.format(i))
+        endpoint_class = OPERATIONS[op['op']][1]
+        if endpoint_class:
+            costs[endpoint_class] = costs.get(endpoint_class, 0) + 1
+    for endpoint_class, cost in costs.iteritems():
+        charge_ratelimit(endpoint_class, cost)
+
+    results = []
+    for op in ops:
+        handler = OPERATIONS[op['op']][0]
+        try:
+            result = handler(res_id, op['collection'], op.get('params', {}))
+        except MWSServerError as e:
+            results.append({'error': {
+                'error': e.error,
+                'reason': e.message,
+                'detail': e.detail
+            }})
+            if ordered:
+                break
+        except Exception:
+            # Earlier operations have run, so their results are still sent
+            _logger.exception('Batch operation failed')
+            results.append({'error': {
+                'error': 500,
+                'reason': 'The server experienced an unexpected error.',
+                'detail': ''
+            }})
+            if ordered:
+                break
+        else:
+            results.append({'result': result})
+    return to_json({'results': results})
+
+
 @mws.route('/<res_id>/db', methods=['DELETE'])
 @check_session_id
 def db_drop(res_id):
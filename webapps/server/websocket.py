@@ -0,0 +1,165 @@
+#    Copyright 2013 10gen Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+A WebSocket channel for a shell, as an alternative to one HTTP request per
+command.
+
+The shell opens /mws/<res_id>/ws once. The session is checked when the
+connection is made and the session's res_id stays alive for as long as the
+connection is open, so no keep-alive requests are needed. The session is
+checked again in the database before each write and every
+WEBSOCKET_KEEP_ALIVE seconds, and the connection is closed once it no longer
+has access, as when its res_id has expired. Each message is a JSON command,
+
+    {"id": 1, "op": "find", "collection": "foo", "params": {...}}
+
+where op is any key of OPERATIONS and params is what the HTTP endpoint
+takes as its JSON body. Each command is answered with {"id": 1, "result":
+...}, the result being the body the HTTP endpoint would have returned, or
+with {"id": 1, "error": {"error": 400, "reason": ..., "detail": ...}}.
+Commands still count against the rate limit of their endpoint class.
+
+WebSocket connections are only accepted when the app is served by
+webapps.server.async_app with WEBSOCKET_ENABLED set.
+"""
+
+import logging
+
+from bson.json_util import dumps, loads
+from flask import current_app
+
+from webapps.lib import liveness
+from webapps.lib.MWSServerError import MWSServerError
+from webapps.lib.decorators import charge_ratelimit, user_has_access
+from webapps.server.operations import OPERATIONS
+
+_logger = logging.getLogger(__name__)
+
+# Operation name -> function turning its result into the HTTP response body
+RESPONSES = {
+    'count': lambda count: {'count': count},
+}
+
+
+class AccessRevoked(MWSServerError):
+    """Raised for a command once the session no longer has access to the
+    res_id, after which the connection is closed."""
+
+    def __init__(self, command_id):
+        super(AccessRevoked, self).__init__(
+            403, 'Session error. User does not have access to res_id')
+        self.command_id = command_id
+
+
+def error_body(e):
+    return {'error': e.error, 'reason': e.message, 'detail': e.detail}
+
+
+def parse_message(message):
+    """Returns the JSON object in message, or raises a 400."""
+    try:
+        command = loads(message)
+    except (TypeError, ValueError) as e:
+        raise MWSServerError(400, str(e))
+    if not isinstance(command, dict):
+        raise MWSServerError(400, 'Invalid command')
+    return command
+
+
+def dispatch(res_id, session_id, message):
+    """Runs the command in message for res_id and returns its reply. Raises
+    AccessRevoked for a write once session_id no longer has access."""
+    command_id = None
+    try:
+        command = parse_message(message)
+        command_id = command.get('id')
+        if (command.get('op') not in OPERATIONS or
+                not isinstance(command.get('collection'), basestring) or
+                not isinstance(command.get('params', {}), dict)):
+            raise MWSServerError(400, 'Invalid command')
+        handler, endpoint_class = OPERATIONS[command['op']]
+        if (endpoint_class == 'write' and
+                not user_has_access(res_id, session_id, cached=False)):
+            raise AccessRevoked(command_id)
+        if endpoint_class:
+            charge_ratelimit(endpoint_class)
+        result = handler(res_id, command['collection'],
+                         command.get('params', {}))
+        if command['op'] in RESPONSES:
+            result = RESPONSES[command['op']](result)
+        return {'id': command_id, 'result': result}
+    except AccessRevoked:
+        raise
+    except MWSServerError as e:
+        return {'id': command_id, 'error': error_body(e)}
+    except Exception:
+        # One failed command must not close the shell's connection
+        _logger.exception('WebSocket command failed')
+        error = MWSServerError(500, 'The server experienced an unexpected error.')
+        return {'id': command_id, 'error': error_body(error)}
+
+
+def close_if_revoked(socket, res_id, session_id):
+    """Closes socket if session_id no longer has access to res_id. Returns
+    whether it did."""
+    if user_has_access(res_id, session_id, cached=False):
+        return False
+    socket.close()
+    return True
+
+
+def keep_alive(app, socket, res_id, session_id, interval):
+    import gevent
+    while True:
+        gevent.sleep(interval)
+        with app.app_context():
+            if close_if_revoked(socket, res_id, session_id):
+                return
+        liveness.touch(res_id, session_id)
+
+
+def serve(socket, res_id, session_id):
+    """
+    Answers the commands received on socket until it is closed. Must be
+    called from within the request that opened it, after its session has
+    been checked.
+    """
+    # Only reached under gevent, which provides wsgi.websocket
+    import gevent
+    keeper = gevent.spawn(keep_alive, current_app._get_current_object(),
+                          socket, res_id, session_id,
+                          current_app.config['WEBSOCKET_KEEP_ALIVE'])
+    try:
+        while True:
+            message = socket.receive()
+            if message is None:
+                break
+            try:
+                reply = dispatch(res_id, session_id, message)
+            except AccessRevoked as e:
+                socket.send(dumps({'id': e.command_id,
+                                   'error': error_body(e)}))
+                socket.close()
+                break
+            try:
+                body = dumps(reply)
+            except ValueError:
+                error = MWSServerError(
+                    500, 'Error while trying to convert the results to JSON '
+                    'format.')
+                body = dumps({'id': reply['id'], 'error': error_body(error)})
+            socket.send(body)
+    finally:
+        keeper.kill()